@@ -0,0 +1,1515 @@
+# engine.py
+# ゲームのルール本体（Flask に依存しない）。状態は Room / PlayerState、1手の適用は
+#   apply(room, pid, action) -> (room, events)
+# action は対戦画面のフォーム／JSON API と同じキーの mapping（'action' と各フィールド）。
+# events はその手で増えた行動ログ [(種別コード, 行動者pid, tick, 引数), ...]。
+# 確認が要る行動（ヒントのブラフ判断・献身の候補選び）は room.prompt に選択肢を置いて返す。
+# number.py の各ルートはこれを呼んで画面遷移だけを決める。シミュレーションやベンチは
+# リクエストなしで init_room → start_new_round → apply を回せばよい。
+import random, os, time, struct, tempfile, itertools, bisect, shutil
+from array import array
+
+# ====== 定数 ======
+NUM_MIN = 1
+NUM_MAX = 50
+HIDDEN_MIN = 1
+HIDDEN_MAX = 30
+INFO_MAX_DEFAULT = 7
+
+RULE_DEFAULTS = {
+    'trap': True,
+    'bluff': True,
+    'guessflag': True,
+    'decl1': True,
+    'press': True,
+    'roles': True,
+    'yn': True,
+    'devotion': True,
+}
+
+ROLES = {
+    'Scholar':  '学者',
+    'Guardian': '番人',
+    'Trapper':  '罠師',
+    'Disarmer': '解除士',
+    'Trickster':'詐欺師',
+    'Analyst':  '分析屋',
+    'Tuner':    '調律士',
+}
+
+def role_label(code):
+    return ROLES.get(code, '—')
+
+def role_desc(code):
+    desc = {
+        'Scholar':  'ラウンド中ずっとヒント種類指定可＆ヒントCT無効。',
+        'Guardian': '自分の「次ターンスキップ」を1度だけ自動無効化（このラウンド）。',
+        'Trapper':  'info最大 +3。さらに自分のkillは±2即死／±6スキップに強化。',
+        'Disarmer': '自分のターン開始時、2ターンに1回 相手のinfoをランダム解除（CD2）。',
+        'Trickster':'相手がブラフ指摘に失敗するとヒントCT2。さらに相手が得た本物ヒント表示に±1ノイズ。',
+        'Analyst':  'Yes/No質問がクールタイム2、ラウンド3回まで（同一ターン連打は不可）。',
+        'Tuner':    '自分の数の変更がCT5、ラウンド最大3回まで使用可能。',
+    }
+    return desc.get(code, '—')
+
+# ====== ユーティリティ ======
+def eff_ranges(allow_negative: bool):
+    if allow_negative:
+        return -NUM_MAX, NUM_MAX, -HIDDEN_MAX, HIDDEN_MAX
+    return NUM_MIN, NUM_MAX, HIDDEN_MIN, HIDDEN_MAX
+
+def get_info_max(room, pid):
+    base = room.players[pid].info_max
+    extra = 0
+    if has_role(room, pid, 'Trapper'):
+        extra += 3
+    extra -= room.players[pid].devotion_info_penalty
+    return max(1, min(base + extra, 13))
+
+def get_int(form, key, default=None, min_v=None, max_v=None):
+    v = form.get(key)
+    if v is None or v == '':
+        return default
+    try:
+        x = int(v)
+    except Exception:
+        return default
+    if min_v is not None and x < min_v:
+        return default
+    if max_v is not None and x > max_v:
+        return default
+    return x
+
+def reject(room, pid, event, *args):
+    """行動を受け付けず、理由のログだけ残す（手番はそのまま）"""
+    push_event(room, event, pid, *args)
+
+# ====== ルームの状態 ======
+# ルームとプレイヤーごとの状態は __slots__ のクラスで持つ（{1: x, 2: y} の入れ子 dict を作らない）。
+# プレイヤーの値は room.players[pid]（pid=1,2。添字0は None）にまとめ、ラウンドが変わる時は
+# PlayerState.reset_round でその場で初期値に戻す（リストも作り直さず clear する）。
+# CT（*_until）は「この tick になったら解ける」という絶対 tick で持ち、残りは ct_left で
+# 読む時に計算する（switch_turn で毎回減算しない）。tick はラウンド頭で 0 に戻る。
+class PlayerState:
+    __slots__ = (
+        # 対戦を通して持ち越すもの
+        'score', 'pname', 'secret', 'log_epoch', 'hint_penalty_len',
+        # ラウンドごとに reset_round で戻すもの
+        'tries', 'available_hints', 'hint_choice_available', 'cooldown_until', 'change_used',
+        # trap_outcome：自分が守る側の予想判定表（refresh_trap_outcome 参照）
+        'trap_kill', 'trap_info', 'trap_outcome', 'pending_view', 'can_view', 'view_cut_index', 'skip_next_turn',
+        'info_set_this_turn', 'info_max', 'info_free_per_turn', 'info_free_used_this_turn',
+        # 表示ログ索引（log_view=表示対象の添字、log_scan=走査済み位置、log_html=描画済み<li>）
+        'log_view', 'log_scan', 'log_html',
+        'bluff', 'hint_preview', 'hint_penalty_active', 'hint_ct_until',
+        'guess_flag_armed', 'guess_flag_ct_until', 'guess_penalty_active', 'guess_ct_until',
+        'guess_flag_warn', 'guess_flag_used',
+        'decl1_value', 'decl1_used', 'decl1_resolved', 'decl1_hint_token_ready', 'decl1_hint_token_active',
+        'free_guess_pending', 'press_used', 'press_pending',
+        # 解除士：disarm_ready はこの tick 以降の自分のターン開始で発動
+        'role_main', 'role_extra', 'guardian_shield_used', 'disarm_ready',
+        'yn_used_count', 'yn_ct_until', 'yn_last_tick',
+        'devotion_used', 'devotion_offers', 'devotion_info_penalty',
+    )
+
+    def __init__(self, hint_choice, num_span):
+        self.score = 0
+        self.pname = None
+        self.secret = None
+        self.log_epoch = 0
+        self.hint_penalty_len = 1
+        self.available_hints = list(HINT_TYPES)
+        self.trap_kill = []
+        self.trap_info = []
+        self.trap_outcome = bytearray(num_span)
+        self.log_view = []
+        self.log_html = []
+        self.reset_round(hint_choice)
+
+    def reset_round(self, hint_choice):
+        self.tries = 0
+        self.available_hints[:] = HINT_TYPES
+        self.hint_choice_available = hint_choice
+        self.cooldown_until = 0
+        self.change_used = 0
+        self.trap_kill.clear()
+        self.trap_info.clear()
+        self.trap_outcome[:] = bytes(len(self.trap_outcome))
+        self.pending_view = False
+        self.can_view = False
+        self.view_cut_index = None
+        self.skip_next_turn = False
+        self.info_set_this_turn = False
+        self.info_max = INFO_MAX_DEFAULT
+        self.info_free_per_turn = 1
+        self.info_free_used_this_turn = 0
+        self.log_view.clear()
+        self.log_scan = 0
+        self.log_html.clear()
+
+        self.bluff = None
+        self.hint_preview = None
+        self.hint_penalty_active = False
+        self.hint_ct_until = 0
+        self.guess_flag_armed = False
+        self.guess_flag_ct_until = 0
+        self.guess_penalty_active = False
+        self.guess_ct_until = 0
+        self.guess_flag_warn = False
+        self.guess_flag_used = False
+
+        self.decl1_value = None
+        self.decl1_used = False
+        self.decl1_resolved = True
+        self.decl1_hint_token_ready = False
+        self.decl1_hint_token_active = False
+        self.free_guess_pending = False
+
+        self.press_used = False
+        self.press_pending = False
+
+        self.role_main = None
+        self.role_extra = None
+        self.guardian_shield_used = False
+        self.disarm_ready = 0
+
+        self.yn_used_count = 0
+        self.yn_ct_until = 0
+        self.yn_last_tick = -999
+
+        self.devotion_used = False
+        self.devotion_offers = None
+        self.devotion_info_penalty = 0
+
+class Room:
+    __slots__ = (
+        'id', 'allow_negative', 'eff_num_min', 'eff_num_max', 'eff_hidden_min', 'eff_hidden_max',
+        'target_points', 'round_no', 'turn', 'hidden', 'actions', 'winner', 'phase', 'last_active',
+        'starter', 'rules', 'turn_serial', 'tick', 'skip_suppress_pid', 'players',
+        # 確認待ちの選択肢（apply の頭で None に戻す）
+        'prompt',
+        # ストア用：公開スナップショット（notify_room）と共有ストアの rev
+        'poll_snap', '_rev',
+    )
+
+    def __init__(self, rid, allow_negative, target_points, rules):
+        self.id = rid
+        self.allow_negative = allow_negative
+        self.eff_num_min, self.eff_num_max, self.eff_hidden_min, self.eff_hidden_max = eff_ranges(allow_negative)
+        self.target_points = target_points
+        self.round_no = 1
+        self.turn = 1
+        self.hidden = None
+        self.actions = EventLog()
+        self.winner = None
+        self.phase = 'lobby'
+        self.last_active = time.time()
+        self.starter = 1
+        self.rules = rules
+        self.turn_serial = 0
+        self.tick = 0
+        self.skip_suppress_pid = None
+        self.prompt = None
+        span = self.eff_num_max - self.eff_num_min + 1
+        self.players = (None, PlayerState(False, span), PlayerState(True, span))
+        self.poll_snap = None
+        self._rev = None
+
+def init_room(allow_negative: bool, target_points: int, rules=None, rid=None):
+    if rules is None:
+        rules = RULE_DEFAULTS.copy()
+    else:
+        base = RULE_DEFAULTS.copy()
+        base.update({k: bool(v) for k, v in rules.items()})
+        rules = base
+    return Room(rid, allow_negative, target_points, rules)
+
+# ====== 行動ログ（型付きイベント） ======
+# ログは文章ではなく (種別コード, 行動者pid, tick, 整数引数列) の列として配列に詰めて持つ。
+# 日本語への整形は表示時に EVENTS の render で行う（リプレイ・書き出し・集計は生の列を使う）。
+# 公開範囲：PUBLIC=両者に常に表示（相手の g 予想）、ACTOR=本人＋info発動後の相手
+LOG_VIS_PUBLIC = 0
+LOG_VIS_ACTOR = 1
+EVENT_ARG_MAX = 2**31 - 1
+
+HINT_TYPES = ('和', '差', '積')
+ROLE_KEYS = tuple(ROLES)
+YN_TYPES = ('ge', 'le', 'eq', 'between')
+
+# 行動ログのメモリ上限：直近 LOG_MEM_CAP 件だけをリングバッファに持ち、溢れた古い側は
+# 半分ずつルーム別の追記専用ファイル（固定長レコード）へ書き出す。
+# 対戦画面は直近 LOG_WINDOW 件の範囲だけを表示し（常にメモリ内）、ラウンド結果ではファイルから流す。
+LOG_MEM_CAP = max(16, int(os.environ.get("LOG_MEM_CAP", "512")))
+LOG_SPILL_DIR = os.environ.get("LOG_SPILL_DIR") or os.path.join(tempfile.gettempdir(), "number-logs")
+EVENT_MAX_ARGS = 8
+# code, actor, tick, 引数の個数, 引数×EVENT_MAX_ARGS
+EVENT_REC = struct.Struct(f"<BbiB{EVENT_MAX_ARGS}i")
+_spill_seq = itertools.count(1)
+
+class LogDiscarded(Exception):
+    """spill 済みの範囲を読もうとしたが、ファイルがもう無い（ラウンド終了で discard() 済みなど）"""
+    pass
+
+class EventLog:
+    """1ラウンド分の行動ログ。添字は通し番号のまま、直近 LOG_MEM_CAP 件を列ごとの array に
+    リング状に持ち（slot = 添字 % cap）、それより古い分は spill ファイルから読む"""
+    __slots__ = ('cap', 'n', 'spilled', 'path', 'code', 'actor', 'tick', 'nargs', 'args')
+
+    def __init__(self, cap=LOG_MEM_CAP):
+        self.cap = cap
+        self.n = 0          # 通算件数
+        self.spilled = 0    # ファイルへ書き出し済みの件数（= メモリ上の先頭添字）
+        self.path = None
+        self.code = array('B', bytes(cap))
+        self.actor = array('b', bytes(cap))
+        self.tick = array('i', bytes(4 * cap))
+        self.nargs = array('B', bytes(cap))
+        self.args = array('i', bytes(4 * cap * EVENT_MAX_ARGS))
+
+    def __len__(self):
+        return self.n
+
+    def append(self, code, actor, tick, args=()):
+        if len(args) > EVENT_MAX_ARGS:
+            raise ValueError(f"event args > {EVENT_MAX_ARGS}")
+        if self.n - self.spilled >= self.cap:
+            self._spill(self.cap // 2)
+        self._put(self.n, code, actor or 0, tick, args)
+        self.n += 1
+
+    def _put(self, i, code, actor, tick, args):
+        k = i % self.cap
+        self.code[k] = code
+        self.actor[k] = actor
+        self.tick[k] = tick
+        self.nargs[k] = len(args)
+        base = k * EVENT_MAX_ARGS
+        self.args[base:base + len(args)] = array('i', args)
+
+    def _record(self, i):
+        k = i % self.cap
+        base = k * EVENT_MAX_ARGS
+        return EVENT_REC.pack(self.code[k], self.actor[k], self.tick[k], self.nargs[k],
+                              *self.args[base:base + EVENT_MAX_ARGS])
+
+    def _spill(self, count):
+        if self.path is None:
+            os.makedirs(LOG_SPILL_DIR, exist_ok=True)
+            self.path = os.path.join(LOG_SPILL_DIR, f"{os.getpid()}-{next(_spill_seq)}.log")
+        stop = self.spilled + max(1, count)
+        # 位置指定で書く：共有ストアで楽観ロックが外れてやり直した時も同じ位置に上書きされる
+        with open(self.path, 'r+b' if os.path.exists(self.path) else 'wb') as f:
+            f.seek(self.spilled * EVENT_REC.size)
+            f.write(b"".join(self._record(i) for i in range(self.spilled, stop)))
+            f.truncate()
+        self.spilled = stop
+
+    def _mem(self, i):
+        k = i % self.cap
+        base = k * EVENT_MAX_ARGS
+        return self.code[k], self.actor[k], self.tick[k], tuple(self.args[base:base + self.nargs[k]])
+
+    @staticmethod
+    def _unpack(buf):
+        code, actor, tick, nargs, *args = EVENT_REC.unpack(buf)
+        return code, actor, tick, tuple(args[:nargs])
+
+    def get(self, i):
+        if i < 0 or i >= self.n:
+            raise IndexError(i)
+        if i >= self.spilled:
+            return self._mem(i)
+        if self.path is None:
+            raise LogDiscarded(i)
+        with open(self.path, 'rb') as f:
+            f.seek(i * EVENT_REC.size)
+            return self._unpack(f.read(EVENT_REC.size))
+
+    def iter_range(self, start=0, stop=None):
+        """(添字, (code, actor, tick, args)) を順に返す。書き出し済みの範囲はファイルから順読み。
+        spill ファイルが discard() 済み・消失している時は LogDiscarded（途中までで黙って終わらない）"""
+        stop = self.n if stop is None else min(stop, self.n)
+        i = max(0, start)
+        if i < min(self.spilled, stop):
+            if self.path is None:
+                raise LogDiscarded(i)
+            try:
+                f = open(self.path, 'rb')
+            except OSError:
+                # 次ラウンドへ進んで（共有ストアでは別ワーカーに）消されたログを読みに来た場合など
+                raise LogDiscarded(i) from None
+            with f:
+                f.seek(i * EVENT_REC.size)
+                while i < min(self.spilled, stop):
+                    buf = f.read(EVENT_REC.size)
+                    if len(buf) < EVENT_REC.size:
+                        raise LogDiscarded(i)
+                    yield i, self._unpack(buf)
+                    i += 1
+        for i in range(max(i, self.spilled), stop):
+            yield i, self._mem(i)
+
+    def truncate(self, n):
+        """n 件目以降を捨てる（バッチ実行の巻き戻し用）"""
+        if n >= self.n:
+            return
+        if n < self.spilled:
+            # 残す分はすべてファイル側にある。末尾の cap//2 件をメモリへ読み戻して
+            # （表示窓の読み出しがファイルへ行かないように）、ファイルはその手前で切る
+            keep = min(n, self.cap // 2)
+            with open(self.path, 'rb') as f:
+                f.seek((n - keep) * EVENT_REC.size)
+                buf = f.read(keep * EVENT_REC.size)
+            for j in range(keep):
+                self._put(n - keep + j, *self._unpack(buf[j * EVENT_REC.size:(j + 1) * EVENT_REC.size]))
+            self.spilled = n - keep
+            os.truncate(self.path, self.spilled * EVENT_REC.size)
+        self.n = n
+
+    def discard(self):
+        """ラウンド終了・マッチ終了時に spill ファイルを消す"""
+        if self.path:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+    def freeze(self):
+        """読み出し専用の複製。配列と spill ファイルを写すので、元のログがこの後
+        discard()・truncate() されても複製は最後まで読める（使い終わったら discard()）"""
+        snap = EventLog.__new__(EventLog)
+        snap.cap, snap.n, snap.spilled, snap.path = self.cap, self.n, self.spilled, None
+        for name in ('code', 'actor', 'tick', 'nargs', 'args'):
+            a = getattr(self, name)
+            setattr(snap, name, array(a.typecode, a))
+        if self.spilled:
+            if self.path is None:
+                raise LogDiscarded(0)
+            snap.path = os.path.join(LOG_SPILL_DIR, f"{os.getpid()}-{next(_spill_seq)}.log")
+            try:
+                shutil.copyfile(self.path, snap.path)
+            except OSError:
+                snap.path = None
+                raise LogDiscarded(0) from None
+        return snap
+
+    def to_list(self):
+        """書き出し用：[{'event','actor','tick','args'}, ...]"""
+        return [{'event': EVENTS[code][0], 'actor': actor, 'tick': tick, 'args': list(args)}
+                for _i, (code, actor, tick, args) in self.iter_range()]
+
+def _yn_desc(a):
+    q, x = YN_TYPES[a[0]], a[2]
+    if q == 'between':
+        return f"[{x}, {a[3]}] 内"
+    return {'ge': '≥', 'le': '≤', 'eq': '='}[q] + f" {x}"
+
+_A = LOG_VIS_ACTOR
+_P = LOG_VIS_PUBLIC
+# (名前, 公開範囲, 本文 render(行動者名, 相手名, 引数), FXキー, 叫び)
+EVENTS = (
+    ('guardian_shield', _A, lambda me, op, a: f"{me} の番人効果により『次ターンスキップ』は無効化された（このラウンド1回）", None, None),
+    ('disarm', _A, lambda me, op, a: f"{me} の解除士が相手のinfo({a[0]})を解除した（CD2）", None, None),
+    ('turn_skipped', _A, lambda me, op, a: f"{me} のターンは近接トラップ効果でスキップ", 'kill_near', 'ヒヤッ！'),
+    ('guessflag_notice', _A, lambda me, op, a: f"{me} への通知: 実は前のターンに {op} がゲスフラグを立てていた。危なかった！", 'ping', None),
+    ('devotion_gain', _A, lambda me, op, a: f"{me} が 献身として『{role_label(ROLE_KEYS[a[0]])}』を獲得 — {role_desc(ROLE_KEYS[a[0]])}", None, None),
+    ('devotion_cost', _A, lambda me, op, a: "（献身の代償：このターン終了／g&amp;hにCT1／info上限-2）", None, None),
+    ('hint_typed', _A, lambda me, op, a: f"{me} が h（ヒント取得）{HINT_TYPES[a[0]]}＝{a[1]}", None, None),
+    ('hint', _A, lambda me, op, a: f"{me} が h（ヒント取得）＝{a[0]}", None, None),
+    ('hint_ct', _A, lambda me, op, a: "（ヒントはCT中）", None, None),
+    ('hint_accept_typed', _A, lambda me, op, a: f"{me} は 提示ヒント（{a[1]}）を受け入れた → h（ヒント取得）{HINT_TYPES[a[0]]}＝{a[1]}", None, None),
+    ('hint_accept', _A, lambda me, op, a: f"{me} は 提示ヒント（{a[0]}）を受け入れた → h（ヒント取得）＝{a[0]}", None, None),
+    ('guess_ct', _A, lambda me, op, a: "（予想はCT中）", None, None),
+    ('guessflag_boom', _P, lambda me, op, a: f"（{op} のゲスフラグが発動！{me} は即死）", 'flag_boom', 'ゲスフラ炸裂！'),
+    ('guess_hit', _P, lambda me, op, a: f"{me} が g（予想）→ {a[0]}（正解！相手は即死）", 'guess_hit', '一撃必殺！'),
+    ('guess_kill', _P, lambda me, op, a: f"{me} が g（予想）→ {a[0]}（killトラップ±{a[1]}命中＝即敗北）", 'kill_dead', '木っ端微塵！'),
+    ('guess_info', _P, lambda me, op, a: f"{me} が g（予想）→ {a[0]}（情報トラップ発動）", 'info', '覗き見タイム！'),
+    ('guess_near', _P, lambda me, op, a: f"{me} が g（予想）→ {a[0]}（kill近接±{a[1]}命中：次ターンスキップ）", 'kill_near', 'ヒヤッ！'),
+    ('guess_miss', _P, lambda me, op, a: f"{me} が g（予想）→ {a[0]}（ハズレ）", None, None),
+    ('press_ready', _A, lambda me, op, a: "（サドン・プレスのチャンス！）", 'press_ready', 'もう一回いく？'),
+    ('bluff_caught', _A, lambda me, op, a: f"{me} は ブラフだ！と指摘 → 見破った！本物ヒント×2", 'bluff_ok', '見抜いた！'),
+    ('bluff_wrong', _A, lambda me, op, a: f"{me} は ブラフだ！と指摘したが外れ（以後ヒント取得後はCT{a[0]}）", 'bluff_ng', 'ぐぬぬ…'),
+    ('change_ct', _A, lambda me, op, a: "（自分の数の変更はCT中）", None, None),
+    ('change_on_trap', _A, lambda me, op, a: "⚠ その数字は現在のトラップに含まれています。別の数字を選んでください。", None, None),
+    ('change_out_of_range', _A, lambda me, op, a: "⚠ 範囲外の数字です。", None, None),
+    ('change_limit', _A, lambda me, op, a: f"（このラウンドでの自分の数の変更は{a[0]}回まで）", None, None),
+    ('change', _A, lambda me, op, a: f"{me} が c（自分の数を変更）→ {a[0]}", 'change', '入れ替え！'),
+    ('decl_reset', _A, lambda me, op, a: f"（宣言効果リセット：無料info/ターン=1、上限={a[0]}。再宣言可）", None, None),
+    ('kill_invalid', _A, lambda me, op, a: "⚠ 無効なkillトラップ値です。", None, None),
+    ('kill_set', _A, lambda me, op, a: f"{me} が killトラップを {a[0]} に設定", None, None),
+    ('info_bulk', _A, lambda me, op, a: f"{me} が infoトラップをまとめて設定 → {', '.join(map(str, a))}（ターン消費）", None, None),
+    ('info_none', _A, lambda me, op, a: "⚠ infoトラップの追加はありません。", None, None),
+    ('info_free_cap', _A, lambda me, op, a: f"（このターンの無料infoは上限 {a[0]} 個に達しています）", None, None),
+    ('info_max', _A, lambda me, op, a: f"（infoは最大{a[0]}個までです）", None, None),
+    ('info_set', _A, lambda me, op, a: f"{me} が infoトラップを {', '.join(map(str, a[1:]))} に設定（ターン消費なし／このターンはあと {a[0]} 個）", None, None),
+    ('bluff_bad_value', _A, lambda me, op, a: "⚠ ブラフ値が不正です。", None, None),
+    ('bluff_set', _A, lambda me, op, a: f"{me} が ブラフヒント を仕掛けた", None, None),
+    ('guessflag_used', _A, lambda me, op, a: "⚠ このラウンドでは既にゲスフラグを使っています。", None, None),
+    ('guessflag_set', _A, lambda me, op, a: f"{me} が ゲスフラグ を立てた", 'ping', None),
+    ('decl', _A, lambda me, op, a: f"{me} が 一の位を {a[0]} と宣言（このラウンド中、無料infoは1ターン2個・最大10個）", 'decl', '宣言ッ！'),
+    ('decl_notice', _A, lambda me, op, a: f"{me} への通知: {op} が秘密の数字の一の位が {a[0]} であると宣言した", None, None),
+    ('decl_call_ok', _A, lambda me, op, a: f"{me} が『嘘だ！』→ 成功。正しい一の位は {a[0]}", 'bluff_ok', '見破った！'),
+    ('decl_call_ng', _A, lambda me, op, a: f"{me} が『嘘だ！』→ 失敗（宣言は真だった）", 'bluff_ng', 'ぐぬぬ…'),
+    ('press_hit', _A, lambda me, op, a: f"{me} が サドン・プレス → {a[0]}（正解！相手は即死）", 'guess_hit', '一撃必殺！'),
+    ('press_kill', _A, lambda me, op, a: f"{me} が サドン・プレス → {a[0]}（killトラップ±{a[1]}命中＝即敗北）", 'kill_dead', '木っ端微塵！'),
+    ('press_info', _A, lambda me, op, a: f"{me} が サドン・プレス → {a[0]}（情報トラップ発動）", 'info', '覗き見タイム！'),
+    ('press_miss', _A, lambda me, op, a: f"{me} が サドン・プレス → {a[0]}（ハズレ：次ターンスキップ）", 'press_miss', 'ガーン…'),
+    ('press_pass', _A, lambda me, op, a: f"{me} は サドン・プレスを見送った", None, None),
+    ('free_hit', _A, lambda me, op, a: f"{me} が 無料予想 → {a[0]}（正解！相手は即死）", 'guess_hit', '一撃必殺！'),
+    ('free_kill', _A, lambda me, op, a: f"{me} が 無料予想 → {a[0]}（killトラップ±{a[1]}命中＝即敗北）", 'kill_dead', '木っ端微塵！'),
+    ('free_info', _A, lambda me, op, a: f"{me} が 無料予想 → {a[0]}（情報トラップ発動）", 'info', '覗き見タイム！'),
+    ('free_near', _A, lambda me, op, a: f"{me} が 無料予想 → {a[0]}（kill近接±{a[1]}命中：次ターンスキップ）", 'kill_near', 'ヒヤッ！'),
+    ('free_miss', _A, lambda me, op, a: f"{me} が 無料予想 → {a[0]}（ハズレ）", None, None),
+    ('yn', _A, lambda me, op, a: f"{me} が Yes/No 質問 → 「{_yn_desc(a)}？」：{'Yes' if a[1] else 'No'}", None, None),
+    # reject の差し戻しメッセージ
+    ('bad_guess', _A, lambda me, op, a: "⚠ 予想値が不正です。", None, None),
+    ('bad_change', _A, lambda me, op, a: "⚠ 変更する数が不正です。", None, None),
+    ('bad_press', _A, lambda me, op, a: "⚠ サドン・プレスの値が不正です。", None, None),
+    ('bad_free_guess', _A, lambda me, op, a: "⚠ 無料予想の値が不正です。", None, None),
+    ('bad_action', _A, lambda me, op, a: "⚠ 不明なアクションです。", None, None),
+    ('devotion_disabled', _A, lambda me, op, a: "（このルームでは献身は無効です）", None, None),
+    ('devotion_used', _A, lambda me, op, a: "（このラウンドは既に献身を使っています）", None, None),
+    ('devotion_bad_pick', _A, lambda me, op, a: "⚠ 献身の選択肢が有効ではありません。", None, None),
+    ('trap_disabled', _A, lambda me, op, a: "（このルームではトラップは無効です）", None, None),
+    ('bluff_disabled', _A, lambda me, op, a: "（このルームではブラフヒントは無効です）", None, None),
+    ('guessflag_disabled', _A, lambda me, op, a: "（このルームではゲスフラグは無効です）", None, None),
+    ('decl_disabled', _A, lambda me, op, a: "（このルームでは一の位の宣言は無効です）", None, None),
+    ('decl_used', _A, lambda me, op, a: "（このラウンドは既に宣言しています）", None, None),
+    ('decl_bad_digit', _A, lambda me, op, a: "⚠ 一の位は0〜9で入力してください。", None, None),
+    ('decl_call_unavailable', _A, lambda me, op, a: "（相手の宣言は現在チャレンジできません）", None, None),
+    ('press_disabled', _A, lambda me, op, a: "（このルームではサドン・プレスは無効です）", None, None),
+    ('press_unavailable', _A, lambda me, op, a: "（サドン・プレスは現在使用できません）", None, None),
+    ('press_not_pending', _A, lambda me, op, a: "（サドン・プレス待機はありません）", None, None),
+    ('yn_disabled', _A, lambda me, op, a: "（このルームではYes/No質問は無効です）", None, None),
+    ('yn_limit', _A, lambda me, op, a: f"（このラウンドのYes/Noは上限 {a[0]} 回です）", None, None),
+    ('yn_same_turn', _A, lambda me, op, a: "（同一ターンでの連続質問はできません）", None, None),
+    ('yn_ct', _A, lambda me, op, a: "（Yes/NoはCT中です）", None, None),
+    ('yn_bad_input', _A, lambda me, op, a: "⚠ 質問の入力が不正です。", None, None),
+)
+EV = {e[0]: code for code, e in enumerate(EVENTS)}
+EVENT_VIS = bytes(e[1] for e in EVENTS)
+
+def push_event(room, name, actor, *args):
+    """actor=行動者（通知なら宛先）のpid。args は整数のみ（表示用の文字列は render 側で作る）"""
+    room.actions.append(EV[name], actor, room.tick, args)
+
+def log_visible(room, pid, idx, ev=None):
+    code, actor = (ev or room.actions.get(idx))[:2]
+    if actor == pid or EVENT_VIS[code] == LOG_VIS_PUBLIC:
+        return True
+    if not actor or not room.players[pid].can_view:
+        return False
+    cut = room.players[pid].view_cut_index
+    return cut is None or idx >= cut
+
+def rewind_log_view(room, pid, idx):
+    """閲覧権・閲覧開始位置が変わった時、idx 以降を再走査させる"""
+    view = room.players[pid].log_view
+    keep = bisect.bisect_left(view, idx)
+    if keep < len(view) or idx < room.players[pid].log_scan:
+        room.players[pid].log_epoch += 1
+    del view[keep:]
+    del room.players[pid].log_html[keep:]
+    room.players[pid].log_scan = min(room.players[pid].log_scan, idx)
+
+def set_view_cut(room, viewer):
+    """info トラップ発動：viewer は次ターン以降、この時点からの相手の行動を閲覧できる"""
+    old = room.players[viewer].view_cut_index
+    cut = len(room.actions)
+    room.players[viewer].view_cut_index = cut
+    rewind_log_view(room, viewer, cut if old is None else min(old, cut))
+
+def has_role(room, pid, code):
+    if not room.rules.get('roles', True):
+        return False
+    return room.players[pid].role_main == code or room.players[pid].role_extra == code
+
+def assign_roles(room):
+    """ラウンド頭（reset_round の後）にメインロールを配る。副ロール・守護/解除士の状態は reset_round で初期化済み"""
+    if not room.rules.get('roles', True):
+        return
+    keys = list(ROLES.keys())
+    room.players[1].role_main = random.choice(keys)
+    room.players[2].role_main = random.choice(keys)
+
+def set_skip(room, pid):
+    if has_role(room, pid, 'Guardian') and not room.players[pid].guardian_shield_used:
+        room.players[pid].guardian_shield_used = True
+        push_event(room, 'guardian_shield', pid)
+        return
+    room.players[pid].skip_next_turn = True
+
+def _apply_trickster_noise(room, hint_owner_pid, value):
+    opp = 2 if hint_owner_pid == 1 else 1
+    if has_role(room, opp, 'Trickster'):
+        delta = random.choice([-1, 1])
+        return value + delta
+    return value
+
+def switch_turn(room, cur_pid):
+    opp_prev = 2 if cur_pid == 1 else 1
+    if room.players[opp_prev].pending_view:
+        room.players[opp_prev].can_view = True
+        rewind_log_view(room, opp_prev, room.players[opp_prev].view_cut_index or 0)
+        room.players[opp_prev].pending_view = False
+
+    next_pid = opp_prev
+    room.turn = next_pid
+    room.tick += 1
+    room.players[next_pid].info_free_used_this_turn = 0
+    room.skip_suppress_pid = None
+
+    if room.rules.get('guessflag', True):
+        gf_owner = next_pid
+        prev = cur_pid
+        if room.players[gf_owner].guess_flag_armed:
+            room.players[gf_owner].guess_flag_armed = False
+            room.players[prev].guess_flag_warn = True
+
+    # 解除士：自分のターン開始時、2ターンに1回ランダム解除（CD2）
+    if has_role(room, next_pid, 'Disarmer') and room.tick >= room.players[next_pid].disarm_ready:
+        opp = 2 if next_pid == 1 else 1
+        if room.players[opp].trap_info:
+            removed = remove_info_trap(room, opp, random.randrange(len(room.players[opp].trap_info)))
+            room.players[next_pid].disarm_ready = own_turns_later(room, 2)  # 次の自分のターン2回は待機
+            push_event(room, 'disarm', next_pid, removed)
+
+    bump_serial(room)
+
+def bump_serial(room):
+    """手番・勝敗・フェーズが変わった印（/poll・/events はこの番号の変化を見る）"""
+    room.turn_serial += 1
+
+
+def start_new_round(room):
+    room.hidden = random.randint(room.eff_hidden_min, room.eff_hidden_max)
+    room.actions.discard()
+    room.actions = EventLog()
+    for p in (1, 2):
+        ps = room.players[p]
+        ps.reset_round(p != room.starter)
+        ps.log_epoch += 1
+    assign_roles(room)
+    room.turn = room.starter
+    room.tick = 0
+    room.winner = None
+    room.phase = 'play'
+    bump_serial(room)
+
+# ===== kill 閾値（罠師なら±2/±6、通常±1/±5） =====
+# (即死の幅, 近接＝次ターンスキップの幅)
+KILL_THRESHOLDS = (1, 5)
+KILL_THRESHOLDS_TRAPPER = (2, 6)
+
+def _kill_thresholds(room, trap_owner_pid):
+    if has_role(room, trap_owner_pid, 'Trapper'):
+        return KILL_THRESHOLDS_TRAPPER
+    return KILL_THRESHOLDS
+
+# --- 予想の判定表 ---
+# 守る側ごとに eff_num_min..eff_num_max の各値へ OUT_* フラグを持ち、予想は1回の添字参照で判定する。
+# トラップが変わった時は変わった値の near_t 以内だけ、しきい値が変わる時（ロール取得）は全体を作り直す。
+OUT_KILL = 1  # 即死トラップから inst_t 以内
+OUT_NEAR = 2  # 即死トラップから near_t 以内
+OUT_INFO = 4  # info トラップそのもの
+
+def trap_flags(v, kills, infos, inst_t, near_t):
+    """値 v への予想が守る側のトラップに対して立てる OUT_* フラグ"""
+    f = OUT_INFO if v in infos else 0
+    if kills:
+        d = min(abs(v - k) for k in kills)
+        if d <= inst_t:
+            f |= OUT_KILL
+        if d <= near_t:
+            f |= OUT_NEAR
+    return f
+
+def refresh_trap_outcome(room, pid, values=None):
+    ps = room.players[pid]
+    lo, hi = room.eff_num_min, room.eff_num_max
+    inst_t, near_t = _kill_thresholds(room, pid)
+    spans = [(lo, hi)] if values is None else [(max(lo, v - near_t), min(hi, v + near_t)) for v in values]
+    kills, infos, table = ps.trap_kill, set(ps.trap_info), ps.trap_outcome
+    for a, b in spans:
+        for v in range(a, b + 1):
+            table[v - lo] = trap_flags(v, kills, infos, inst_t, near_t)
+
+def set_kill_trap(room, pid, x):
+    """kill は1つだけ（上書き）"""
+    kills = room.players[pid].trap_kill
+    changed = kills + [x]
+    kills.clear()
+    kills.append(x)
+    refresh_trap_outcome(room, pid, changed)
+
+def add_info_traps(room, pid, values):
+    room.players[pid].trap_info.extend(values)
+    refresh_trap_outcome(room, pid, values)
+
+def remove_info_trap(room, pid, idx):
+    x = room.players[pid].trap_info.pop(idx)
+    refresh_trap_outcome(room, pid, [x])
+    return x
+
+def resolve_guess(room, pid, val, kind):
+    """予想・プレス・無料予想の共通判定。当たり／即死／info の処理（得点・勝者・閲覧権・ログ）まで行い、
+    'hit' / 'kill' / 'near' / 'miss' を返す。kind はログ種別の頭（'guess' / 'press' / 'free'）"""
+    opp = 2 if pid == 1 else 1
+    if val == room.players[opp].secret:
+        push_event(room, kind + '_hit', pid, val)
+        room.players[pid].score += 1
+        room.winner = pid
+        bump_serial(room)
+        return 'hit'
+    i = val - room.eff_num_min
+    flags = room.players[opp].trap_outcome[i] if 0 <= i < len(room.players[opp].trap_outcome) else 0
+    if flags & OUT_KILL:
+        push_event(room, kind + '_kill', pid, val, _kill_thresholds(room, opp)[0])
+        room.players[opp].score += 1
+        room.winner = opp
+        bump_serial(room)
+        return 'kill'
+    if flags & OUT_INFO:
+        room.players[opp].pending_view = True
+        set_view_cut(room, opp)
+        push_event(room, kind + '_info', pid, val)
+    return 'near' if flags & OUT_NEAR else 'miss'
+# --- CT（クールタイム）を自分の手番単位で正しく付与するヘルパ ---
+def own_turns_later(room, n):
+    """自分の手番中に呼ぶ：この後の自分の手番 n 回をやり過ごした時点の tick。
+    ターン交代ごとに tick が1進むので、自分の手番 n 回＝交代 2n 回＋今の手番の終わりの1回"""
+    return room.tick + 2 * max(0, int(n)) + 1
+
+def ct_left(room, pid, key):
+    """CT の残り（ターン交代の回数）。0 なら解けている"""
+    return max(0, getattr(room.players[pid], key) - room.tick)
+
+def start_ct(room, pid, key, ticks):
+    """CT を ticks 回のターン交代ぶん掛ける"""
+    setattr(room.players[pid], key, room.tick + ticks)
+
+def apply_ct(room, pid, key, own_turns):
+    """CTを「自分の手番」単位で付与する。既存のCTより短くはしない"""
+    ps = room.players[pid]
+    setattr(ps, key, max(getattr(ps, key), own_turns_later(room, own_turns)))
+
+def resolve_pending_skip(room):
+    """手番側に「次ターンスキップ」が残っていれば消化して手番を渡す（渡したら True）"""
+    if room.players[room.turn].skip_next_turn and room.skip_suppress_pid != room.turn:
+        room.players[room.turn].skip_next_turn = False
+        push_event(room, 'turn_skipped', room.turn)
+        cur = room.turn
+        switch_turn(room, cur)
+        return True
+    return False
+
+def apply(room, pid, action):
+    """pid の1手を適用して (room, events) を返す。events はこの手で増えた行動ログ。
+    手番・フェーズの確認は呼び出し側で行う（resolve_pending_skip も同様）"""
+    room.prompt = None
+    n0 = len(room.actions)
+    dispatch(room, pid, action)
+    return room, [ev for _i, ev in room.actions.iter_range(n0)]
+
+def dispatch(room, pid, form):
+    """action コードを handle_* に振り分ける"""
+    action = form.get('action')
+    if action == 'g':
+        guess_val = get_int(form, 'guess', None, room.eff_num_min, room.eff_num_max)
+        if guess_val is None:
+            return reject(room, pid, 'bad_guess')
+        return handle_guess(room, pid, guess_val)
+
+    elif action == 'h':
+        return handle_hint(room, pid, form)
+
+    elif action == 'c':
+        new_secret = get_int(form, 'new_secret', None, room.eff_num_min, room.eff_num_max)
+        if new_secret is None:
+            return reject(room, pid, 'bad_change')
+        return handle_change(room, pid, new_secret)
+
+    elif action == 't':
+        return handle_trap(room, pid, form)
+
+    elif action == 't_kill':
+        return handle_trap_kill(room, pid, form)
+
+    elif action == 't_info':
+        return handle_trap_info(room, pid, form)
+
+    elif action == 'bh':
+        return handle_bluff(room, pid, form)
+
+    elif action == 'gf':
+        return handle_guessflag(room, pid)
+
+    elif action == 'decl1':
+        return handle_decl1(room, pid, form)
+
+    elif action == 'decl1_challenge':
+        return handle_decl1_challenge(room, pid)
+
+    elif action == 'press':
+        press_val = get_int(form, 'press_guess', None, room.eff_num_min, room.eff_num_max)
+        if press_val is None:
+            return reject(room, pid, 'bad_press')
+        return handle_press(room, pid, press_val)
+
+    elif action == 'press_skip':
+        return handle_press_skip(room, pid)
+
+    elif action == 'free_guess':
+        fg_val = get_int(form, 'free_guess', None, room.eff_num_min, room.eff_num_max)
+        if fg_val is None:
+            return reject(room, pid, 'bad_free_guess')
+        return handle_free_guess(room, pid, fg_val)
+
+    elif action == 'yn':
+        return handle_yn(room, pid, form)
+
+    elif action == 'devotion_offer':
+        return handle_devotion_offer(room, pid)
+
+    elif action == 'devotion_pick':
+        pick = form.get('pick')
+        return handle_devotion_pick(room, pid, pick)
+
+    else:
+        return reject(room, pid, 'bad_action')
+
+# ====== アクション処理 ======
+
+def hint_value(htype, secret, hidden):
+    """ヒントの真値（和＝secret+hidden、差＝|secret−hidden|、積＝secret×hidden）。ノイズは別"""
+    if htype == '和':
+        return secret + hidden
+    if htype == '差':
+        return abs(secret - hidden)
+    return secret * hidden
+
+def yn_answer(qtype, secret, x=None, lo=None, hi=None):
+    """Yes/No 質問の答え。between は lo <= hi に並べてから渡す"""
+    if qtype == 'ge':
+        return secret >= x
+    if qtype == 'le':
+        return secret <= x
+    if qtype == 'eq':
+        return secret == x
+    return lo <= secret <= hi
+
+def _hint_once(room, pid, chose_by_user=False, silent=False, chosen_type=None):
+    opp = 2 if pid == 1 else 1
+    opp_secret = room.players[opp].secret
+    hidden = room.hidden
+
+    # --- 先にプレビューがあればそれを使う（確認画面と実値の一致を保証） ---
+    pv = room.players[pid].hint_preview
+    if pv:
+        htype = pv.get('type')         # '和' / '差' / '積'
+        shown = pv.get('shown')        # 既にノイズ適用済みの表示値
+        # 在庫（available_hints）をここで消費
+        stock = room.players[pid].available_hints
+        if htype in stock:
+            stock.remove(htype)
+        # 使い終わったのでクリア
+        room.players[pid].hint_preview = None
+        # プレビュー経由でも「種類指定だったか」を反映（学者・後攻指定）
+        chose_by_user = pv.get('chose_by_user', chose_by_user)
+    else:
+        # ここからは従来どおりの決定・計算フロー
+        if chosen_type in ('和','差','積'):
+            htype = chosen_type
+            stock = room.players[pid].available_hints
+            if htype in stock:
+                stock.remove(htype)
+        else:
+            stock = room.players[pid].available_hints
+            if stock:
+                htype = random.choice(stock)
+                stock.remove(htype)
+            else:
+                htype = random.choice(['和','差','積'])
+
+        shown = _apply_trickster_noise(room, pid, hint_value(htype, opp_secret, hidden))
+
+    # --- ログ：指定があった時だけ種別を表示。ランダムは値のみ ---
+    if not silent:
+        if chose_by_user:
+            push_event(room, 'hint_typed', pid, HINT_TYPES.index(htype), shown)
+        else:
+            push_event(room, 'hint', pid, shown)
+    return
+
+def handle_guess(room, pid, guess):
+    opp = 2 if pid == 1 else 1
+
+    if ct_left(room, pid, 'guess_ct_until') > 0:
+        push_event(room, 'guess_ct', pid)
+        switch_turn(room, pid)
+        return
+
+    room.players[pid].tries += 1
+
+    if room.rules.get('guessflag', True) and room.players[opp].guess_flag_armed:
+        room.players[opp].guess_flag_armed = False
+        push_event(room, 'guessflag_boom', pid)
+        room.players[opp].score += 1
+        room.winner = opp
+        bump_serial(room)
+        return
+
+    outcome = resolve_guess(room, pid, guess, 'guess')
+    if outcome in ('hit', 'kill'):
+        return
+
+    if outcome == 'near':
+        set_skip(room, pid)
+        push_event(room, 'guess_near', pid, guess, _kill_thresholds(room, opp)[1])
+        if room.players[pid].guess_penalty_active:
+            apply_ct(room, pid, 'guess_ct_until', 1)
+        switch_turn(room, pid)
+        return
+
+    push_event(room, 'guess_miss', pid, guess)
+    if room.rules.get('press', True) and (not room.players[pid].press_used) and (not room.players[pid].press_pending):
+        push_event(room, 'press_ready', pid)
+        room.players[pid].press_pending = True
+        return
+
+    if room.players[pid].guess_penalty_active:
+        apply_ct(room, pid, 'guess_ct_until', 1)
+    switch_turn(room, pid)
+    return
+
+def handle_hint(room, pid, form):
+    opp = 2 if pid == 1 else 1
+
+    if ct_left(room, pid, 'hint_ct_until') > 0:
+        push_event(room, 'hint_ct', pid)
+        switch_turn(room, pid)
+        return
+
+    want_choose = bool(form.get('confirm_choice'))
+    choose_type = form.get('hint_type')
+
+    if has_role(room, pid, 'Scholar'):
+        want_choose = True
+        if choose_type not in ('和','差','積'):
+            choose_type = random.choice(['和','差','積'])
+
+    if not room.rules.get('bluff', True):
+        allow_choose_now = want_choose and (has_role(room, pid, 'Scholar') or room.players[pid].hint_choice_available) and choose_type in ('和','差','積')
+        if allow_choose_now and not has_role(room, pid, 'Scholar'):
+            room.players[pid].hint_choice_available = False
+        _hint_once(room, pid, chose_by_user=allow_choose_now, silent=False, chosen_type=choose_type if allow_choose_now else None)
+        # ヒント取得後は常にCT1（学者は例外）。ペナルティ中なら長い方を採用
+        if not has_role(room, pid, 'Scholar'):
+            ct_len = 1
+            if room.players[pid].hint_penalty_active:
+                ct_len = max(ct_len, room.players[pid].hint_penalty_len)
+            apply_ct(room, pid, 'hint_ct_until', ct_len)
+        switch_turn(room, pid)
+        return
+
+    decision = form.get('bluff_decision')
+    has_bluff_flag = bool(room.players[opp].bluff)
+
+    if not decision:
+        # 確認：次の送信でも種類指定を引き継ぐ
+        keep = {}
+        if want_choose:
+            keep['confirm_choice'] = '1'
+        if want_choose and choose_type:
+            keep['hint_type'] = choose_type
+        if has_bluff_flag:
+            shown = room.players[opp].bluff['value']
+        else:
+            # ここでプレビュー値を計算して保存（決定時に同じ値が出るよう固定）
+            choose_allowed = has_role(room, pid, 'Scholar') or room.players[pid].hint_choice_available
+            allow_choose_now = False
+            if has_role(room, pid, 'Scholar'):
+                # 学者は常に種類指定可能（未指定なら在庫からランダムに後で決定）
+                allow_choose_now = True
+            else:
+                allow_choose_now = bool(want_choose and choose_allowed and choose_type in ('和','差','積'))
+
+            # 実際の種類を決定（指定があればそれ、なければ在庫→無ければランダム）
+            stock = list(room.players[pid].available_hints)
+            if allow_choose_now and choose_type in ('和','差','積'):
+                htype = choose_type
+            else:
+                htype = random.choice(stock) if stock else random.choice(['和','差','積'])
+
+            # 値を計算してノイズ適用
+            opp = 2 if pid == 1 else 1
+            opp_secret = room.players[opp].secret
+            hidden = room.hidden
+            preview_shown = _apply_trickster_noise(room, pid, hint_value(htype, opp_secret, hidden))
+
+            # プレビュー保存（_hint_once 側で在庫消費＆ログ出力時に使用）
+            room.players[pid].hint_preview = {
+                'type': htype,
+                'shown': preview_shown,
+                'chose_by_user': allow_choose_now
+            }
+
+            shown = preview_shown
+        room.prompt = {'kind': 'bluff_decision', 'value': shown, 'choices': ['believe', 'accuse'],
+                       'bluff': has_bluff_flag, 'keep': keep}
+        return
+
+    if has_bluff_flag:
+        if decision == 'believe':
+            # プレイヤーはブラフを「信じる」→ このターンのヒントは
+            # ブラフの種類・値として扱い、在庫（available_hints）も消費する
+            fake = room.players[opp].bluff or {}
+            ftype = fake.get('type')
+            fval  = fake.get('value')
+            # 在庫から該当種類を消費（存在すれば）
+            stock = room.players[pid].available_hints
+            if ftype in stock:
+                stock.remove(ftype)
+
+            # ログ（ブラフ値として提示されたことを明示）
+            if ftype in ('和','差','積'):
+                push_event(room, 'hint_accept_typed', pid, HINT_TYPES.index(ftype), fval)
+            else:
+                # 種類が不明/異常でも値は表示（安全側）
+                push_event(room, 'hint_accept', pid, fval)
+
+            # ブラフは消費
+            room.players[opp].bluff = None
+
+            # ヒント受領扱い：常にCT1（学者は例外）。ペナルティ中なら長い方を採用
+            if not has_role(room, pid, 'Scholar'):
+                ct_len = 1
+                if room.players[pid].hint_penalty_active:
+                    ct_len = max(ct_len, room.players[pid].hint_penalty_len)
+                apply_ct(room, pid, 'hint_ct_until', ct_len)
+            switch_turn(room, pid)
+            return
+        else:
+            push_event(room, 'bluff_caught', pid)
+            _hint_once(room, pid, chose_by_user=False, silent=False, chosen_type=None)
+            _hint_once(room, pid, chose_by_user=False, silent=False, chosen_type=None)
+            room.players[opp].bluff = None
+            # 本物ヒント×2後：常にCT1（学者は例外）。ペナルティ中なら長い方を採用
+            if not has_role(room, pid, 'Scholar'):
+                ct_len = 1
+                if room.players[pid].hint_penalty_active:
+                    ct_len = max(ct_len, room.players[pid].hint_penalty_len)
+                apply_ct(room, pid, 'hint_ct_until', ct_len)
+            switch_turn(room, pid)
+            return
+    else:
+        if decision == 'accuse':
+            room.players[pid].hint_penalty_active = True
+            if has_role(room, opp, 'Trickster'):
+                room.players[pid].hint_penalty_len = 2
+                push_event(room, 'bluff_wrong', pid, 2)
+            else:
+                room.players[pid].hint_penalty_len = 1
+                push_event(room, 'bluff_wrong', pid, 1)
+            # 直後の処理：ヒント行動としてCTを付与し、ターンを進める（学者はCT無効）
+            if not has_role(room, pid, 'Scholar'):
+                ct_len = max(1, room.players[pid].hint_penalty_len)
+                apply_ct(room, pid, 'hint_ct_until', ct_len)
+            switch_turn(room, pid)
+            return
+            room.players[pid].hint_preview = None
+            # ブラフ指摘失敗でも、次の自分のヒントは最低CT1（学者以外）
+            if not has_role(room, pid, 'Scholar'):
+                ct_len = max(1, room.players[pid].hint_penalty_len)
+                apply_ct(room, pid, 'hint_ct_until', ct_len)
+            switch_turn(room, pid)
+            return
+        else:
+            allow_choose_now = (has_role(room, pid, 'Scholar') or (want_choose and room.players[pid].hint_choice_available)) and choose_type in ('和','差','積')
+            if allow_choose_now and not has_role(room, pid, 'Scholar'):
+                room.players[pid].hint_choice_available = False
+            _hint_once(room, pid, chose_by_user=allow_choose_now, silent=False, chosen_type=choose_type if allow_choose_now else None)
+            # ヒント取得後は常にCT1（学者は例外）。ペナルティ中なら長い方を採用
+            if not has_role(room, pid, 'Scholar'):
+                ct_len = 1
+                if room.players[pid].hint_penalty_active:
+                    ct_len = max(ct_len, room.players[pid].hint_penalty_len)
+                apply_ct(room, pid, 'hint_ct_until', ct_len)
+            switch_turn(room, pid)
+            return
+
+def handle_change(room, pid, new_secret):
+    if ct_left(room, pid, 'cooldown_until') > 0:
+        push_event(room, 'change_ct', pid)
+        switch_turn(room, pid)
+        return
+    my_traps = set(room.players[pid].trap_kill) | set(room.players[pid].trap_info)
+    if new_secret in my_traps:
+        push_event(room, 'change_on_trap', pid)
+        switch_turn(room, pid)
+        return
+    if not (room.eff_num_min <= new_secret <= room.eff_num_max):
+        push_event(room, 'change_out_of_range', pid)
+        switch_turn(room, pid)
+        return
+    limit = 3 if has_role(room, pid, 'Tuner') else 2
+    ct = 5 if has_role(room, pid, 'Tuner') else 7
+    if room.players[pid].change_used >= limit:
+        push_event(room, 'change_limit', pid, limit)
+        switch_turn(room, pid)
+        return
+
+    room.players[pid].secret = new_secret
+    start_ct(room, pid, 'cooldown_until', ct)
+    room.players[pid].change_used += 1
+
+    room.players[pid].decl1_value = None
+    room.players[pid].decl1_resolved = True
+    room.players[pid].decl1_used = False
+    room.players[pid].info_free_per_turn = 1
+    room.players[pid].info_max = INFO_MAX_DEFAULT
+    room.players[pid].info_free_used_this_turn = min(room.players[pid].info_free_used_this_turn, room.players[pid].info_free_per_turn)
+
+    opp = 2 if pid == 1 else 1
+    room.players[opp].available_hints = ['和','差','積']
+
+    push_event(room, 'change', pid, new_secret)
+    push_event(room, 'decl_reset', pid, INFO_MAX_DEFAULT)
+    switch_turn(room, pid)
+    return
+
+def handle_trap_kill(room, pid, form):
+    if not room.rules.get('trap', True):
+        return reject(room, pid, 'trap_disabled')
+    eff_min, eff_max = room.eff_num_min, room.eff_num_max
+    my_secret = room.players[pid].secret
+    v = form.get('trap_kill_value')
+    try:
+        x = int(v)
+    except Exception:
+        push_event(room, 'kill_invalid', pid)
+        switch_turn(room, pid)
+        return
+    if not (eff_min <= x <= eff_max) or x == my_secret or (room.allow_negative and abs(x) == abs(my_secret)):
+        push_event(room, 'kill_invalid', pid)
+        switch_turn(room, pid)
+        return
+    set_kill_trap(room, pid, x)
+    push_event(room, 'kill_set', pid, x)
+    switch_turn(room, pid)
+    return
+
+def handle_trap_info(room, pid, form):
+    if not room.rules.get('trap', True):
+        return reject(room, pid, 'trap_disabled')
+    eff_min, eff_max = room.eff_num_min, room.eff_num_max
+    my_secret = room.players[pid].secret
+
+    max_allowed = get_info_max(room, pid)
+    free_cap = room.players[pid].info_free_per_turn
+    free_used = room.players[pid].info_free_used_this_turn
+
+    bulk = form.get('info_bulk') in ('1', 'on', 'true', 'True')
+
+    if bulk:
+        candidates = ('trap_info_value', 'trap_info_value_1', 'trap_info_value_2', 'trap_info_val')
+        added_list = []
+        for key in candidates:
+            v = form.get(key)
+            if not v:
+                continue
+            try:
+                x = int(v)
+            except Exception:
+                continue
+            if not (eff_min <= x <= eff_max):
+                continue
+            if x == my_secret or (room.allow_negative and abs(x) == abs(my_secret)):
+                continue
+            if x in room.players[pid].trap_info or x in added_list:
+                continue
+            if len(room.players[pid].trap_info) >= max_allowed:
+                break
+            added_list.append(x)
+
+        if added_list:
+            add_info_traps(room, pid, added_list)
+            push_event(room, 'info_bulk', pid, *added_list)
+            switch_turn(room, pid)
+        else:
+            push_event(room, 'info_none', pid)
+        return
+
+    if free_used >= free_cap:
+        push_event(room, 'info_free_cap', pid, free_cap)
+        return
+
+    candidates = ('trap_info_value', 'trap_info_value_1', 'trap_info_value_2', 'trap_info_val')
+    added = None
+    for key in candidates:
+        v = form.get(key)
+        if not v:
+            continue
+        try:
+            x = int(v)
+        except Exception:
+            continue
+        if not (eff_min <= x <= eff_max):
+            continue
+        if x == my_secret or (room.allow_negative and abs(x) == abs(my_secret)):
+            continue
+        if x in room.players[pid].trap_info:
+            continue
+        if len(room.players[pid].trap_info) >= max_allowed:
+            push_event(room, 'info_max', pid, max_allowed)
+            return
+        added = x
+        break
+
+    if added is not None:
+        add_info_traps(room, pid, [added])
+        room.players[pid].info_free_used_this_turn += 1
+        left = max(0, free_cap - room.players[pid].info_free_used_this_turn)
+        push_event(room, 'info_set', pid, left, added)
+    else:
+        push_event(room, 'info_none', pid)
+    return
+
+def handle_trap(room, pid, form):
+    if not room.rules.get('trap', True):
+        return reject(room, pid, 'trap_disabled')
+
+    eff_min, eff_max = room.eff_num_min, room.eff_num_max
+    my_secret = room.players[pid].secret
+
+    turn_consumed = False
+
+    bulk = form.get('info_bulk') in ('1', 'on', 'true', 'True')
+    info_keys = ('trap_info_value', 'trap_info_value_1', 'trap_info_value_2', 'trap_info_val')
+    info_inputs = []
+    for k in info_keys:
+        v = form.get(k)
+        if v is None or v == '':
+            continue
+        try:
+            x = int(v)
+        except Exception:
+            continue
+        info_inputs.append(x)
+
+    info_inputs_unique = []
+    for x in info_inputs:
+        if x not in info_inputs_unique:
+            info_inputs_unique.append(x)
+
+    max_allowed = get_info_max(room, pid)
+    free_cap   = room.players[pid].info_free_per_turn
+    free_used  = room.players[pid].info_free_used_this_turn
+
+    if bulk and info_inputs_unique:
+        added_bulk = []
+        for x in info_inputs_unique:
+            if not (eff_min <= x <= eff_max):
+                continue
+            if x == my_secret or (room.allow_negative and abs(x) == abs(my_secret)):
+                continue
+            if x in room.players[pid].trap_info or x in added_bulk:
+                continue
+            if len(room.players[pid].trap_info) >= max_allowed:
+                break
+            added_bulk.append(x)
+        if added_bulk:
+            add_info_traps(room, pid, added_bulk)
+            push_event(room, 'info_bulk', pid, *added_bulk)
+            turn_consumed = True
+        else:
+            push_event(room, 'info_none', pid)
+
+    if (not bulk) and info_inputs_unique:
+        remain = max(0, free_cap - free_used)
+        added_free = []
+        for x in info_inputs_unique:
+            if remain <= 0:
+                break
+            if not (eff_min <= x <= eff_max):
+                continue
+            if x == my_secret or (room.allow_negative and abs(x) == abs(my_secret)):
+                continue
+            if x in room.players[pid].trap_info or x in added_free:
+                continue
+            if len(room.players[pid].trap_info) >= max_allowed:
+                break
+            add_info_traps(room, pid, [x])
+            added_free.append(x)
+            remain -= 1
+        if added_free:
+            room.players[pid].info_free_used_this_turn += len(added_free)
+            left = max(0, free_cap - room.players[pid].info_free_used_this_turn)
+            push_event(room, 'info_set', pid, left, *added_free)
+        else:
+            if free_cap - free_used <= 0:
+                push_event(room, 'info_free_cap', pid, free_cap)
+            else:
+                push_event(room, 'info_none', pid)
+
+    kill_v = form.get('trap_kill_value')
+    if kill_v is not None and kill_v != '':
+        try:
+            kx = int(kill_v)
+        except Exception:
+            kx = None
+        if kx is None or not (eff_min <= kx <= eff_max) or kx == my_secret or (room.allow_negative and abs(kx) == abs(my_secret)):
+            push_event(room, 'kill_invalid', pid)
+        else:
+            set_kill_trap(room, pid, kx)
+            push_event(room, 'kill_set', pid, kx)
+            turn_consumed = True
+
+    if turn_consumed:
+        switch_turn(room, pid)
+    return
+
+def handle_bluff(room, pid, form):
+    if not room.rules.get('bluff', True):
+        return reject(room, pid, 'bluff_disabled')
+    btype = form.get('bluff_type') or '和'
+    try:
+        bval = int(form.get('bluff_value'))
+        if abs(bval) > EVENT_ARG_MAX:
+            raise ValueError
+    except:
+        push_event(room, 'bluff_bad_value', pid)
+        switch_turn(room, pid)
+        return
+    room.players[pid].bluff = {'type': btype, 'value': bval}
+    push_event(room, 'bluff_set', pid)
+    switch_turn(room, pid)
+    return
+
+def handle_guessflag(room, pid):
+    if not room.rules.get('guessflag', True):
+        return reject(room, pid, 'guessflag_disabled')
+    if room.players[pid].guess_flag_used:
+        push_event(room, 'guessflag_used', pid)
+        switch_turn(room, pid)
+        return
+    room.players[pid].guess_flag_armed = True
+    room.players[pid].guess_flag_used = True
+    push_event(room, 'guessflag_set', pid)
+    switch_turn(room, pid)
+    return
+
+def handle_decl1(room, pid, form):
+    if not room.rules.get('decl1', True):
+        return reject(room, pid, 'decl_disabled')
+    if room.players[pid].decl1_used:
+        return reject(room, pid, 'decl_used')
+    d = get_int(form, 'decl1_digit', default=None, min_v=0, max_v=9)
+    if d is None:
+        return reject(room, pid, 'decl_bad_digit')
+    room.players[pid].decl1_value = d
+    room.players[pid].decl1_used = True
+    room.players[pid].decl1_resolved = False
+    room.players[pid].info_free_per_turn = 2
+    room.players[pid].info_max = 10
+    push_event(room, 'decl', pid, d)
+    opp = 2 if pid == 1 else 1
+    push_event(room, 'decl_notice', opp, d)
+    return
+
+def handle_decl1_challenge(room, pid):
+    if not room.rules.get('decl1', True):
+        return reject(room, pid, 'decl_disabled')
+
+    opp = 2 if pid == 1 else 1
+
+    # 相手が宣言していない／既に決着済みならチャレンジ不可
+    if room.players[opp].decl1_value is None or room.players[opp].decl1_resolved:
+        return reject(room, pid, 'decl_call_unavailable')
+
+    # 真値（一の位）と宣言値を比較
+    true_ones = abs(room.players[opp].secret) % 10
+    declared = room.players[opp].decl1_value
+
+    if declared != true_ones:
+        # 成功：正しい一の位を公開し、直後に無料予想権を付与（ターンは維持）
+        push_event(room, 'decl_call_ok', pid, true_ones)
+        room.players[opp].decl1_resolved = True
+        room.players[pid].free_guess_pending = True
+        return
+    else:
+        # 失敗：次ターンスキップ（番人なら1回だけ自動無効化）、ターン交代
+        push_event(room, 'decl_call_ng', pid)
+        room.players[opp].decl1_resolved = True
+        set_skip(room, pid)
+        switch_turn(room, pid)
+        return
+
+def handle_press(room, pid, press_val):
+    """サドン・プレス：ハズレ直後に同ターンでもう1回だけ予想。当たれば勝利、外せば次ターンスキップ。"""
+    if not room.rules.get('press', True):
+        return reject(room, pid, 'press_disabled')
+    if not room.players[pid].press_pending:
+        return reject(room, pid, 'press_unavailable')
+
+
+    # 今回のプレス消費
+    room.players[pid].press_pending = False
+    room.players[pid].press_used = True
+
+    # プレスでも通常の予想としてカウント
+    room.players[pid].tries += 1
+
+    # 成功：即勝利／トラップ（即死・info。近接は見ない。ゲスフラグは同ターンなので発動対象外）
+    if resolve_guess(room, pid, press_val, 'press') in ('hit', 'kill'):
+        return
+
+    # 失敗：必ず次ターンスキップ
+    push_event(room, 'press_miss', pid, press_val)
+    set_skip(room, pid)
+    switch_turn(room, pid)
+    return
+
+def handle_press_skip(room, pid):
+    """サドン・プレス権を放棄して通常のターン交代へ。"""
+    if not room.rules.get('press', True):
+        return reject(room, pid, 'press_disabled')
+    if not room.players[pid].press_pending:
+        return reject(room, pid, 'press_not_pending')
+
+    room.players[pid].press_pending = False
+    room.players[pid].press_used = True
+    push_event(room, 'press_pass', pid)
+    switch_turn(room, pid)
+    return
+
+def handle_free_guess(room, pid, val):
+    """嘘だ！成功後の無料予想。
+    - ターン消費なし（自分のターンのまま）
+    - ゲスフラグ無効
+    - kill/info/近接は有効
+    - CT/サドン・プレスは発生させない
+    """
+    opp = 2 if pid == 1 else 1
+
+    # 1回限りの無料予想フラグを消費
+    room.players[pid].free_guess_pending = False
+
+    # 正解：その場で勝利／トラップ（kill/info/近接）は有効。ゲスフラグは発動しない（チェック自体を行わない）
+    outcome = resolve_guess(room, pid, val, 'free')
+    if outcome in ('hit', 'kill'):
+        return
+
+    # 近接（次ターンスキップ付与）。ターンは切り替えない。
+    if outcome == 'near':
+        set_skip(room, pid)
+        push_event(room, 'free_near', pid, val, _kill_thresholds(room, opp)[1])
+        return
+
+    # 通常ハズレ：ターンは維持（CTやプレスも発生させない）
+    push_event(room, 'free_miss', pid, val)
+    return
+
+def handle_yn(room, pid, form):
+    """Yes/No 質問（ターン消費なし）。分析屋はラウンド3回まで、CT2。同一ターン連打不可。"""
+    if not room.rules.get('yn', True):
+        return reject(room, pid, 'yn_disabled')
+
+    opp = 2 if pid == 1 else 1
+    secret = room.players[opp].secret
+
+    # 使用回数・CT制御
+    cap = 3 if has_role(room, pid, 'Analyst') else 1
+    if room.players[pid].yn_used_count >= cap:
+        return reject(room, pid, 'yn_limit', cap)
+    if has_role(room, pid, 'Analyst'):
+        # 連打防止：同一ターンでの連投禁止
+        if room.players[pid].yn_last_tick == room.tick:
+            return reject(room, pid, 'yn_same_turn')
+        if ct_left(room, pid, 'yn_ct_until') > 0:
+            return reject(room, pid, 'yn_ct')
+
+    qtype = form.get('yn_type', 'ge')
+    x = get_int(form, 'yn_x', None, room.eff_num_min, room.eff_num_max)
+    a = get_int(form, 'yn_a', None, room.eff_num_min, room.eff_num_max)
+    b = get_int(form, 'yn_b', None, room.eff_num_min, room.eff_num_max)
+
+    # 質問評価
+    if qtype in ('ge', 'le', 'eq') and x is not None:
+        ans = yn_answer(qtype, secret, x)
+    elif qtype == 'between' and (a is not None and b is not None):
+        lo, hi = (a, b) if a <= b else (b, a)
+        ans = yn_answer(qtype, secret, lo=lo, hi=hi)
+    else:
+        return reject(room, pid, 'yn_bad_input')
+
+    if qtype == 'between':
+        push_event(room, 'yn', pid, YN_TYPES.index(qtype), int(ans), lo, hi)
+    else:
+        push_event(room, 'yn', pid, YN_TYPES.index(qtype), int(ans), x)
+
+    # 消費
+    room.players[pid].yn_used_count += 1
+    room.players[pid].yn_last_tick = room.tick
+    if has_role(room, pid, 'Analyst'):
+        start_ct(room, pid, 'yn_ct_until', 2)
+
+    # ターンは維持（消費なし）
+    return
+
+def _devotion_candidates(room, pid):
+    """献身の候補ロールを2つ返す（自分の main/extra と重複しないように）。"""
+    owned = {room.players[pid].role_main, room.players[pid].role_extra}
+    pool = [k for k in ROLES.keys() if k not in owned]
+    if len(pool) >= 2:
+        c1 = random.choice(pool); pool.remove(c1)
+        c2 = random.choice(pool)
+        return [c1, c2]
+    # 足りない場合は重複を許すが、極力1個は別種を返す
+    if len(pool) == 1:
+        return [pool[0], pool[0]]
+    # すべて埋まっている（理論上起きにくい）：とりあえず任意2種
+    keys = list(ROLES.keys())
+    return random.sample(keys, 2)
+
+def handle_devotion_offer(room, pid):
+    """献身：候補を2つ提示。決定は handle_devotion_pick へ。"""
+    if not (room.rules.get('devotion', True) and room.rules.get('roles', True)):
+        return reject(room, pid, 'devotion_disabled')
+    if room.players[pid].devotion_used:
+        return reject(room, pid, 'devotion_used')
+
+    # 候補生成＆保存
+    cand = _devotion_candidates(room, pid)
+    room.players[pid].devotion_offers = cand
+
+    room.prompt = {'kind': 'devotion_pick', 'choices': cand}
+
+def handle_devotion_pick(room, pid, pick):
+    # 献身：候補2から1つ取得し、代償を適用（今ターン終了／g&hにCT1／info上限-2）
+    if not (room.rules.get('devotion', True) and room.rules.get('roles', True)):
+        return reject(room, pid, 'devotion_disabled')
+
+    offers = room.players[pid].devotion_offers
+    if not offers or pick not in offers:
+        return reject(room, pid, 'devotion_bad_pick')
+
+    # 取得
+    room.players[pid].role_extra = pick
+    refresh_trap_outcome(room, pid)  # 罠師ならしきい値が変わる
+    room.players[pid].devotion_offers = None
+    room.players[pid].devotion_used = True
+    push_event(room, 'devotion_gain', pid, ROLE_KEYS.index(pick))
+
+    # 代償：g/h の CT を最低1に引き上げ、info 上限 -2（get_info_max で反映）
+    room.players[pid].guess_penalty_active = True
+    room.players[pid].hint_penalty_active = True
+    room.players[pid].hint_penalty_len = max(room.players[pid].hint_penalty_len, 1)
+    room.players[pid].devotion_info_penalty = 2
+    push_event(room, 'devotion_cost', pid)
+
+    # 今ターン終了
+    switch_turn(room, pid)
+    return
+
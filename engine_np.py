@@ -0,0 +1,59 @@
+# engine_np.py
+# engine.py の判定（ヒント値・Yes/No の答え・トラップ判定）を NumPy でまとめて計算するカーネル。
+# 1要素 = 1局ぶんの (secret, hidden, guess, trap…) で、数千〜数百万局を1回の呼び出しで評価する。
+# 結果は engine.hint_value / yn_answer / trap_flags / resolve_guess と要素ごとに完全一致する
+# （tools/bench_engine_np.py が突き合わせと速度比較を行う）。
+# NumPy は任意依存（Web サーバは使わない）。無い環境では import 時に ImportError になる。
+import numpy as np
+
+import engine as E
+
+NO_TRAP = 1 << 40          # トラップ未設置の埋め値（どの予想とも閾値内にならない距離）
+GUESS_OUTCOMES = ('hit', 'kill', 'near', 'miss')   # resolve_guess の戻り値と同じ並び
+
+def _i64(a):
+    return np.asarray(a, dtype=np.int64)
+
+def hint_values(htype, secret, hidden, noise=None):
+    """htype は HINT_TYPES の添字（0=和, 1=差, 2=積）。noise は詐欺師の ±1（無ければ 0）"""
+    htype, secret, hidden = _i64(htype), _i64(secret), _i64(hidden)
+    val = np.where(htype == 0, secret + hidden,
+                   np.where(htype == 1, np.abs(secret - hidden), secret * hidden))
+    return val if noise is None else val + _i64(noise)
+
+def yn_answers(qtype, secret, x=None, lo=None, hi=None):
+    """qtype は YN_TYPES の添字（0=ge, 1=le, 2=eq, 3=between）。between は lo <= hi に並べて渡す"""
+    qtype, secret = _i64(qtype), _i64(secret)
+    x = secret if x is None else _i64(x)
+    lo = secret if lo is None else _i64(lo)
+    hi = secret if hi is None else _i64(hi)
+    return np.select([qtype == 0, qtype == 1, qtype == 2],
+                     [secret >= x, secret <= x, secret == x],
+                     (lo <= secret) & (secret <= hi))
+
+def kill_thresholds(trapper):
+    """罠師なら KILL_THRESHOLDS_TRAPPER、それ以外は KILL_THRESHOLDS を (inst_t, near_t) の配列で返す"""
+    trapper = np.asarray(trapper, dtype=bool)
+    inst_t = np.where(trapper, E.KILL_THRESHOLDS_TRAPPER[0], E.KILL_THRESHOLDS[0])
+    near_t = np.where(trapper, E.KILL_THRESHOLDS_TRAPPER[1], E.KILL_THRESHOLDS[1])
+    return inst_t, near_t
+
+def trap_flags(guess, kill, info, inst_t, near_t):
+    """guess:(N,)、kill:(N,) か (N,K)、info:(N,M)。未設置の枠は NO_TRAP で埋める。
+    閾値はスカラーか (N,)。OUT_KILL / OUT_NEAR / OUT_INFO を立てた (N,) を返す"""
+    guess = _i64(guess)
+    kill = _i64(kill)
+    if kill.ndim == 1:
+        kill = kill[:, None]
+    d = np.abs(kill - guess[:, None]).min(axis=1) if kill.shape[1] else np.full(guess.shape, NO_TRAP)
+    f = np.where(d <= inst_t, E.OUT_KILL, 0) | np.where(d <= near_t, E.OUT_NEAR, 0)
+    info = _i64(info)
+    if info.ndim == 2 and info.shape[1]:
+        f |= np.where((info == guess[:, None]).any(axis=1), E.OUT_INFO, 0)
+    return f.astype(np.uint8)
+
+def guess_outcomes(guess, secret, flags):
+    """GUESS_OUTCOMES の添字（resolve_guess と同じく 正解 → 即死 → 近接 → ハズレ の順に判定）"""
+    guess, secret, flags = _i64(guess), _i64(secret), _i64(flags)
+    return np.select([guess == secret, (flags & E.OUT_KILL) != 0, (flags & E.OUT_NEAR) != 0],
+                     [0, 1, 2], 3).astype(np.uint8)
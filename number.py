@@ -1,6 +1,12 @@
 # number.py
-from flask import Flask, request, redirect, url_for, render_template_string, session, abort, jsonify, Response
-import random, string, os
+from flask import Flask, request, redirect, url_for, session, abort, jsonify, Response, g, has_request_context
+from werkzeug.datastructures import MultiDict
+import random, string, os, json, time, threading, hashlib, html, functools, bisect
+import itertools, copy, pickle, sqlite3, collections
+from engine import (NUM_MIN, NUM_MAX, HIDDEN_MIN, HIDDEN_MAX, ROLES, role_label, role_desc,
+                    get_info_max, get_int, Room, PlayerState, init_room, EVENTS, EV, LOG_MEM_CAP,
+                    push_event, log_visible, rewind_log_view, has_role, bump_serial, start_new_round,
+                    ct_left, resolve_pending_skip, apply, LogDiscarded)
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY", "imigawakaranai")
@@ -9,49 +15,294 @@ app.config.update(
     SESSION_COOKIE_SECURE=False
 )
 # ====== 定数 ======
-NUM_MIN = 1
-NUM_MAX = 50
-HIDDEN_MIN = 1
-HIDDEN_MAX = 30
-INFO_MAX_DEFAULT = 7
-
-RULE_DEFAULTS = {
-    'trap': True,
-    'bluff': True,
-    'guessflag': True,
-    'decl1': True,
-    'press': True,
-    'roles': True,
-    'yn': True,
-    'devotion': True,
-}
-
-ROLES = {
-    'Scholar':  '学者',
-    'Guardian': '番人',
-    'Trapper':  '罠師',
-    'Disarmer': '解除士',
-    'Trickster':'詐欺師',
-    'Analyst':  '分析屋',
-    'Tuner':    '調律士',
+# ルール・状態・行動ログの定義は engine.py
+
+# SSE（/events）：1接続あたりの最大保持秒数・心拍間隔
+SSE_MAX_SECONDS = int(os.environ.get("SSE_MAX_SECONDS", "55"))
+SSE_HEARTBEAT_SECONDS = 15
+# ロングポーリング（/poll?since=）の最大待機秒数
+LONGPOLL_TIMEOUT = float(os.environ.get("LONGPOLL_TIMEOUT", "25"))
+# 待機型の接続（SSE・ロングポーリング）は gthread のスレッドを1本ずつ握ったままにするので、
+# 1ワーカーで同時に待てるのは STREAM_MAX 本（対戦画面 STREAM_MAX 枚）まで。Procfile の
+# --threads 64 の残りは通常のページ表示・POST 用に空けておく。上限を超えた接続は待たずに返し
+# （/events は 503、/poll は retry 付きの現状態）、クライアントは SHORT_POLL_MS ごとの短い
+# ポーリングに落ちる。--threads を変える時は STREAM_MAX もそれより十分小さくすること。
+STREAM_MAX = int(os.environ.get("STREAM_MAX", "32"))
+SHORT_POLL_MS = 1200
+_stream_slots = threading.BoundedSemaphore(STREAM_MAX) if STREAM_MAX > 0 else None
+
+def take_stream_slot():
+    return _stream_slots is not None and _stream_slots.acquire(blocking=False)
+
+def release_stream_slot():
+    _stream_slots.release()
+
+# ====== ルームストア ======
+# 既定はプロセス内 dict（gunicorn は1ワーカー。ワーカーごとに別のルーム表になるので -w は上げない）。
+# ROOM_STORE=sqlite:///path/to/rooms.db で SQLite（WAL）に置き、複数ワーカーで共有する
+# （その時だけ Procfile の -w を上げる）。共有時はリクエストの頭でルームを読み込み、
+# 終わりに rev（保存ごとに+1）が読んだ時のままなら書き戻す（楽観ロック）。ずれていれば
+# そのリクエストを読み直してやり直す。/poll・/events は snap 列（turn_serial 等）だけを読む。
+ROOM_COMMIT_RETRIES = 5
+ROOM_STORE_POLL_SECONDS = float(os.environ.get("ROOM_STORE_POLL_SECONDS", "0.25"))
+
+def room_phase_key(phase, winner):
+    """TTL の区分：lobby / play / ended（勝敗が付いて次ラウンド待ち）"""
+    return 'ended' if winner is not None else ('lobby' if phase == 'lobby' else 'play')
+
+class DictRoomStore(collections.OrderedDict):
+    """プロセス内 dict。並び順＝最終アクセス順（commit のたびに末尾へ）。begin/commit は素通し"""
+    shared = False
+
+    def begin(self, rid):
+        return self.get(rid)
+
+    def commit(self, room):
+        room.last_active = time.time()
+        with rooms_lock:
+            if self.get(room.id) is room:
+                self.move_to_end(room.id)
+        return True
+
+    def snapshot(self, rid):
+        room = self.get(rid)
+        if room is None:
+            return None
+        return room.poll_snap or {}
+
+    def activity(self):
+        """(番号, 最終アクセス時刻, TTL区分) の一覧"""
+        return [(rid, room.last_active, room_phase_key(room.phase, room.winner))
+                for rid, room in list(self.items())]
+
+    def lru_ids(self, n):
+        with rooms_lock:
+            return list(itertools.islice(self.keys(), max(0, n)))
+
+class SQLiteRoomStore:
+    """rooms(id, rev, serial, snap(JSON), data(pickle)) の1テーブル。接続はスレッドごと"""
+    shared = True
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        with self._conn() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS rooms (id TEXT PRIMARY KEY, rev INTEGER NOT NULL,"
+                       " serial INTEGER NOT NULL, snap TEXT, data BLOB NOT NULL, updated REAL NOT NULL)")
+
+    def _conn(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return db
+
+    def _cache(self):
+        # 同じリクエスト内では同じ dict を返す（room_or_404 を何度呼んでも書き戻し対象は1つ）
+        if not has_request_context():
+            return {}
+        if 'room_cache' not in g:
+            g.room_cache = {}
+        return g.room_cache
+
+    def _blobs(self):
+        # 読み込んだ時の data 列（commit で変化の有無を比べる）
+        if not has_request_context():
+            return {}
+        if 'room_blobs' not in g:
+            g.room_blobs = {}
+        return g.room_blobs
+
+    @staticmethod
+    def _dump(room):
+        # rev は列で持つので data には入れない（読み直しただけのルームが同じバイト列になるように）
+        rev, room._rev = room._rev, None
+        try:
+            return pickle.dumps(room, pickle.HIGHEST_PROTOCOL)
+        finally:
+            room._rev = rev
+
+    def _load(self, rid):
+        row = self._conn().execute("SELECT rev, data FROM rooms WHERE id=?", (rid,)).fetchone()
+        if row is None:
+            return None
+        room = pickle.loads(row[1])
+        room._rev = row[0]
+        self._blobs()[rid] = row[1]
+        return room
+
+    def get(self, rid, default=None):
+        cache = self._cache()
+        if rid not in cache:
+            cache[rid] = self._load(rid)
+        room = cache[rid]
+        return default if room is None else room
+
+    def begin(self, rid):
+        self._cache().pop(rid, None)
+        return self.get(rid)
+
+    def __getitem__(self, rid):
+        room = self.get(rid)
+        if room is None:
+            raise KeyError(rid)
+        return room
+
+    def __contains__(self, rid):
+        return self._conn().execute("SELECT 1 FROM rooms WHERE id=?", (rid,)).fetchone() is not None
+
+    def _row(self, room, data):
+        snap = room.poll_snap
+        return (room.turn_serial, json.dumps(snap) if snap else None, data, time.time())
+
+    def setdefault(self, rid, room):
+        room._rev = 1
+        data = self._dump(room)
+        cur = self._conn().execute(
+            "INSERT OR IGNORE INTO rooms (id, rev, serial, snap, data, updated) VALUES (?, 1, ?, ?, ?, ?)",
+            (rid,) + self._row(room, data))
+        if cur.rowcount == 1:
+            self._cache()[rid] = room
+            self._blobs()[rid] = data
+            return room
+        return self.begin(rid)
+
+    def __setitem__(self, rid, room):
+        self._conn().execute("DELETE FROM rooms WHERE id=?", (rid,))
+        self.setdefault(rid, room)
+
+    def __delitem__(self, rid):
+        room = self.get(rid)
+        if self._conn().execute("DELETE FROM rooms WHERE id=?", (rid,)).rowcount == 0:
+            raise KeyError(rid)
+        if room is not None:
+            room._rev = None  # commit() は削除済みとして成功扱い
+        self._cache()[rid] = None
+
+    def pop(self, rid, default=None):
+        try:
+            room = self[rid]
+            del self[rid]
+            return room
+        except KeyError:
+            return default
+
+    def commit(self, room):
+        """書き戻す。読んだ時から変わっていなければ rev は上げず最終アクセスだけ更新する
+        （閲覧だけのリクエスト同士が rev 競合でやり直しにならないように）。
+        変更ありで rev がずれていれば False"""
+        rev = room._rev
+        if rev is None:
+            return True
+        data = self._dump(room)
+        if data == self._blobs().get(room.id):
+            self._conn().execute("UPDATE rooms SET updated=? WHERE id=?", (time.time(), room.id))
+            return True
+        cur = self._conn().execute(
+            "UPDATE rooms SET rev=rev+1, serial=?, snap=?, data=?, updated=? WHERE id=? AND rev=?",
+            self._row(room, data) + (room.id, rev))
+        if cur.rowcount != 1:
+            return False
+        room._rev = rev + 1
+        self._blobs()[room.id] = data
+        return True
+
+    def snapshot(self, rid):
+        row = self._conn().execute("SELECT snap FROM rooms WHERE id=?", (rid,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]) if row[0] else {}
+
+    def activity(self):
+        out = []
+        for rid, updated, snap in self._conn().execute("SELECT id, updated, snap FROM rooms"):
+            snap = json.loads(snap) if snap else {}
+            out.append((rid, updated, room_phase_key(snap.get('phase'), snap.get('winner'))))
+        return out
+
+    def lru_ids(self, n):
+        return [r[0] for r in self._conn().execute(
+            "SELECT id FROM rooms ORDER BY updated LIMIT ?", (max(0, n),))]
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM rooms").fetchone()[0]
+
+    def __iter__(self):
+        return iter([r[0] for r in self._conn().execute("SELECT id FROM rooms")])
+
+def open_room_store(url):
+    if url and url.startswith("sqlite:///"):
+        return SQLiteRoomStore(url[len("sqlite:///"):])
+    return DictRoomStore()
+
+rooms = open_room_store(os.environ.get("ROOM_STORE"))
+# ルームごとの状態変化通知（/poll?since= と /events が待機する）
+room_conds = {}
+# ルームごとの書き込みロック（状態遷移はすべてこの中で行う）。rooms への追加・削除は rooms_lock
+room_locks = {}
+rooms_lock = threading.Lock()
+
+# ====== 放置ルームの掃除 ======
+# 最終アクセス（ルームロック付きリクエストの終わり）から区分ごとの TTL を過ぎたルームを
+# ROOM_SWEEP_SECONDS ごとにバックグラウンドで消す。ROOM_MAX を超えたら最終アクセスの古い順に消す。
+# 消した数は区分別に room_evictions に数え、/debug/rooms で見られる。
+ROOM_TTL = {
+    'lobby': float(os.environ.get("ROOM_TTL_LOBBY", "1800")),
+    'play': float(os.environ.get("ROOM_TTL_PLAY", "7200")),
+    'ended': float(os.environ.get("ROOM_TTL_ENDED", "900")),
 }
+ROOM_SWEEP_SECONDS = float(os.environ.get("ROOM_SWEEP_SECONDS", "60"))
+ROOM_MAX = int(os.environ.get("ROOM_MAX", "5000"))
+room_evictions = collections.Counter()
+
+def evict_room(rid, reason):
+    """ルームを消す。リクエスト処理中（ロック中）のルームは触らない。
+    ルームロックは無ければ作ってから取り、room_locks から外すのもロックを持っている間だけ
+    （外されたロックを待っていたリクエストは with_room_lock が読み直す）"""
+    with rooms_lock:
+        lock = room_locks.setdefault(rid, threading.RLock())
+    if not lock.acquire(blocking=False):
+        return False
+    try:
+        with rooms_lock:
+            room = rooms.pop(rid, None)
+            if room is not None:
+                room_evictions[reason] += 1
+        if room is not None:
+            room_ids.release(rid)
+            room.actions.discard()
+            notify_room(room, force=True)
+            room_conds.pop(rid, None)
+        if room_locks.get(rid) is lock:
+            del room_locks[rid]
+    finally:
+        lock.release()
+    return room is not None
+
+def sweep_rooms(now=None):
+    now = time.time() if now is None else now
+    evicted = 0
+    for rid, last, phase in rooms.activity():
+        if now - last > ROOM_TTL[phase]:
+            evicted += evict_room(rid, 'ttl_' + phase)
+    excess = len(rooms) - ROOM_MAX
+    if excess > 0:
+        for rid in rooms.lru_ids(excess):
+            evicted += evict_room(rid, 'lru')
+    return evicted
+
+def _room_sweeper():
+    while True:
+        time.sleep(ROOM_SWEEP_SECONDS)
+        try:
+            sweep_rooms()
+        except Exception:
+            app.logger.exception("ルーム掃除中の例外")
 
-def role_label(code):
-    return ROLES.get(code, '—')
-
-def role_desc(code):
-    desc = {
-        'Scholar':  'ラウンド中ずっとヒント種類指定可＆ヒントCT無効。',
-        'Guardian': '自分の「次ターンスキップ」を1度だけ自動無効化（このラウンド）。',
-        'Trapper':  'info最大 +3。さらに自分のkillは±2即死／±6スキップに強化。',
-        'Disarmer': '自分のターン開始時、2ターンに1回 相手のinfoをランダム解除（CD2）。',
-        'Trickster':'相手がブラフ指摘に失敗するとヒントCT2。さらに相手が得た本物ヒント表示に±1ノイズ。',
-        'Analyst':  'Yes/No質問がクールタイム2、ラウンド3回まで（同一ターン連打は不可）。',
-        'Tuner':    '自分の数の変更がCT5、ラウンド最大3回まで使用可能。',
-    }
-    return desc.get(code, '—')
-
-rooms = {}
+if ROOM_SWEEP_SECONDS > 0:
+    threading.Thread(target=_room_sweeper, name='room-sweeper', daemon=True).start()
 
 # ====== ちょい演出ヘルパ ======
 def fx_markup(key, shout=None):
@@ -60,30 +311,177 @@ def fx_markup(key, shout=None):
         attr += f" data-shout='{shout}'"
     return f"<span class='fx'{attr}></span>"
 
-# 画像アセット（拡張子の実在確認付き）
+# ====== アセットマニフェスト ======
+# static/img・static/img/fx・static/sfx を起動時に走査して key → URL / サイズ / 内容ハッシュ を保持する。
+# static/img/fx/<key>-<幅>.<avif|webp|png> は tools/build_fx_images.py が作る縮小版（srcset 候補）。
+# リクエスト毎のファイル存在確認は行わず、ASSET_RECHECK_SECONDS ごとにディレクトリの
+# 中身（名前・サイズ・mtime）を見て変化があれば作り直す。/debug/assets/reload で強制再構築。
+FX_IMG_KEYS = {
+    'bluff_success': 'ブラフ/嘘だ 成功（黒・スリム）',
+    'bluff_fail':    'ブラフ/嘘だ 失敗（茶・ぽっちゃり）',
+    'round_win':     'ラウンド勝利（カラフル）',
+    'round_lose':    'ラウンド敗北（白黒）',
+}
+FX_IMG_EXTS = ('png', 'jpg', 'jpeg', 'PNG', 'JPG', 'JPEG')
+FX_VARIANT_TYPES = {'avif': 'image/avif', 'webp': 'image/webp', 'png': 'image/png'}
+SFX_FILES = {
+    'guess_hit':   'hit.mp3',
+    'kill_dead':   'dead.mp3',
+    'kill_near':   'near.mp3',
+    'info':        'info.mp3',
+    'bluff_ok':    'bluff_ok.mp3',
+    'bluff_ng':    'bluff_ng.mp3',
+    'flag_boom':   'boom.mp3',
+    'press_ready': 'press_ready.mp3',
+    'press_miss':  'press_miss.mp3',
+    'decl':        'decl.mp3',
+    'win':         'win.mp3',
+    'ping':        'ping.mp3',
+    'change':      'change.mp3',
+}
+ASSET_DIRS = ('img', 'img/fx', 'sfx')
+ASSET_RECHECK_SECONDS = float(os.environ.get("ASSET_RECHECK_SECONDS", "5"))
+# ?v=<内容ハッシュ> 付きURL（フィンガープリント済み）に付けるキャッシュ期間
+ASSET_IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# ?v= に載せる内容ハッシュの桁数（この桁数ちょうどで一致した時だけ immutable）
+FINGERPRINT_LEN = 12
+
+_asset_manifest = None
+_asset_checked_at = 0.0
+_asset_hash_cache = {}  # (path, size, mtime_ns) -> sha256 hex
+_asset_lock = threading.Lock()
+
+def _asset_dir_sig():
+    sig = []
+    for d in ASSET_DIRS:
+        try:
+            with os.scandir(os.path.join(app.static_folder, d)) as it:
+                for e in it:
+                    st = e.stat()
+                    sig.append((d, e.name, st.st_size, st.st_mtime_ns))
+        except OSError:
+            continue
+    return tuple(sorted(sig))
+
+def _asset_entry(rel):
+    path = os.path.join(app.static_folder, rel)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    ck = (path, st.st_size, st.st_mtime_ns)
+    digest = _asset_hash_cache.get(ck)
+    if digest is None:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        digest = _asset_hash_cache[ck] = h.hexdigest()
+    return {
+        'file': rel,
+        'size': st.st_size,
+        'hash': digest,
+        'url': f"{app.static_url_path}/{rel}?v={digest[:FINGERPRINT_LEN]}",
+    }
+
+def _fx_variant_entries(key, names):
+    entries = []
+    prefix = key + '-'
+    for name in names:
+        stem, _, ext = name.rpartition('.')
+        width = stem[len(prefix):]
+        if not stem.startswith(prefix) or not width.isdigit() or ext not in FX_VARIANT_TYPES:
+            continue
+        e = _asset_entry(f"img/fx/{name}")
+        if e:
+            e['width'] = int(width)
+            e['type'] = FX_VARIANT_TYPES[ext]
+            entries.append(e)
+    entries.sort(key=lambda e: e['width'])
+    return entries
+
+def build_asset_manifest():
+    global _asset_manifest, _asset_checked_at
+    with _asset_lock:
+        try:
+            variant_names = sorted(os.listdir(os.path.join(app.static_folder, 'img', 'fx')))
+        except OSError:
+            variant_names = []
+        img = {}
+        variants = {}
+        for key in FX_IMG_KEYS:
+            entries = []
+            for ext in FX_IMG_EXTS:
+                e = _asset_entry(f"img/{key}.{ext}")
+                if e:
+                    entries.append(e)
+            img[key] = entries
+            variants[key] = _fx_variant_entries(key, variant_names)
+        sfx = {}
+        for key, fname in SFX_FILES.items():
+            e = _asset_entry(f"sfx/{fname}")
+            if e:
+                sfx[key] = e
+        by_file = {}
+        for e in [*sfx.values(), *(e for v in img.values() for e in v), *(e for v in variants.values() for e in v)]:
+            by_file[e['file']] = e['hash']
+        _asset_manifest = {'sig': _asset_dir_sig(), 'img': img, 'variants': variants, 'sfx': sfx,
+                           'by_file': by_file, 'shell': None}
+        _asset_checked_at = time.monotonic()
+        return _asset_manifest
+
+def asset_manifest():
+    global _asset_checked_at
+    m = _asset_manifest
+    if m is None:
+        return build_asset_manifest()
+    now = time.monotonic()
+    if now - _asset_checked_at >= ASSET_RECHECK_SECONDS:
+        _asset_checked_at = now
+        if _asset_dir_sig() != m['sig']:
+            return build_asset_manifest()
+    return m
+
+build_asset_manifest()  # 起動時に一度構築
+
+# 画像アセット（実在するファイルのみ。無ければプレースホルダ）
 def fx_img_urls(key: str):
-    base = os.path.join(app.root_path, 'static', 'img')
-    urls = []
-    # 実在する拡張子のみ列挙
-    for ext in ('png', 'jpg', 'jpeg', 'PNG', 'JPG', 'JPEG'):
-        p = os.path.join(base, f"{key}.{ext}")
-        if os.path.exists(p):
-            urls.append(url_for('static', filename=f"img/{key}.{ext}"))
+    urls = [e['url'] for e in asset_manifest()['img'].get(key, [])]
     # 1つも見つからなければプレースホルダ（SVG）を最後の候補として返す
     if not urls:
-        urls.append(url_for('fx_placeholder', key=key))
+        urls.append(url_for('fx_placeholder', key=key, v=_placeholder_svg(key)[1]))
     return urls
 
-# プレースホルダ画像（SVG）を返すルート
-@app.get('/fx_placeholder/<key>')
-def fx_placeholder(key):
+# showFxImage 用：縮小版の <source>（形式ごとの srcset）＋元画像URL（フォールバック）
+def fx_img_spec(key: str):
+    by_type = {}
+    for e in asset_manifest()['variants'].get(key, []):
+        by_type.setdefault(e['type'], []).append(f"{e['url']} {e['width']}w")
+    sources = [{'type': t, 'srcset': ', '.join(by_type[t])}
+               for t in FX_VARIANT_TYPES.values() if t in by_type]
+    return {'sources': sources, 'urls': fx_img_urls(key)}
+
+# ページ外枠で使う FX 画像と SFX 表（マニフェスト再構築までは使い回す）
+def fx_shell_assets():
+    m = asset_manifest()
+    if m['shell'] is None:
+        m['shell'] = {
+            'img': {k: fx_img_spec(k) for k in FX_IMG_KEYS},
+            'sfx': {k: e['url'] for k, e in m['sfx'].items()},
+        }
+    return m['shell']
+
+# プレースホルダ画像（SVG）。キーごとに一度だけ組み立てて ETag と一緒に保持する
+@functools.lru_cache(maxsize=64)
+def _placeholder_svg(key):
     label_map = {
         'bluff_success': 'Bluff/嘘だ 成功',
         'bluff_fail':    'Bluff/嘘だ 失敗',
         'round_win':     'ラウンド勝利',
         'round_lose':    'ラウンド敗北',
     }
-    label = label_map.get(key, key)
+    label = html.escape(label_map.get(key, key))
+    key = html.escape(key)
     svg = f"""<?xml version="1.0" encoding="UTF-8"?>
     <svg xmlns="http://www.w3.org/2000/svg" width="640" height="640" viewBox="0 0 640 640">
       <defs>
@@ -100,59 +498,165 @@ def fx_placeholder(key):
         <text x="320" y="448" font-size="20" fill="#fde68a">{key}.(png|jpg|jpeg)</text>
       </g>
     </svg>"""
-    return Response(svg, mimetype='image/svg+xml')
-
-# ====== ユーティリティ ======
-def get_info_max(room, pid):
-    base = room.get('info_max', {}).get(pid, INFO_MAX_DEFAULT)
-    extra = 0
-    if has_role(room, pid, 'Trapper'):
-        extra += 3
-    extra -= room.get('devotion_info_penalty', {}).get(pid, 0)
-    return max(1, min(base + extra, 13))
-
-def get_int(form, key, default=None, min_v=None, max_v=None):
-    v = form.get(key)
-    if v is None or v == '':
-        return default
-    try:
-        x = int(v)
-    except Exception:
-        return default
-    if min_v is not None and x < min_v:
-        return default
-    if max_v is not None and x > max_v:
-        return default
-    return x
-
-def push_and_back(room, pid, msg, to_play=True):
-    if msg:
-        push_log(room, msg)
-    rid = get_current_room_id()
-    if to_play:
-        return redirect(url_for('play', room_id=rid) + (f"?as={pid}" if pid in (1,2) else ""))
+    return svg, hashlib.sha256(svg.encode('utf-8')).hexdigest()[:FINGERPRINT_LEN]
+
+@app.get('/fx_placeholder/<key>')
+def fx_placeholder(key):
+    svg, etag = _placeholder_svg(key)
+    resp = Response(svg, mimetype='image/svg+xml')
+    resp.set_etag(etag)
+    if request.args.get('v') == etag:
+        _set_immutable(resp)
     else:
-        return redirect(url_for('room_lobby', room_id=rid) + (f"?as={pid}" if pid in (1,2) else ""))
+        resp.cache_control.public = True
+        resp.cache_control.no_cache = True
+    return resp.make_conditional(request)
+
+def _set_immutable(resp):
+    resp.cache_control.no_cache = None
+    resp.cache_control.public = True
+    resp.cache_control.max_age = ASSET_IMMUTABLE_MAX_AGE
+    resp.cache_control.immutable = True
+
+@app.after_request
+def static_cache_headers(resp):
+    """内容ハッシュ一致の ?v= 付き静的ファイルは immutable で長期キャッシュさせる"""
+    if request.endpoint == 'static' and resp.status_code in (200, 304):
+        v = request.args.get('v')
+        digest = asset_manifest()['by_file'].get((request.view_args or {}).get('filename'))
+        if v and digest and v == digest[:FINGERPRINT_LEN]:
+            _set_immutable(resp)
+    return resp
+
+# ====== ルーム番号 ======
+# 番号は ROOM_ID_ALPHABET の文字で書いた ROOM_ID_LENGTH 桁の固定長（既定は数字4桁）。
+# 番号 ⇔ 0..(文字数^桁数 - 1) の整数を対応させ、整数 % SHARD_COUNT == SHARD_INDEX の番号だけを
+# このプロセスが払い出す（router.py のシャーディングモード。既定は1シャード）。
+ROOM_ID_LENGTH = max(1, int(os.environ.get("ROOM_ID_LENGTH", "4")))
+ROOM_ID_ALPHABET = os.environ.get("ROOM_ID_ALPHABET") or string.digits
+ROOM_ID_SPACE = len(ROOM_ID_ALPHABET) ** ROOM_ID_LENGTH
+_ROOM_ID_DIGIT = {ch: i for i, ch in enumerate(ROOM_ID_ALPHABET)}
+SHARD_COUNT = max(1, int(os.environ.get("SHARD_COUNT", "1")))
+SHARD_INDEX = int(os.environ.get("SHARD_INDEX", "0")) % SHARD_COUNT
+
+def encode_room_id(n):
+    base = len(ROOM_ID_ALPHABET)
+    out = []
+    for _ in range(ROOM_ID_LENGTH):
+        n, d = divmod(n, base)
+        out.append(ROOM_ID_ALPHABET[d])
+    return ''.join(reversed(out))
+
+def decode_room_id(rid):
+    """番号 → 整数（形式が違えば None）"""
+    if len(rid) != ROOM_ID_LENGTH:
+        return None
+    n = 0
+    for ch in rid:
+        d = _ROOM_ID_DIGIT.get(ch)
+        if d is None:
+            return None
+        n = n * len(ROOM_ID_ALPHABET) + d
+    return n
+
+def normalize_room_id(rid):
+    rid = rid.strip()
+    # 英字が大文字だけの文字種なら小文字入力も受け付ける
+    return rid.upper() if ROOM_ID_ALPHABET.upper() == ROOM_ID_ALPHABET else rid
+
+def room_shard(rid, count=SHARD_COUNT):
+    """ルーム番号 → 担当シャード（形式が違えば None）"""
+    n = decode_room_id(rid)
+    return None if n is None else n % count
+
+# 参加フォームの入力欄（数字だけならテンキー・桁数チェック）
+if ROOM_ID_ALPHABET == string.digits:
+    ROOM_ID_INPUT_ATTRS = (f'inputmode="numeric" pattern="\\d{{{ROOM_ID_LENGTH}}}" '
+                           f'placeholder="{encode_room_id(1234 % ROOM_ID_SPACE)}"')
+else:
+    ROOM_ID_INPUT_ATTRS = (f'autocapitalize="characters" minlength="{ROOM_ID_LENGTH}" '
+                           f'maxlength="{ROOM_ID_LENGTH}" placeholder="{ROOM_ID_ALPHABET[1] * ROOM_ID_LENGTH}"')
+
+class RoomIdsExhausted(Exception):
+    pass
+
+class RoomIdPool:
+    """このシャードの番号を O(1) で払い出し・返却するプール。
+    遅延 Fisher-Yates：位置 0..free-1 が空き番号で、入れ替わった位置だけを swapped に持つ
+    （未使用の位置 p は番号 p*SHARD_COUNT+SHARD_INDEX）。払い出し中の位置は taken に持ち、
+    そこに無い番号の release は無視する（共有ストアで他ワーカーが払い出した番号を二重に空きへ
+    戻さないため）。メモリは使用中の番号数に比例する。"""
+
+    def __init__(self, space=ROOM_ID_SPACE, shards=SHARD_COUNT, index=SHARD_INDEX):
+        self.shards, self.index = shards, index
+        self.size = max(0, (space - index + shards - 1) // shards)
+        self.free = self.size
+        self.swapped = {}
+        self.taken = set()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            if self.free == 0:
+                raise RoomIdsExhausted()
+            r = random.randrange(self.free)
+            last = self.free - 1
+            pos = self.swapped.pop(r, r)
+            if r != last:
+                self.swapped[r] = self.swapped.pop(last, last)
+            self.free = last
+            self.taken.add(pos)
+        return encode_room_id(pos * self.shards + self.index)
+
+    def release(self, rid):
+        n = decode_room_id(rid)
+        if n is None or n % self.shards != self.index:
+            return
+        pos = n // self.shards
+        with self.lock:
+            if pos in self.taken:
+                self.taken.discard(pos)
+                self.swapped[self.free] = pos
+                self.free += 1
+
+    def in_use(self):
+        return self.size - self.free
+
+    def reset(self, used):
+        """使用中の番号一覧から作り直す（共有ストアで他ワーカーの払い出し分を数え直す時）"""
+        taken = set()
+        for rid in used:
+            n = decode_room_id(rid)
+            if n is not None and n % self.shards == self.index:
+                taken.add(n // self.shards)
+        free = self.size - len(taken)
+        # 空き側 [0, free) に入り込んだ使用中の位置を、使用側 [free, size) の空き位置と入れ替える
+        spare = (p for p in range(free, self.size) if p not in taken)
+        swapped = {p: next(spare) for p in taken if p < free}
+        with self.lock:
+            self.free, self.swapped, self.taken = free, swapped, taken
+
+room_ids = RoomIdPool()
 
 def gen_room_id():
+    """空き番号を1つ取る。空きが無ければ RoomIdsExhausted（満室）"""
+    rebuilt = False
     while True:
-        rid = ''.join(random.choices(string.digits, k=4))
+        try:
+            rid = room_ids.take()
+        except RoomIdsExhausted:
+            # 共有ストアでは他ワーカーが返した番号があり得るので、ストアから1回だけ数え直す
+            if not rooms.shared or rebuilt:
+                raise
+            room_ids.reset(list(rooms))
+            rebuilt = True
+            continue
+        # 共有ストアで他ワーカーが使っている番号なら使用中のまま取り直す
         if rid not in rooms:
             return rid
 
-def eff_ranges(allow_negative: bool):
-    if allow_negative:
-        return -NUM_MAX, NUM_MAX, -HIDDEN_MAX, HIDDEN_MAX
-    return NUM_MIN, NUM_MAX, HIDDEN_MIN, HIDDEN_MAX
-
-def bootstrap_page(title, body_html):
-    # FX images: 実在する拡張子をサーバ側で解決
-    FX_BS = fx_img_urls('bluff_success')
-    FX_BF = fx_img_urls('bluff_fail')
-    FX_RW = fx_img_urls('round_win')
-    FX_RL = fx_img_urls('round_lose')
-
-    return render_template_string("""
+# ページ外枠（CSS・ルール・FX用JS）。import時に一度だけコンパイルして使い回す
+PAGE_SHELL_SRC = """
 <!doctype html>
 <html lang="ja">
 <head>
@@ -300,21 +804,7 @@ def bootstrap_page(title, body_html):
     <!-- === SFX / FX helpers === -->
     <div id="sfx-toast" class="toast-bubble"></div>
     <script>
-      const SFX = {
-        guess_hit:   "/static/sfx/hit.mp3",
-        kill_dead:   "/static/sfx/dead.mp3",
-        kill_near:   "/static/sfx/near.mp3",
-        info:        "/static/sfx/info.mp3",
-        bluff_ok:    "/static/sfx/bluff_ok.mp3",
-        bluff_ng:    "/static/sfx/bluff_ng.mp3",
-        flag_boom:   "/static/sfx/boom.mp3",
-        press_ready: "/static/sfx/press_ready.mp3",
-        press_miss:  "/static/sfx/press_miss.mp3",
-        decl:        "/static/sfx/decl.mp3",
-        win:         "/static/sfx/win.mp3",
-        ping:        "/static/sfx/ping.mp3",
-        change:      "/static/sfx/change.mp3",
-      };
+      const SFX = {{ SFX | tojson }}; // 実在ファイルのみ（アセットマニフェスト）
 
       // --- image assets for bluff/lie judgement (実在ファイルのみ) ---
       const FX_IMG_SUCCESS = {{ FX_BS | tojson }}; // 実在ファイルのみ
@@ -341,8 +831,10 @@ def bootstrap_page(title, body_html):
         setTimeout(()=>document.body.classList.remove("screen-shake"), 380);
       }
 
-      function showFxImage(urlOrList){
-        const urls = Array.isArray(urlOrList) ? urlOrList : [urlOrList];
+      // spec: URL配列（従来形式）または {sources:[{type,srcset}], urls:[元画像...]}
+      function showFxImage(spec){
+        const urls = Array.isArray(spec) ? spec : ((spec && spec.urls) || [spec]);
+        const sources = (spec && !Array.isArray(spec) && spec.sources) || [];
         if(!urls.length) return;
 
         let i = 0;
@@ -353,9 +845,17 @@ def bootstrap_page(title, body_html):
         const prevOverflow = document.documentElement.style.overflow;
         document.documentElement.style.overflow = 'hidden';
 
+        // 縮小版（AVIF/WebP 等）があれば <picture> で画面幅に合うものをブラウザに選ばせる
+        const pic = document.createElement("picture");
+        for (const s of sources){
+          const el = document.createElement("source");
+          el.type = s.type; el.srcset = s.srcset; el.sizes = "100vw";
+          pic.appendChild(el);
+        }
         const img = new Image();
+        pic.appendChild(img);
         img.onload = () => {
-          wrap.appendChild(img);
+          wrap.appendChild(pic);
           document.body.appendChild(wrap);
           setTimeout(()=> {
             wrap.remove();
@@ -364,9 +864,15 @@ def bootstrap_page(title, body_html):
           }, 1500);
         };
         img.onerror = () => {
+          // 縮小版が読めなければ外して元画像の候補へ
+          if (pic.querySelector("source")) {
+            pic.querySelectorAll("source").forEach(el => el.remove());
+            img.src = urls[0];
+            return;
+          }
           i++;
           if (i < urls.length) {
-            img.src = urls[i] + "?v=" + Date.now();
+            img.src = urls[i];
           } else {
             try { wrap.remove(); } catch(_){}
             // スクロールを元に戻す
@@ -375,11 +881,10 @@ def bootstrap_page(title, body_html):
             try { toast("画像ファイルが見つかりません（" + urls.map(u=>u.split('/').pop()).join(' / ') + "）"); } catch(_){}
           }
         };
-        img.src = urls[0] + "?v=" + Date.now();
+        img.src = urls[0];
       }
-                                        (function(){
-        // 最後のログ行を取得（fxの有無で分岐）
-        const lastLi = document.querySelector(".log-box ol li:last-child");
+      // ログ行の演出（読み込み時は最後の行、/log 差分で追記した時はその最後の行）
+      function runLogFx(lastLi){
         if(!lastLi) return;
 
         const fxEl  = lastLi.querySelector(".fx");
@@ -407,37 +912,39 @@ def bootstrap_page(title, body_html):
         }
 
         if (shout) toast(shout);
-      })();
+      }
+      window.runLogFx = runLogFx;
+      runLogFx(document.querySelector(".log-box ol li:last-child"));
     </script>
   </div>
 </body>
 </html>
-""", title=title, body=body_html, NUM_MIN=NUM_MIN, NUM_MAX=NUM_MAX, HIDDEN_MIN=HIDDEN_MIN, HIDDEN_MAX=HIDDEN_MAX
-    , FX_BS=FX_BS, FX_BF=FX_BF, FX_RW=FX_RW, FX_RL=FX_RL
-)
+"""
+PAGE_SHELL = app.jinja_env.from_string(PAGE_SHELL_SRC)
+
+def bootstrap_page(title, body_html):
+    # FX images / SFX: アセットマニフェストから解決
+    assets = fx_shell_assets()
+    fx = assets['img']
+    return PAGE_SHELL.render(title=title, body=body_html, NUM_MIN=NUM_MIN, NUM_MAX=NUM_MAX, HIDDEN_MIN=HIDDEN_MIN, HIDDEN_MAX=HIDDEN_MAX
+        , FX_BS=fx['bluff_success'], FX_BF=fx['bluff_fail'], FX_RW=fx['round_win'], FX_RL=fx['round_lose']
+        , SFX=assets['sfx']
+    )
 # ===== 画像アセット診断ルート =====
 
 @app.get('/debug/assets')
 def debug_assets():
-    base = os.path.join(app.root_path, 'static', 'img')
-    names = [
-        ('bluff_success', 'ブラフ/嘘だ 成功（黒・スリム）'),
-        ('bluff_fail',    'ブラフ/嘘だ 失敗（茶・ぽっちゃり）'),
-        ('round_win',     'ラウンド勝利（カラフル）'),
-        ('round_lose',    'ラウンド敗北（白黒）'),
-    ]
+    base = os.path.join(app.static_folder, 'img')
+    m = asset_manifest()
     exts = ['png', 'jpg', 'jpeg']
     rows = []
-    for key, label in names:
-        found = None
-        for ext in exts:
-            p = os.path.join(base, f"{key}.{ext}")
-            if os.path.exists(p):
-                found = f"{key}.{ext}"
-                break
+    for key, label in FX_IMG_KEYS.items():
+        found = m['img'].get(key)
         if found:
-            url = f"/static/img/{found}"
-            rows.append(f"<tr><td><code>{key}</code></td><td>{label}</td><td><span class='badge bg-success'>OK</span></td><td><a href='{url}' target='_blank'>{url}</a></td><td><img src='{url}' style='max-height:120px'></td></tr>")
+            e = found[0]
+            url = e['url']
+            nvar = len(m['variants'].get(key, []))
+            rows.append(f"<tr><td><code>{key}</code></td><td>{label}</td><td><span class='badge bg-success'>OK</span><div class='small text-muted'>{e['size']:,} B / {e['hash'][:FINGERPRINT_LEN]} / 縮小版 {nvar}</div></td><td><a href='{url}' target='_blank'>{url}</a></td><td><img src='{url}' style='max-height:120px'></td></tr>")
         else:
             trial = ' / '.join(f"{key}.{e}" for e in exts)
             placeholder = url_for('fx_placeholder', key=key)
@@ -463,94 +970,37 @@ def debug_assets():
         <tbody>{''.join(rows)}</tbody>
       </table>
     </div>
+    <p class='small text-muted mb-2'>効果音: {len(m['sfx'])}/{len(SFX_FILES)} 件（{', '.join(sorted(m['sfx'])) or 'なし'}）</p>
+    <form method='post' action='{url_for('debug_assets_reload')}' class='d-inline'>
+      <button class='btn btn-outline-light'>マニフェストを再構築</button>
+    </form>
     <a class='btn btn-outline-light' href='{url_for('index')}'>ホームへ</a>
   </div>
 </div>
 """
     return bootstrap_page('画像デバッグ', body)
 
+@app.post('/debug/assets/reload')
+def debug_assets_reload():
+    build_asset_manifest()
+    return redirect(url_for('debug_assets'))
+
+@app.get('/debug/rooms')
+def debug_rooms():
+    """ルーム数・区分別の内訳・TTL・掃除で消した数・番号の使用数（このプロセス分）"""
+    by_phase = collections.Counter(phase for _rid, _last, phase in rooms.activity())
+    return jsonify({
+        'rooms': len(rooms),
+        'max': ROOM_MAX,
+        'by_phase': by_phase,
+        'ttl': ROOM_TTL,
+        'sweep_seconds': ROOM_SWEEP_SECONDS,
+        'evictions': room_evictions,
+        # 共有ストアではプールは他ワーカーの払い出しを知らないのでストアの件数を出す
+        'ids': {'space': room_ids.size, 'in_use': len(rooms) if rooms.shared else room_ids.in_use()},
+    })
 
 
-def init_room(allow_negative: bool, target_points: int, rules=None):
-    if rules is None:
-        rules = RULE_DEFAULTS.copy()
-    else:
-        base = RULE_DEFAULTS.copy()
-        base.update({k: bool(v) for k, v in rules.items()})
-        rules = base
-    eff_nmin, eff_nmax, eff_hmin, eff_hmax = eff_ranges(allow_negative)
-    return {
-        'allow_negative': allow_negative,
-        'eff_num_min': eff_nmin,
-        'eff_num_max': eff_nmax,
-        'eff_hidden_min': eff_hmin,
-        'eff_hidden_max': eff_hmax,
-        'target_points': target_points,
-        'round_no': 1,
-        'score': {1:0, 2:0},
-        'turn': 1,
-        'pname': {1: None, 2: None},
-        'secret': {1: None, 2: None},
-        'hidden': None,
-        'tries': {1:0, 2:0},
-        'available_hints': {1: ['和','差','積'], 2: ['和','差','積']},
-        'hint_choice_available': {1: False, 2: True},
-        'cooldown': {1:0, 2:0},
-        'change_used': {1:0, 2:0},
-        'trap_kill': {1: [], 2: []},
-        'trap_info': {1: [], 2: []},
-        'pending_view': {1: False, 2: False},
-        'can_view': {1: False, 2: False},
-        'view_cut_index': {1: None, 2: None},
-        'skip_next_turn': {1: False, 2: False},
-        'info_set_this_turn': {1: False, 2: False},
-        'info_max': {1: INFO_MAX_DEFAULT, 2: INFO_MAX_DEFAULT},
-        'info_free_per_turn': {1: 1, 2: 1},
-        'info_free_used_this_turn': {1: 0, 2: 0},
-        'actions': [],
-        'winner': None,
-        'phase': 'lobby',
-        'starter': 1,
-        'rules': rules,
-
-        'bluff': {1: None, 2: None},
-        'hint_preview': {1: None, 2: None},
-        'hint_penalty_active': {1: False, 2: False},
-        'hint_ct': {1: 0, 2: 0},
-        'guess_flag_armed': {1: False, 2: False},
-        'guess_flag_ct': {1: 0, 2: 0},
-        'guess_penalty_active': {1: False, 2: False},
-        'guess_ct': {1: 0, 2: 0},
-        'guess_flag_warn': {1: False, 2: False},
-        'guess_flag_used': {1: False, 2: False},
-
-        'decl1_value': {1: None, 2: None},
-        'decl1_used': {1: False, 2: False},
-        'decl1_resolved': {1: True, 2: True},
-        'decl1_hint_token_ready': {1: False, 2: False},
-        'decl1_hint_token_active': {1: False, 2: False},
-        'free_guess_pending': {1: False, 2: False},
-
-        'press_used': {1: False, 2: False},
-        'press_pending': {1: False, 2: False},
-
-        'role_main': {1: None, 2: None},
-        'role_extra': {1: None, 2: None},
-        'guardian_shield_used': {1: False, 2: False},
-        # 解除士：CD（自分のターン基準）。0=即発動可、>0 は減算して待機
-        'disarm_cd': {1: 0, 2: 0},
-
-        'yn_used_count': {1:0, 2:0},
-        'yn_ct': {1:0, 2:0},
-        'yn_last_tick': {1:-999, 2:-999},
-
-        'devotion_used': {1: False, 2: False},
-        'devotion_offers': {1: None, 2: None},
-        'devotion_info_penalty': {1: 0, 2: 0},
-
-        'turn_serial': 0,
-        'tick': 0,
-    }
 
 def room_or_404(rid):
     room = rooms.get(rid)
@@ -564,84 +1014,124 @@ def player_guard(rid, pid):
         abort(404)
     return room
 
-def push_log(room, s):
-    room['actions'].append(s)
-
-def has_role(room, pid, code):
-    if not room['rules'].get('roles', True):
+def room_cond(room_id):
+    cond = room_conds.get(room_id)
+    if cond is None:
+        cond = room_conds.setdefault(room_id, threading.Condition())
+    return cond
+
+def room_lock(room):
+    lock = room_locks.get(room.id)
+    if lock is None:
+        with rooms_lock:
+            lock = room_locks.setdefault(room.id, threading.RLock())
+    return lock
+
+def with_room_lock(view):
+    """ルートを room_id のルームロック内で実行し、抜ける時に公開スナップショットを更新する。
+    同じルームへの二重送信・同時 GET（スキップ処理）による switch_turn の重複を防ぐ"""
+    @functools.wraps(view)
+    def wrapper(**kw):
+        for _ in range(ROOM_COMMIT_RETRIES):
+            room = rooms.begin(kw.get('room_id'))
+            if room is None:
+                return view(**kw)
+            spill0 = room.actions.path
+            lock = room_lock(room)
+            with lock:
+                if room_locks.get(room.id) is not lock or (not rooms.shared and rooms.get(room.id) is not room):
+                    # ロック待ちの間にルームが消された（evict_room・finish_match）：読み直す
+                    continue
+                try:
+                    resp = view(**kw)
+                except BaseException:
+                    # プロセス内 dict では途中までの変更もそのまま残るので公開しておく
+                    if not rooms.shared:
+                        notify_room(room)
+                    elif room.actions.path != spill0:
+                        room.actions.discard()
+                    raise
+                changed = publish_room(room)
+                if rooms.commit(room):
+                    # 確定した状態だけを /poll・/events に知らせる
+                    if changed:
+                        wake_room(room.id)
+                    return resp
+            # 共有ストアで他ワーカーが先に書いた：この回で新しく作った spill ファイルは
+            # どこからも参照されないので消してから、読み直してやり直す
+            if room.actions.path != spill0:
+                room.actions.discard()
+        app.logger.warning("room %s: commit conflict", kw.get('room_id'))
+        abort(409)
+    return wrapper
+
+def wait_room(room_id, pred, timeout):
+    """pred() が真になるまで最大 timeout 秒待つ。共有ストアでは他ワーカーからの通知が
+    届かないので ROOM_STORE_POLL_SECONDS ごとに起きて読み直す"""
+    cond = room_cond(room_id)
+    deadline = time.monotonic() + timeout
+    with cond:
+        while not pred():
+            remain = deadline - time.monotonic()
+            if remain <= 0:
+                return False
+            cond.wait(min(remain, ROOM_STORE_POLL_SECONDS) if rooms.shared else remain)
+    return True
+
+def publish_room(room):
+    """turn_serial / phase / winner / ログ件数の公開スナップショットを作り直す（読み手はロックを
+    取らずスナップショットを見る）。変化があれば True"""
+    snap = _poll_state_now(room)
+    if snap == room.poll_snap:
         return False
-    return room['role_main'][pid] == code or room['role_extra'][pid] == code
-
-def assign_roles(room):
-    if not room['rules'].get('roles', True):
-        room['role_main'] = {1: None, 2: None}
-        room['role_extra'] = {1: None, 2: None}
-        return
-    keys = list(ROLES.keys())
-    room['role_main'][1] = random.choice(keys)
-    room['role_main'][2] = random.choice(keys)
-    room['role_extra'] = {1: None, 2: None}
-    room['guardian_shield_used'] = {1: False, 2: False}
-    room['disarm_cd'] = {1: 0, 2: 0}  # ラウンド頭でCDリセット
-
-def set_skip(room, pid):
-    if has_role(room, pid, 'Guardian') and not room['guardian_shield_used'][pid]:
-        room['guardian_shield_used'][pid] = True
-        push_log(room, f"{room['pname'][pid]} の番人効果により『次ターンスキップ』は無効化された（このラウンド1回）")
-        return
-    room['skip_next_turn'][pid] = True
-
-def _apply_trickster_noise(room, hint_owner_pid, value):
-    opp = 2 if hint_owner_pid == 1 else 1
-    if has_role(room, opp, 'Trickster'):
-        delta = random.choice([-1, 1])
-        return value + delta
-    return value
-
-def switch_turn(room, cur_pid):
-    for p in (1,2):
-        if room['cooldown'][p] > 0: room['cooldown'][p] -= 1
-        if room['hint_ct'][p] > 0: room['hint_ct'][p] -= 1
-        if room['guess_ct'][p] > 0: room['guess_ct'][p] -= 1
-        if room['guess_flag_ct'][p] > 0: room['guess_flag_ct'][p] -= 1
-        if room['yn_ct'][p] > 0: room['yn_ct'][p] -= 1
-
-    opp_prev = 2 if cur_pid == 1 else 1
-    if room['pending_view'][opp_prev]:
-        room['can_view'][opp_prev] = True
-        room['pending_view'][opp_prev] = False
-
-    next_pid = opp_prev
-    room['turn'] = next_pid
-    room['tick'] += 1
-    room['turn_serial'] += 1
-    room['info_free_used_this_turn'][next_pid] = 0
-    room['skip_suppress_pid'] = None
-
-    if room['rules'].get('guessflag', True):
-        gf_owner = next_pid
-        prev = cur_pid
-        if room['guess_flag_armed'][gf_owner]:
-            room['guess_flag_armed'][gf_owner] = False
-            room['guess_flag_warn'][prev] = True
-
-    # 解除士：自分のターン開始時、2ターンに1回ランダム解除（CD2）
-    if has_role(room, next_pid, 'Disarmer'):
-        opp = 2 if next_pid == 1 else 1
-        cd = room['disarm_cd'][next_pid]
-        if cd > 0:
-            room['disarm_cd'][next_pid] = cd - 1
-        else:
-            if room['trap_info'][opp]:
-                idx = random.randrange(len(room['trap_info'][opp]))
-                removed = room['trap_info'][opp].pop(idx)
-                room['disarm_cd'][next_pid] = 2  # 次の自分のターン2回は待機
-                push_log(room, f"{room['pname'][next_pid]} の解除士が相手のinfo({removed})を解除した（CD2）")
+    room.poll_snap = snap
+    return True
+
+def wake_room(room_id):
+    """待機中の /poll・/events を起こす"""
+    cond = room_cond(room_id)
+    with cond:
+        cond.notify_all()
+
+def notify_room(room, force=False):
+    """publish_room ＋ wake_room（ストアへの書き戻しを挟まない所：作成・削除時）"""
+    if publish_room(room) or force:
+        wake_room(room.id)
+
+# ====== 行動ログの表示 ======
+# 対戦画面は直近 LOG_WINDOW 件の範囲だけを表示する（常に EventLog のメモリ内）。
+LOG_WINDOW = min(int(os.environ.get("LOG_WINDOW", "200")), LOG_MEM_CAP // 2)
+
+def render_event(room, idx, ev=None):
+    code, actor, _tick, args = ev or room.actions.get(idx)
+    _name, _vis, render, fx, shout = EVENTS[code]
+    me = room.players[actor].pname if actor else ''
+    op = room.players[3 - actor].pname if actor else ''
+    text = render(me, op, args)
+    return text + fx_markup(fx, shout) if fx else text
+
+def sync_log_view(room, pid):
+    """前回以降に増えたログだけを走査して pid の表示索引と描画済みHTMLに追記する。
+    表示は直近 LOG_WINDOW 件の範囲に限り、それより古い分は索引から落とす"""
+    actions = room.actions
+    n = len(actions)
+    lo = max(0, n - LOG_WINDOW)
+    view, rendered = room.players[pid].log_view, room.players[pid].log_html
+    for idx, ev in actions.iter_range(max(room.players[pid].log_scan, lo), n):
+        if log_visible(room, pid, idx, ev):
+            view.append(idx)
+            rendered.append(f"<li>{render_event(room, idx, ev)}</li>")
+    room.players[pid].log_scan = n
+    drop = bisect.bisect_left(view, lo)
+    if drop:
+        del view[:drop]
+        del rendered[:drop]
+    return rendered
 
 # ====== ルーティング ======
 @app.route('/')
 def index():
-    body = """
+    body = f"""
 <div class="row g-3">
   <div class="col-12 col-lg-6">
     <div class="card">
@@ -681,8 +1171,8 @@ def index():
       <div class="card-body">
         <form method="get" action="/room">
           <div class="mb-3">
-            <label class="form-label">ルームID（4桁）</label>
-            <input class="form-control" name="room_id" inputmode="numeric" pattern="\\d{4}" placeholder="1234" required>
+            <label class="form-label">ルームID（{ROOM_ID_LENGTH}{"桁" if ROOM_ID_ALPHABET == string.digits else "文字"}）</label>
+            <input class="form-control" name="room_id" {ROOM_ID_INPUT_ATTRS} required>
           </div>
           <button class="btn btn-outline-light w-100">ロビーへ</button>
         </form>
@@ -707,13 +1197,28 @@ def create_room():
         'yn': bool(request.form.get('rule_yn')),
         'devotion': bool(request.form.get('rule_dev')),
     }
-    rid = gen_room_id()
-    rooms[rid] = init_room(allow_neg, target_points, rules)
+    if len(rooms) >= ROOM_MAX:
+        for old in rooms.lru_ids(len(rooms) - ROOM_MAX + 1):
+            evict_room(old, 'lru')
+    with rooms_lock:
+        while True:
+            try:
+                rid = gen_room_id()
+            except RoomIdsExhausted:
+                return bootstrap_page("満室", f"""
+<div class="alert alert-warning">ただいまルームが満室です。しばらくしてからもう一度お試しください。</div>
+<a class="btn btn-primary" href="{url_for('index')}">ホームへ</a>
+"""), 503
+            room = init_room(allow_neg, target_points, rules, rid=rid)
+            notify_room(room)
+            # 共有ストアでは他ワーカーが同じ番号を取っている場合があるので入れられた時だけ確定
+            if rooms.setdefault(rid, room) is room:
+                break
     return redirect(url_for('room_lobby', room_id=rid))
 
 @app.get('/room')
 def room_lobby_redirect():
-    rid = request.args.get('room_id', '').strip()
+    rid = normalize_room_id(request.args.get('room_id', ''))
     if not rid or rid not in rooms:
         return bootstrap_page("エラー", f"""
 <div class="alert alert-danger">そのルームは見つかりませんでした。</div>
@@ -726,24 +1231,24 @@ def room_lobby(room_id):
     room = room_or_404(room_id)
     l1 = url_for('join', room_id=room_id, player_id=1, _external=True)
     l2 = url_for('join', room_id=room_id, player_id=2, _external=True)
-    p1 = room['pname'][1] or '未参加'
-    p2 = room['pname'][2] or '未参加'
+    p1 = room.players[1].pname or '未参加'
+    p2 = room.players[2].pname or '未参加'
 
     # クイック入力（次ラウンドの秘密の数のみ）
     quick = ""
-    if room['phase'] == 'lobby' and room['pname'][1] and room['pname'][2]:
+    if room.phase == 'lobby' and room.players[1].pname and room.players[2].pname:
         pid_q = request.args.get('as')
         pid = int(pid_q) if pid_q in ('1','2') else None
-        if pid in (1, 2) and room['secret'][pid] is None:
+        if pid in (1, 2) and room.players[pid].secret is None:
             quick = f"""
 <div class="card mb-3">
   <div class="card-header">次ラウンド準備：新しい数を入力（プレイヤー{pid}）</div>
   <div class="card-body">
-    <div class="mb-2"><span class="badge bg-secondary">ニックネーム</span> <span class="value">{room['pname'][pid]}</span> <span class="small text-muted">（再入力不要）</span></div>
+    <div class="mb-2"><span class="badge bg-secondary">ニックネーム</span> <span class="value">{room.players[pid].pname}</span> <span class="small text-muted">（再入力不要）</span></div>
     <form method="post" action="{url_for('set_secret', room_id=room_id, player_id=pid)}">
       <div class="mb-3">
-        <label class="form-label">秘密の数字 ({room['eff_num_min']}〜{room['eff_num_max']})</label>
-        <input class="form-control" name="secret" type="number" required min="{room['eff_num_min']}" max="{room['eff_num_max']}" placeholder="{room['eff_num_min']}〜{room['eff_num_max']}">
+        <label class="form-label">秘密の数字 ({room.eff_num_min}〜{room.eff_num_max})</label>
+        <input class="form-control" name="secret" type="number" required min="{room.eff_num_min}" max="{room.eff_num_max}" placeholder="{room.eff_num_min}〜{room.eff_num_max}">
       </div>
       <button class="btn btn-primary w-100">この数で開始</button>
       <div class="small text-warning mt-1">※ 次ラウンドからは名前入力は不要です</div>
@@ -788,37 +1293,38 @@ def room_lobby(room_id):
 
 
 @app.route('/join/<room_id>/<int:player_id>', methods=['GET','POST'])
+@with_room_lock
 def join(room_id, player_id):
     room = player_guard(room_id, player_id)
     session['player_id'] = player_id
     # 既に名前があり、かつラウンド間ロビー中なら「秘密の数のみ」モード
-    simple_mode = (room['pname'][player_id] is not None and room['phase'] == 'lobby' and room['secret'][player_id] is None)
+    simple_mode = (room.players[player_id].pname is not None and room.phase == 'lobby' and room.players[player_id].secret is None)
 
     if request.method == 'POST':
         if simple_mode:
             secret = get_int(request.form, 'secret', default=None,
-                             min_v=room['eff_num_min'], max_v=room['eff_num_max'])
+                             min_v=room.eff_num_min, max_v=room.eff_num_max)
             if secret is None:
-                err = f"{room['eff_num_min']}〜{room['eff_num_max']}の整数で入力してください。"
+                err = f"{room.eff_num_min}〜{room.eff_num_max}の整数で入力してください。"
                 return join_form(room_id, player_id, err)
-            room['secret'][player_id] = secret
+            room.players[player_id].secret = secret
             session['room_id'] = room_id
             
-            if room['secret'][1] is not None and room['secret'][2] is not None:
+            if room.players[1].secret is not None and room.players[2].secret is not None:
                 start_new_round(room)
             return redirect(url_for('play', room_id=room_id) + f"?as={player_id}")
         else:
             name = request.form.get('name', '').strip() or f'プレイヤー{player_id}'
             secret = get_int(request.form, 'secret', default=None,
-                             min_v=room['eff_num_min'], max_v=room['eff_num_max'])
+                             min_v=room.eff_num_min, max_v=room.eff_num_max)
             if secret is None:
-                err = f"{room['eff_num_min']}〜{room['eff_num_max']}の整数で入力してください。"
+                err = f"{room.eff_num_min}〜{room.eff_num_max}の整数で入力してください。"
                 return join_form(room_id, player_id, err)
-            room['pname'][player_id] = name
-            room['secret'][player_id] = secret
+            room.players[player_id].pname = name
+            room.players[player_id].secret = secret
             session['room_id'] = room_id
             
-            if room['pname'][1] and room['pname'][2]:
+            if room.players[1].pname and room.players[2].pname:
                 start_new_round(room)
             return redirect(url_for('play', room_id=room_id) + f"?as={player_id}")
 
@@ -826,7 +1332,7 @@ def join(room_id, player_id):
 
 def join_form(room_id, player_id, error=None):
     room = rooms[room_id]
-    simple_mode = (room['pname'][player_id] is not None and room['phase'] == 'lobby' and room['secret'][player_id] is None)
+    simple_mode = (room.players[player_id].pname is not None and room.phase == 'lobby' and room.players[player_id].secret is None)
 
     if simple_mode:
         body = f"""
@@ -836,12 +1342,12 @@ def join_form(room_id, player_id, error=None):
     {"<div class='alert alert-danger'>" + error + "</div>" if error else ""}
     <form method="post">
       <div class="mb-2">
-        <span class="badge bg-secondary">ニックネーム</span> <span class="value">{room['pname'][player_id]}</span>
+        <span class="badge bg-secondary">ニックネーム</span> <span class="value">{room.players[player_id].pname}</span>
         <div class="small text-muted">※ 再入力不要です</div>
       </div>
       <div class="mb-3">
-        <label class="form-label">新しい秘密の数字 ({room['eff_num_min']}〜{room['eff_num_max']})</label>
-        <input class="form-control" type="number" name="secret" required min="{room['eff_num_min']}" max="{room['eff_num_max']}" placeholder="{room['eff_num_min']}〜{room['eff_num_max']}">
+        <label class="form-label">新しい秘密の数字 ({room.eff_num_min}〜{room.eff_num_max})</label>
+        <input class="form-control" type="number" name="secret" required min="{room.eff_num_min}" max="{room.eff_num_max}" placeholder="{room.eff_num_min}〜{room.eff_num_max}">
       </div>
       <button class="btn btn-primary w-100">この数で開始</button>
     </form>
@@ -861,8 +1367,8 @@ def join_form(room_id, player_id, error=None):
         <input class="form-control" name="name" placeholder="プレイヤー{player_id}">
       </div>
       <div class="mb-3">
-        <label class="form-label">秘密の数字 ({room['eff_num_min']}〜{room['eff_num_max']})</label>
-        <input class="form-control" type="number" name="secret" required min="{room['eff_num_min']}" max="{room['eff_num_max']}" placeholder="{room['eff_num_min']}〜{room['eff_num_max']}">
+        <label class="form-label">秘密の数字 ({room.eff_num_min}〜{room.eff_num_max})</label>
+        <input class="form-control" type="number" name="secret" required min="{room.eff_num_min}" max="{room.eff_num_max}" placeholder="{room.eff_num_min}〜{room.eff_num_max}">
       </div>
       <button class="btn btn-primary w-100">参加</button>
     </form>
@@ -874,6 +1380,7 @@ def join_form(room_id, player_id, error=None):
 
 # --- 新規: クイック秘密の数入力の受け口 ---
 @app.post('/set_secret/<room_id>/<int:player_id>')
+@with_room_lock
 def set_secret(room_id, player_id):
     room = player_guard(room_id, player_id)
     # セッションをプレイヤーにバインド
@@ -881,106 +1388,338 @@ def set_secret(room_id, player_id):
     session['player_id'] = player_id
     
     secret = get_int(request.form, 'secret', default=None,
-                     min_v=room['eff_num_min'], max_v=room['eff_num_max'])
+                     min_v=room.eff_num_min, max_v=room.eff_num_max)
     if secret is None:
-        err = f"{room['eff_num_min']}〜{room['eff_num_max']}の整数で入力してください。"
+        err = f"{room.eff_num_min}〜{room.eff_num_max}の整数で入力してください。"
         return join_form(room_id, player_id, err)
-    room['secret'][player_id] = secret
-    if room['secret'][1] is not None and room['secret'][2] is not None:
+    room.players[player_id].secret = secret
+    if room.players[1].secret is not None and room.players[2].secret is not None:
         start_new_round(room)
     return redirect(url_for('play', room_id=room_id) + f"?as={player_id}")
 
 
-def start_new_round(room):
-    room['hidden'] = random.randint(room['eff_hidden_min'], room['eff_hidden_max'])
-    room['tries'] = {1:0, 2:0}
-    room['actions'] = []
-    room['trap_kill'] = {1: [], 2: []}
-    room['trap_info'] = {1: [], 2: []}
-    room['pending_view'] = {1: False, 2: False}
-    room['can_view'] = {1: False, 2: False}
-    room['view_cut_index'] = {1: None, 2: None}
-    room['skip_next_turn'] = {1: False, 2: False}
-    room['info_set_this_turn'] = {1: False, 2: False}
-    room['info_max'] = {1: INFO_MAX_DEFAULT, 2: INFO_MAX_DEFAULT}
-    room['info_free_per_turn'] = {1: 1, 2: 1}
-    room['info_free_used_this_turn'] = {1: 0, 2: 0}
-    room['cooldown'] = {1: 0, 2: 0}
-    room['change_used'] = {1: 0, 2: 0}
-    room['available_hints'] = {1: ['和','差','積'], 2: ['和','差','積']}
-    room['bluff'] = {1: None, 2: None}
-    room['hint_preview'] = {1: None, 2: None}
-    room['hint_penalty_active'] = {1: False, 2: False}
-    room['hint_ct'] = {1: 0, 2: 0}
-    room['guess_flag_armed'] = {1: False, 2: False}
-    room['guess_flag_ct'] = {1: 0, 2: 0}
-    room['guess_penalty_active'] = {1: False, 2: False}
-    room['guess_ct'] = {1: 0, 2: 0}
-    room['guess_flag_warn'] = {1: False, 2: False}
-    room['guess_flag_used'] = {1: False, 2: False}
-
-    room['decl1_value'] = {1: None, 2: None}
-    room['decl1_used'] = {1: False, 2: False}
-    room['decl1_resolved'] = {1: True, 2: True}
-    room['decl1_hint_token_ready'] = {1: False, 2: False}
-    room['decl1_hint_token_active'] = {1: False, 2: False}
-    room['free_guess_pending'] = {1: False, 2: False}
-
-    room['press_used'] = {1: False, 2: False}
-    room['press_pending'] = {1: False, 2: False}
-
-    assign_roles(room)
-    room['devotion_used'] = {1: False, 2: False}
-    room['devotion_offers'] = {1: None, 2: None}
-    room['devotion_info_penalty'] = {1: 0, 2: 0}
-    room['guardian_shield_used'] = {1: False, 2: False}
-    room['disarm_cd'] = {1: 0, 2: 0}
-
-    room['yn_used_count'] = {1:0, 2:0}
-    room['yn_ct'] = {1:0, 2:0}
-    room['yn_last_tick'] = {1:-999, 2:-999}
-
-    if room['starter'] == 1:
-        room['hint_choice_available'] = {1: False, 2: True}
-        room['turn'] = 1
-        room['tick'] = 0
-    else:
-        room['hint_choice_available'] = {1: True, 2: False}
-        room['turn'] = 2
-        room['tick'] = 0
+def _poll_state_now(room):
+    return {
+        'turn': room.turn,
+        'serial': room.turn_serial,
+        'winner': room.winner,
+        'phase': room.phase,
+        'log': len(room.actions),
+    }
 
-    room['winner'] = None
-    room['phase'] = 'play'
-    room['turn_serial'] += 1
+def poll_state(room_id):
+    """最後に公開されたスナップショット（dict ごと差し替えるのでロック不要。共有ストアでは snap 列だけ読む）。
+    まだ一度も公開されていない時だけルーム本体から作る。ルームが無ければ None"""
+    snap = rooms.snapshot(room_id)
+    if snap or snap is None:
+        return snap
+    room = rooms.get(room_id)
+    return _poll_state_now(room) if room else None
+
+def poll_state_or_404(room_id):
+    snap = poll_state(room_id)
+    if snap is None:
+        abort(404)
+    return snap
 
 @app.route('/poll/<room_id>')
 def poll(room_id):
-    room = room_or_404(room_id)
-    return jsonify({
-        'turn': room['turn'],
-        'serial': room['turn_serial'],
-        'winner': room['winner'],
-        'phase': room['phase'],
-    })
+    """?since=<serial> 付きなら turn_serial がその値から動くまで（最大 LONGPOLL_TIMEOUT 秒）待つ。
+    ?log=<件数> も付ければログ件数が変わった時にも返る。ルーム本体は読まない（共有ストアでも snap 列だけ）。
+    待機枠（STREAM_MAX）が埋まっていれば待たずに返し、retry（ミリ秒）で次の問い合わせまでの間隔を伝える"""
+    poll_state_or_404(room_id)
+    since = request.args.get('since', type=int)
+    log_n = request.args.get('log', type=int)
+    if since is not None:
+        if not take_stream_slot():
+            return jsonify(dict(poll_state_or_404(room_id), retry=SHORT_POLL_MS))
+        timeout = min(request.args.get('timeout', LONGPOLL_TIMEOUT, type=float), LONGPOLL_TIMEOUT)
+
+        def changed():
+            snap = poll_state(room_id)
+            if snap is None:
+                return True
+            return snap['serial'] != since or (log_n is not None and snap['log'] != log_n)
+        try:
+            wait_room(room_id, changed, max(0.0, timeout))
+        finally:
+            release_stream_slot()
+    return jsonify(poll_state_or_404(room_id))
+
+@app.get('/log/<room_id>')
+@with_room_lock
+def log_delta(room_id):
+    """?as=<pid>&since=<件数>&epoch=<n>：since 以降に増えた pid から見えるログ行だけを返す。
+    閲覧権の変化で過去行の見え方が変わった時（epoch 不一致）は reset=true で表示窓全体を返し、
+    クライアントはリストを置き換える。"""
+    pid = request.args.get('as', type=int)
+    room = player_guard(room_id, pid)
+    since = request.args.get('since', 0, type=int)
+    epoch = request.args.get('epoch', type=int)
+    return jsonify(log_delta_payload(room, pid, since, epoch))
+
+def log_delta_payload(room, pid, since, epoch):
+    rendered = sync_log_view(room, pid)
+    n = len(room.actions)
+    reset = epoch != room.players[pid].log_epoch or since > n
+    start = 0 if reset else bisect.bisect_left(room.players[pid].log_view, since)
+    return {
+        'serial': room.turn_serial,
+        'next': n,
+        'epoch': room.players[pid].log_epoch,
+        'reset': reset,
+        'items': rendered[start:],
+    }
+
+# ===== JSON アクションAPI =====
+# 対戦画面のフォームと同じ action コード・フィールド名を JSON で受け、1手ぶんの
+# 状態差分と新しいログを1レスポンスで返す（POST→redirect→GET の往復を省く）。
+
+def player_state(room, pid):
+    """pid から見える状態（相手の秘密の数・トラップ・ロールは含めない）"""
+    return {
+        'serial': room.turn_serial,
+        'turn': room.turn,
+        'winner': room.winner,
+        'phase': room.phase,
+        'round_no': room.round_no,
+        'score': [room.players[1].score, room.players[2].score],
+        'tries': [room.players[1].tries, room.players[2].tries],
+        'secret': room.players[pid].secret,
+        'cooldown': ct_left(room, pid, 'cooldown_until'),
+        'hint_ct': ct_left(room, pid, 'hint_ct_until'),
+        'guess_ct': ct_left(room, pid, 'guess_ct_until'),
+        'trap_kill': list(room.players[pid].trap_kill),
+        'trap_info': list(room.players[pid].trap_info),
+        'info_max': get_info_max(room, pid),
+        'info_free_left': room.players[pid].info_free_per_turn - room.players[pid].info_free_used_this_turn,
+        'can_view': room.players[pid].can_view,
+        'opp_can_view': room.players[3 - pid].can_view,
+        'yn_used': room.players[pid].yn_used_count,
+        'decl1_used': room.players[pid].decl1_used,
+        'guess_flag_used': room.players[pid].guess_flag_used,
+        'devotion_used': room.players[pid].devotion_used,
+        'press_pending': room.players[pid].press_pending,
+        'free_guess_pending': room.players[pid].free_guess_pending,
+        'skip_next_turn': room.players[pid].skip_next_turn,
+        'role_main': room.players[pid].role_main,
+        'role_extra': room.players[pid].role_extra,
+    }
+
+def api_form(data):
+    """JSON 本文をフォームと同じ形（MultiDict・文字列値）に直す。配列は同名フィールドの複数値"""
+    form = MultiDict()
+    for k, v in data.items():
+        for x in (v if isinstance(v, list) else [v]):
+            form.add(k, '1' if x is True else '' if x in (False, None) else str(x))
+    return form
+
+def api_events(room, pid, start):
+    out = []
+    for idx, ev in room.actions.iter_range(start):
+        if log_visible(room, pid, idx, ev):
+            code, actor, tick, args = ev
+            out.append({'i': idx, 'event': EVENTS[code][0], 'actor': actor, 'tick': tick,
+                        'args': list(args), 'html': render_event(room, idx, ev)})
+    return out
+
+def action_prompt(room):
+    """確認待ち（room.prompt）の選択肢を JSON で表す"""
+    prompt = room.prompt
+    if not prompt:
+        return None
+    return {k: prompt[k] for k in ('kind', 'value', 'choices') if k in prompt}
+
+def api_preflight(room, pid):
+    """手番でなければ (エラーdict, 409)、実行してよければ None"""
+    if room.phase != 'play' or room.winner is not None:
+        return {'error': 'not_playing', 'state': player_state(room, pid)}, 409
+    resolve_pending_skip(room)
+    if room.turn != pid:
+        return {'error': 'not_your_turn', 'state': player_state(room, pid)}, 409
+    return None
+
+def run_api_action(room, pid, data):
+    """1手を実行して (結果dict, HTTPステータス) を返す"""
+    err = api_preflight(room, pid)
+    if err:
+        return err
+    action = data.get('action')
+    before = player_state(room, pid)
+    n0 = len(room.actions)
+    try:
+        apply(room, pid, api_form(data))
+    except Exception:
+        app.logger.exception("API処理中の例外")
+        return {'error': 'internal'}, 500
+    after = player_state(room, pid)
+    return {
+        'ok': True,
+        'action': action,
+        'serial': after['serial'],
+        'diff': {k: v for k, v in after.items() if before[k] != v},
+        'events': api_events(room, pid, n0),
+        'prompt': action_prompt(room),
+    }, 200
+
+# バッチ：手番を消費しない行動（宣言・Yes/No・無料info・嘘だ！成功など）をまとめて送る。
+# 先頭から順に適用し、手番が移った（または決着した）行動で打ち切る。途中で1つでも
+# 差し戻されたら（REJECT_EVENTS を出して手番が動かなかった／確認画面が要る）全体を巻き戻す。
+REJECT_EVENTS = frozenset(EV[n] for n in (
+    'bad_guess', 'bad_change', 'bad_press', 'bad_free_guess', 'bad_action',
+    'devotion_disabled', 'devotion_used', 'devotion_bad_pick', 'trap_disabled', 'bluff_disabled',
+    'guessflag_disabled', 'guessflag_used', 'decl_disabled', 'decl_used', 'decl_bad_digit',
+    'decl_call_unavailable', 'press_disabled', 'press_unavailable', 'press_not_pending',
+    'yn_disabled', 'yn_limit', 'yn_same_turn', 'yn_ct', 'yn_bad_input',
+    'info_none', 'info_free_cap', 'info_max', 'kill_invalid',
+    'change_on_trap', 'change_out_of_range', 'change_limit',
+))
+BATCH_MAX = 16
+# 巻き戻し用スナップショットから外すもの（ログ本体と表示キャッシュは別に戻す）
+_SNAPSHOT_SKIP = frozenset(('actions', 'players', 'poll_snap', '_rev'))
+_PLAYER_SNAPSHOT_SKIP = frozenset(('log_view', 'log_scan', 'log_html', 'log_epoch'))
+_ROOM_SNAPSHOT_FIELDS = tuple(k for k in Room.__slots__ if k not in _SNAPSHOT_SKIP)
+_PLAYER_SNAPSHOT_FIELDS = tuple(k for k in PlayerState.__slots__ if k not in _PLAYER_SNAPSHOT_SKIP)
+
+def room_snapshot(room):
+    return ([copy.deepcopy(getattr(room, k)) for k in _ROOM_SNAPSHOT_FIELDS],
+            [[copy.deepcopy(getattr(room.players[p], k)) for k in _PLAYER_SNAPSHOT_FIELDS] for p in (1, 2)])
+
+def room_restore(room, snap, n_events):
+    room_vals, player_vals = snap
+    for k, v in zip(_ROOM_SNAPSHOT_FIELDS, room_vals):
+        setattr(room, k, v)
+    for p, vals in zip((1, 2), player_vals):
+        ps = room.players[p]
+        for k, v in zip(_PLAYER_SNAPSHOT_FIELDS, vals):
+            setattr(ps, k, v)
+    room.actions.truncate(n_events)
+    for p in (1, 2):
+        rewind_log_view(room, p, n_events)
+
+def run_api_batch(room, pid, actions):
+    err = api_preflight(room, pid)
+    if err:
+        return err
+    before = player_state(room, pid)
+    n0 = len(room.actions)
+    snap = room_snapshot(room)
+    applied, stopped_at = 0, None
+    for k, data in enumerate(actions):
+        nk = len(room.actions)
+        try:
+            _room, new_events = apply(room, pid, api_form(data))
+        except Exception:
+            app.logger.exception("API処理中の例外")
+            room_restore(room, snap, n0)
+            return {'error': 'internal', 'index': k}, 500
+        still_mine = room.turn == pid and room.winner is None
+        prompt = action_prompt(room)
+        if prompt or (still_mine and any(ev[0] in REJECT_EVENTS for ev in new_events)):
+            reason = [e['html'] for e in api_events(room, pid, nk)]
+            room_restore(room, snap, n0)
+            return {'error': 'rejected', 'index': k, 'action': data.get('action'),
+                    'reason': reason, 'prompt': prompt,
+                    'state': player_state(room, pid)}, 422
+        applied += 1
+        if not still_mine:
+            stopped_at = k
+            break
+    after = player_state(room, pid)
+    return {
+        'ok': True,
+        'applied': applied,
+        'stopped_at': stopped_at,
+        'skipped': len(actions) - applied,
+        'serial': after['serial'],
+        'diff': {k: v for k, v in after.items() if before[k] != v},
+        'events': api_events(room, pid, n0),
+    }, 200
+
+@app.post('/api/rooms/<room_id>/actions/batch')
+@with_room_lock
+def api_action_batch(room_id):
+    """本文：{"as": pid, "actions": [{"action": "decl1", "decl1_digit": 3}, {"action": "yn", ...}, ...]}"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'bad_json'}), 400
+    actions = data.get('actions')
+    if (not isinstance(actions, list) or not 0 < len(actions) <= BATCH_MAX
+            or not all(isinstance(a, dict) for a in actions)):
+        return jsonify({'error': 'bad_actions', 'max': BATCH_MAX}), 400
+    pid = data.get('as')
+    pid = int(pid) if str(pid) in ('1', '2') else request.args.get('as', type=int)
+    room = player_guard(room_id, pid)
+    result, status = run_api_batch(room, pid, actions)
+    log_since = data.get('log_since')
+    if isinstance(log_since, int):
+        result['log'] = log_delta_payload(room, pid, log_since, data.get('log_epoch'))
+    return jsonify(result), status
+
+@app.post('/api/rooms/<room_id>/actions')
+@with_room_lock
+def api_action(room_id):
+    """本文：{"as": pid, "action": "g", "guess": 12, ...}。
+    "log_since"/"log_epoch" を付けると /log と同じ形の差分を "log" に同梱する。"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'bad_json'}), 400
+    data = dict(data)
+    pid = data.pop('as', None)
+    pid = int(pid) if str(pid) in ('1', '2') else request.args.get('as', type=int)
+    room = player_guard(room_id, pid)
+    log_since, log_epoch = data.pop('log_since', None), data.pop('log_epoch', None)
+    result, status = run_api_action(room, pid, data)
+    if isinstance(log_since, int):
+        result['log'] = log_delta_payload(room, pid, log_since, log_epoch)
+    return jsonify(result), status
+
+@app.get('/events/<room_id>')
+def events(room_id):
+    """SSE：turn_serial / winner / phase が変わった時だけ1通送る（接続直後に現状態を1通）。
+    SSE_MAX_SECONDS で一旦閉じ、クライアント（EventSource）の自動再接続に任せる。
+    /poll と同じくルーム本体は読まず、公開スナップショットだけを見る。
+    待機枠（STREAM_MAX）が埋まっていれば 503（EventSource は閉じ、クライアントは /poll へ移る）"""
+    poll_state_or_404(room_id)
+    if not take_stream_slot():
+        return Response("too many streams\n", status=503, mimetype='text/plain',
+                        headers={'Retry-After': str(SSE_MAX_SECONDS)})
+
+    def state_key(snap):
+        return (snap['serial'], snap['winner'], snap['phase'], snap['log'])
+
+    def stream():
+        yield "retry: 2000\n\n"
+        last = None
+        started = beat = time.monotonic()
+
+        def changed():
+            snap = poll_state(room_id)
+            return snap is None or state_key(snap) != last
+
+        while True:
+            snap = poll_state(room_id)
+            if snap is None:
+                yield "event: gone\ndata: {}\n\n"
+                return
+            now = time.monotonic()
+            if state_key(snap) != last:
+                last = state_key(snap)
+                beat = now
+                yield f"data: {json.dumps(snap)}\n\n"
+            elif now - beat >= SSE_HEARTBEAT_SECONDS:
+                beat = now
+                yield ": ping\n\n"
+            remain = SSE_MAX_SECONDS - (now - started)
+            if remain <= 0:
+                return
+            wait_room(room_id, changed, min(remain, SSE_HEARTBEAT_SECONDS))
+
+    resp = Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    resp.call_on_close(release_stream_slot)
+    return resp
 
-# ===== kill 閾値（罠師なら±2/±6、通常±1/±5） =====
-# ===== kill 閾値（罠師なら±2/±6、通常±1/±5） =====
-def _kill_thresholds(room, trap_owner_pid):
-    if has_role(room, trap_owner_pid, 'Trapper'):
-        return 2, 6
-    return 1, 5
-# --- CT（クールタイム）を自分の手番単位で正しく付与するヘルパ ---
-def apply_ct(room, pid, key, own_turns):
-    """
-    CTを「自分の手番」単位で付与する。
-    switch_turn() がターン交代ごとに全員のCTを減算する実装のため、
-    自分の手番を n 回ブロックしたい場合は 2n+1 を内部カウンタに入れる。
-    既存値より短くならないように最大値を採用する。
-    """
-    n = max(0, int(own_turns))
-    raw = 2 * n + 1
-    cur = room.get(key, {}).get(pid, 0)
-    room[key][pid] = max(cur, raw)
 # 任意: get_current_room_id
 def get_current_room_id():
     rid = session.get('room_id')
@@ -1000,7 +1739,63 @@ def redirect_play_with_pid(room_id, pid):
 def redirect_end_with_pid(room_id, pid):
     return redirect(url_for('end_round', room_id=room_id) + (f"?as={pid}" if pid in (1,2) else ""))
 
+def dispatch_action(room, pid, form):
+    """対戦画面の POST：engine.apply で1手進め、確認画面・結果画面・対戦画面のどれかを返す"""
+    apply(room, pid, form)
+    if room.prompt:
+        return prompt_page(room, pid, room.prompt)
+    if room.winner is not None:
+        return redirect_end_with_pid(get_current_room_id(), pid)
+    return redirect_play_with_pid(get_current_room_id(), pid)
+
+def prompt_page(room, pid, prompt):
+    back = url_for('play', room_id=get_current_room_id())
+    if prompt['kind'] == 'devotion_pick':
+        # UI：2択と説明を表示
+        options_html = ""
+        for code in prompt['choices']:
+            options_html += f"""
+        <div class="p-2 rounded border border-secondary mb-2">
+          <div class="h6 m-0"><span class="badge bg-secondary">{ROLES[code]}</span> <span class="small text-muted">（{code}）</span></div>
+          <div class="small text-muted">— {role_desc(code)}</div>
+          <form method="post" class="mt-2">
+            <input type="hidden" name="action" value="devotion_pick">
+            <input type="hidden" name="pick" value="{code}">
+            <button class="btn btn-outline-light w-100">このロールを選ぶ</button>
+          </form>
+        </div>
+        """
+        body = f"""
+<div class="card"><div class="card-header">二重職：献身（{room.players[pid].pname}）</div><div class="card-body">
+  <p class="mb-2">追加で1ロールを獲得します（このラウンド限定）。代償として <code>今ターン終了</code>、さらに <code>g/h にCT1</code>、加えて <code>info上限-2</code>（このラウンド中）。</p>
+  <div class="row"><div class="col-12 col-md-8">{options_html}</div></div>
+  <div class="mt-3"><a class="btn btn-outline-light" href="{back}">戻る</a></div>
+</div></div>
+"""
+        return bootstrap_page("献身の選択", body)
+
+    # ヒントのブラフ判断（相手のブラフが無ければ本物の値を先に決めて見せる）
+    keep = "".join(f"<input type='hidden' name='{k}' value='{v}'>" for k, v in prompt['keep'].items())
+    believe = "信じる" if prompt['bluff'] else "信じる（通常のヒントを受け取る）"
+    body = f"""
+<div class="card"><div class="card-header">ヒント（確認）</div><div class="card-body">
+  <p class="h5 mb-3">提示されたヒントの値： <span class="badge bg-warning text-dark">{prompt['value']}</span></p>
+  <p class="mb-3">このヒントはブラフだと思いますか？</p>
+  <form method="post" class="d-inline me-2">
+    <input type="hidden" name="action" value="h"><input type="hidden" name="bluff_decision" value="believe">{keep}
+    <button class="btn btn-primary">{believe}</button>
+  </form>
+  <form method="post" class="d-inline">
+    <input type="hidden" name="action" value="h"><input type="hidden" name="bluff_decision" value="accuse">{keep}
+    <button class="btn btn-outline-light">ブラフだ！と指摘する</button>
+  </form>
+  <div class="mt-3"><a class="btn btn-outline-light" href="{back}">戻る</a></div>
+</div></div>
+"""
+    return bootstrap_page("ヒント確認", body)
+
 @app.route('/play/<room_id>', methods=['GET','POST'])
+@with_room_lock
 def play(room_id):
     room = room_or_404(room_id)
     as_pid = request.args.get('as')
@@ -1013,11 +1808,11 @@ def play(room_id):
     if rid != room_id or pid not in (1,2):
         return redirect(url_for('room_lobby', room_id=room_id))
 
-    if not (room['pname'][1] and room['pname'][2]):
+    if not (room.players[1].pname and room.players[2].pname):
         l1 = url_for('join', room_id=room_id, player_id=1, _external=True)
         l2 = url_for('join', room_id=room_id, player_id=2, _external=True)
-        p1 = room['pname'][1] or '未参加'
-        p2 = room['pname'][2] or '未参加'
+        p1 = room.players[1].pname or '未参加'
+        p2 = room.players[2].pname or '未参加'
         opp = 2 if pid == 1 else 1
         wait_body = f"""
 <div class="card mb-3">
@@ -1044,136 +1839,58 @@ def play(room_id):
         return bootstrap_page("相手待ち", wait_body)
 
     # ロビー中：両者の新しい数がそろっていれば開始、そうでなければロビーへ戻す
-    if room['phase'] == 'lobby':
-        if room['secret'][1] is not None and room['secret'][2] is not None:
+    if room.phase == 'lobby':
+        if room.players[1].secret is not None and room.players[2].secret is not None:
             start_new_round(room)
         else:
             return redirect(url_for('room_lobby', room_id=room_id) + f"?as={pid}")
-        if room['winner'] is not None:
+        if room.winner is not None:
             return redirect(url_for('end_round', room_id=room_id))
 
-    if room['skip_next_turn'][room['turn']] and room.get('skip_suppress_pid') != room['turn']:
-        room['skip_next_turn'][room['turn']] = False
-        push_log(room, f"{room['pname'][room['turn']]} のターンは近接トラップ効果でスキップ" + fx_markup('kill_near','ヒヤッ！'))
-        cur = room['turn']
-        switch_turn(room, cur)
+    if resolve_pending_skip(room):
         return redirect(url_for('play', room_id=room_id))
 
     if request.method == 'POST':
-        if room['turn'] != pid:
+        if room.turn != pid:
             return redirect(url_for('play', room_id=room_id))
         try:
-            action = request.form.get('action')
-            if action == 'g':
-                guess_val = get_int(request.form, 'guess', None, room['eff_num_min'], room['eff_num_max'])
-                if guess_val is None:
-                    return push_and_back(room, pid, "⚠ 予想値が不正です。")
-                return handle_guess(room, pid, guess_val)
-
-            elif action == 'h':
-                return handle_hint(room, pid, request.form)
-
-            elif action == 'c':
-                new_secret = get_int(request.form, 'new_secret', None, room['eff_num_min'], room['eff_num_max'])
-                if new_secret is None:
-                    return push_and_back(room, pid, "⚠ 変更する数が不正です。")
-                return handle_change(room, pid, new_secret)
-
-            elif action == 't':
-                return handle_trap(room, pid, request.form)
-
-            elif action == 't_kill':
-                return handle_trap_kill(room, pid, request.form)
-
-            elif action == 't_info':
-                return handle_trap_info(room, pid, request.form)
-
-            elif action == 'bh':
-                return handle_bluff(room, pid, request.form)
-
-            elif action == 'gf':
-                return handle_guessflag(room, pid)
-
-            elif action == 'decl1':
-                return handle_decl1(room, pid, request.form)
-
-            elif action == 'decl1_challenge':
-                return handle_decl1_challenge(room, pid)
-
-            elif action == 'press':
-                press_val = get_int(request.form, 'press_guess', None, room['eff_num_min'], room['eff_num_max'])
-                if press_val is None:
-                    return push_and_back(room, pid, "⚠ サドン・プレスの値が不正です。")
-                return handle_press(room, pid, press_val)
-
-            elif action == 'press_skip':
-                return handle_press_skip(room, pid)
-
-            elif action == 'free_guess':
-                fg_val = get_int(request.form, 'free_guess', None, room['eff_num_min'], room['eff_num_max'])
-                if fg_val is None:
-                    return push_and_back(room, pid, "⚠ 無料予想の値が不正です。")
-                return handle_free_guess(room, pid, fg_val)
-
-            elif action == 'yn':
-                return handle_yn(room, pid, request.form)
-
-            elif action == 'devotion_offer':
-                return handle_devotion_offer(room, pid)
-
-            elif action == 'devotion_pick':
-                pick = request.form.get('pick')
-                return handle_devotion_pick(room, pid, pick)
-
-            else:
-                return push_and_back(room, pid, "⚠ 不明なアクションです。")
-
+            return dispatch_action(room, pid, request.form)
         except Exception:
             app.logger.exception("POST処理中の例外")
             return redirect(url_for('index'))
 
-    p1, p2 = room['pname'][1], room['pname'][2]
-    myname = room['pname'][pid]
+    p1, p2 = room.players[1].pname, room.players[2].pname
+    myname = room.players[pid].pname
     opp   = 2 if pid == 1 else 1
-    oppname = room['pname'][opp]
-
-    if request.method == 'GET' and room['turn'] == pid and room.get('guess_flag_warn', {}).get(pid):
-        other = 2 if pid == 1 else 1
-        push_log(room, f"{room['pname'][pid]} への通知: 実は前のターンに {room['pname'][other]} がゲスフラグを立てていた。危なかった！" + fx_markup('ping'))
-        room['guess_flag_warn'][pid] = False
-
-    filtered = []
-    cut = room['view_cut_index'][pid]
-    for idx, entry in enumerate(room['actions']):
-        if entry.startswith(f"{myname} "):
-            filtered.append(entry); continue
-        if entry.startswith(f"{oppname} が g（予想）→"):
-            filtered.append(entry); continue
-        if room['can_view'][pid] and (cut is None or idx >= cut) and entry.startswith(f"{oppname} "):
-            filtered.append(entry); continue
-    log_html = "".join(f"<li>{e}</li>" for e in filtered)
+    oppname = room.players[opp].pname
+
+    if request.method == 'GET' and room.turn == pid and room.players[pid].guess_flag_warn:
+        push_event(room, 'guessflag_notice', pid)
+        room.players[pid].guess_flag_warn = False
+
+    log_html = "".join(sync_log_view(room, pid))
 
     my_turn_block = ""
-    ru = room['rules']
-    if room['turn'] == pid:
-        if room['free_guess_pending'][pid] and ru.get('decl1', True):
+    ru = room.rules
+    if room.turn == pid:
+        if room.players[pid].free_guess_pending and ru.get('decl1', True):
             my_turn_block = f"""
 <div class="card mb-3"><div class="card-header">無料予想（嘘だ！成功）</div><div class="card-body">
 <form method="post" class="p-2 border rounded">
   <input type="hidden" name="action" value="free_guess">
   <label class="form-label">もう一度だけ無料で予想できます</label>
-  <input class="form-control mb-2" name="free_guess" type="number" required min="{room['eff_num_min']}" max="{room['eff_num_max']}" placeholder="{room['eff_num_min']}〜{room['eff_num_max']}">
+  <input class="form-control mb-2" name="free_guess" type="number" required min="{room.eff_num_min}" max="{room.eff_num_max}" placeholder="{room.eff_num_min}〜{room.eff_num_max}">
   <button class="btn btn-primary w-100">予想を送る</button>
   <div class="small text-warning mt-1">※ トラップは有効。±1/±5（罠師なら±2/±6）。ゲスフラグは発動しません。</div>
 </form></div></div>
 """
-        elif room['press_pending'][pid] and ru.get('press', True):
+        elif room.players[pid].press_pending and ru.get('press', True):
             my_turn_block = f"""
 <div class="card mb-3"><div class="card-header">サドン・プレス</div><div class="card-body">
   <form method="post" class="p-2 border rounded mb-2">
     <input type="hidden" name="action" value="press">
     <label class="form-label">もう一回だけ連続で予想</label>
-    <input class="form-control mb-2" name="press_guess" type="number" required min="{room['eff_num_min']}" max="{room['eff_num_max']}">
+    <input class="form-control mb-2" name="press_guess" type="number" required min="{room.eff_num_min}" max="{room.eff_num_max}">
     <button class="btn btn-primary w-100">もう一回だけ予想！</button>
     <div class="small text-warning mt-1">当たれば勝利。外すと次ターンスキップ（このラウンド1回）。</div>
   </form>
@@ -1184,11 +1901,11 @@ def play(room_id):
 </div></div>
 """
         else:
-            choose_allowed = has_role(room, pid, 'Scholar') or room['hint_choice_available'][pid]
+            choose_allowed = has_role(room, pid, 'Scholar') or room.players[pid].hint_choice_available
             yn_left = 3 if has_role(room, pid, 'Analyst') else 1
-            yn_left -= room['yn_used_count'][pid]
-            yn_ct = room['yn_ct'][pid]
-            devotion_ok = ru.get('devotion', True) and ru.get('roles', True) and (not room['devotion_used'][pid])
+            yn_left -= room.players[pid].yn_used_count
+            yn_ct = ct_left(room, pid, 'yn_ct_until')
+            devotion_ok = ru.get('devotion', True) and ru.get('roles', True) and (not room.players[pid].devotion_used)
             change_limit = 3 if has_role(room, pid, 'Tuner') else 2
             change_ct = 5 if has_role(room, pid, 'Tuner') else 7
 
@@ -1200,7 +1917,7 @@ def play(room_id):
       <input type="hidden" name="action" value="t">
       <label class="form-label">トラップ</label>
       <input class="form-control mb-2" name="trap_kill_value" type="number" placeholder="killは1つだけ（上書き・ターン消費）">
-      <div class="small text-warning">infoは最大{get_info_max(room, pid)}個・無料{room['info_free_per_turn'][pid]}個/ターン。チェックで3個まとめ置き（ターン消費）。</div>
+      <div class="small text-warning">infoは最大{get_info_max(room, pid)}個・無料{room.players[pid].info_free_per_turn}個/ターン。チェックで3個まとめ置き（ターン消費）。</div>
       <input class="form-control mb-2" name="trap_info_value" type="number" placeholder="info(1)">
       <input class="form-control mb-2" name="trap_info_value_1" type="number" placeholder="info(2)">
       <input class="form-control mb-2" name="trap_info_value_2" type="number" placeholder="info(3)">
@@ -1232,8 +1949,8 @@ def play(room_id):
       <input type="hidden" name="action" value="gf">
       <label class="form-label">ゲスフラグ</label>
       <div class="small text-warning mb-2">次の相手ターンに予想してきたら相手は即死（各ラウンド1回）</div>
-      <button class="btn btn-outline-light w-100" {"disabled" if room['guess_flag_used'][pid] else ""}>立てる</button>
-      <div class="small text-warning mt-1">{ "（このラウンドは既に使用）" if room['guess_flag_used'][pid] else "" }</div>
+      <button class="btn btn-outline-light w-100" {"disabled" if room.players[pid].guess_flag_used else ""}>立てる</button>
+      <div class="small text-warning mt-1">{ "（このラウンドは既に使用）" if room.players[pid].guess_flag_used else "" }</div>
     </form>
   </div>
 """
@@ -1245,15 +1962,15 @@ def play(room_id):
     <form method="post" class="p-2 border rounded">
       <input type="hidden" name="action" value="decl1">
       <label class="form-label">一の位を宣言（0〜9）</label>
-      <input class="form-control mb-2" name="decl1_digit" type="number" min="0" max="9" {"required" if not room['decl1_used'][pid] else "disabled"} placeholder="0〜9">
-      <button class="btn btn-outline-light w-100" {"disabled" if room['decl1_used'][pid] else ""}>宣言（ターン消費なし）</button>
-      <div class="small text-warning mt-1">{ "（このラウンドは既に宣言）" if room['decl1_used'][pid] else "以後、無料infoは2個/ターン・最大10個に" }</div>
+      <input class="form-control mb-2" name="decl1_digit" type="number" min="0" max="9" {"required" if not room.players[pid].decl1_used else "disabled"} placeholder="0〜9">
+      <button class="btn btn-outline-light w-100" {"disabled" if room.players[pid].decl1_used else ""}>宣言（ターン消費なし）</button>
+      <div class="small text-warning mt-1">{ "（このラウンドは既に宣言）" if room.players[pid].decl1_used else "以後、無料infoは2個/ターン・最大10個に" }</div>
     </form>
   </div>
 """
 
             decl_challenge_block = ""
-            if (ru.get('decl1', True) and (room['decl1_value'][opp] is not None and not room['decl1_resolved'][opp])):
+            if (ru.get('decl1', True) and (room.players[opp].decl1_value is not None and not room.players[opp].decl1_resolved)):
                 decl_challenge_block = f"""
   <div class="col-12 col-md-6">
     <form method="post" class="p-2 border rounded">
@@ -1312,9 +2029,9 @@ def play(room_id):
         <form method="post" class="p-2 border rounded">
           <input type="hidden" name="action" value="g">
           <label class="form-label">相手の数字を予想</label>
-          <input class="form-control mb-2" name="guess" type="number" required min="{room['eff_num_min']}" max="{room['eff_num_max']}">
-          <button class="btn btn-primary w-100" {"disabled" if room['guess_ct'][pid] > 0 else ""}>予想する</button>
-          <div class="small text-warning mt-1">{ "（予想はCT中）" if room['guess_ct'][pid] > 0 else "" }</div>
+          <input class="form-control mb-2" name="guess" type="number" required min="{room.eff_num_min}" max="{room.eff_num_max}">
+          <button class="btn btn-primary w-100" {"disabled" if ct_left(room, pid, 'guess_ct_until') > 0 else ""}>予想する</button>
+          <div class="small text-warning mt-1">{ "（予想はCT中）" if ct_left(room, pid, 'guess_ct_until') > 0 else "" }</div>
         </form>
       </div>
 
@@ -1325,8 +2042,8 @@ def play(room_id):
             <label class="form-label">ヒント</label>
             { "<div class='mb-2'><label class='form-label'>種類を指定</label><select class='form-select' name='hint_type'><option>和</option><option>差</option><option>積</option></select><input type='hidden' name='confirm_choice' value='1'></div>" if choose_allowed else "<div class='small text-warning mb-2'>(このターンは種類指定不可。ランダム)</div>" }
           </div>
-          <button class="btn btn-outline-light w-100" {"disabled" if room['hint_ct'][pid] > 0 else ""}>ヒントをもらう</button>
-          <div class="small text-warning mt-1">{ "（ヒントはCT中）" if room['hint_ct'][pid] > 0 else "" }</div>
+          <button class="btn btn-outline-light w-100" {"disabled" if ct_left(room, pid, 'hint_ct_until') > 0 else ""}>ヒントをもらう</button>
+          <div class="small text-warning mt-1">{ "（ヒントはCT中）" if ct_left(room, pid, 'hint_ct_until') > 0 else "" }</div>
         </form>
       </div>
 
@@ -1334,13 +2051,13 @@ def play(room_id):
         <form method="post" class="p-2 border rounded">
           <input type="hidden" name="action" value="c">
           <label class="form-label">自分の数を変更</label>
-          <input class="form-control mb-2" name="new_secret" type="number" required min="{room['eff_num_min']}" max="{room['eff_num_max']}">
-          <button class="btn btn-outline-light w-100" {"disabled" if (room['cooldown'][pid] > 0 or room['change_used'][pid] >= change_limit) else ""}>
+          <input class="form-control mb-2" name="new_secret" type="number" required min="{room.eff_num_min}" max="{room.eff_num_max}">
+          <button class="btn btn-outline-light w-100" {"disabled" if (ct_left(room, pid, 'cooldown_until') > 0 or room.players[pid].change_used >= change_limit) else ""}>
             変更する（CT{change_ct}・ラウンド{change_limit}回まで）
           </button>
           <div class="small text-warning mt-1">
-            このラウンドの使用回数：<span class="value">{room['change_used'][pid]}</span>/{change_limit}
-            { " ／（CT中）" if room['cooldown'][pid] > 0 else "" }
+            このラウンドの使用回数：<span class="value">{room.players[pid].change_used}</span>/{change_limit}
+            { " ／（CT中）" if ct_left(room, pid, 'cooldown_until') > 0 else "" }
           </div>
         </form>
       </div>
@@ -1357,14 +2074,14 @@ def play(room_id):
 </div>
 """
 
-    my_role = role_label(room['role_main'][pid]) if room['rules'].get('roles', True) else '—'
-    extra_role = role_label(room['role_extra'][pid]) if room['rules'].get('roles', True) else '—'
+    my_role = role_label(room.players[pid].role_main) if room.rules.get('roles', True) else '—'
+    extra_role = role_label(room.players[pid].role_extra) if room.rules.get('roles', True) else '—'
     body = f"""
 <div class="row g-3">
   <div class="col-12 col-lg-8">
     {my_turn_block}
     <div class="card">
-      <div class="card-header">アクション履歴</div>
+      <div class="card-header">アクション履歴{"（直近のみ・全体はラウンド結果で）" if len(room.actions) > LOG_WINDOW else ""}</div>
       <div class="card-body">
         <div class="log-box"><ol class="mb-0">{log_html}</ol></div>
       </div>
@@ -1376,13 +2093,13 @@ def play(room_id):
       <div class="card-header">あなた</div>
       <div class="card-body">
         <div class="mb-1"><span class="badge bg-secondary">名前</span> <span class="value">{myname}</span></div>
-        <div class="mb-1"><span class="badge bg-secondary">自分の秘密の数</span> <span class="value">{room['secret'][pid]}</span></div>
-        <div class="mb-1"><span class="badge bg-secondary">CT</span> c:<span class="value">{room['cooldown'][pid]}</span> / h:<span class="value">{room['hint_ct'][pid]}</span> / g:<span class="value">{room['guess_ct'][pid]}</span></div>
-        <div class="mb-1"><span class="badge bg-secondary">ロール</span> <span class="value">{my_role}</span>{ " ＋ " + extra_role if room['role_extra'][pid] else "" }</div>
-{ (f"<div class='small text-muted ms-1'>— {role_desc(room['role_main'][pid])}</div>") if room['role_main'][pid] else "" }
-{ (f"<div class='small text-muted ms-1'>— {role_desc(room['role_extra'][pid])}</div>") if room['role_extra'][pid] else "" }
+        <div class="mb-1"><span class="badge bg-secondary">自分の秘密の数</span> <span class="value" data-st="secret">{room.players[pid].secret}</span></div>
+        <div class="mb-1"><span class="badge bg-secondary">CT</span> c:<span class="value" data-st="cooldown">{ct_left(room, pid, 'cooldown_until')}</span> / h:<span class="value" data-st="hint_ct">{ct_left(room, pid, 'hint_ct_until')}</span> / g:<span class="value" data-st="guess_ct">{ct_left(room, pid, 'guess_ct_until')}</span></div>
+        <div class="mb-1"><span class="badge bg-secondary">ロール</span> <span class="value">{my_role}</span>{ " ＋ " + extra_role if room.players[pid].role_extra else "" }</div>
+{ (f"<div class='small text-muted ms-1'>— {role_desc(room.players[pid].role_main)}</div>") if room.players[pid].role_main else "" }
+{ (f"<div class='small text-muted ms-1'>— {role_desc(room.players[pid].role_extra)}</div>") if room.players[pid].role_extra else "" }
         <div class="mb-1"><span class="badge bg-secondary">トラップ</span><br>
-        {("<span class='small text-warning'>A(kill): <span class='value'>" + (", ".join(map(str, room['trap_kill'][pid])) if room['trap_kill'][pid] else "なし") + "</span></span><br><span class='small text-warning'>B(info): <span class='value'>" + (", ".join(map(str, room['trap_info'][pid])) if room['trap_info'][pid] else "なし") + f"</span></span><br><span class='small text-warning'>info最大: <span class='value'>{get_info_max(room, pid)}</span></span>") if room['rules'].get('trap', True) else "<span class='small text-warning'>このルームでは無効</span>" }
+        {("<span class='small text-warning'>A(kill): <span class='value' data-st='trap_kill'>" + (", ".join(map(str, room.players[pid].trap_kill)) if room.players[pid].trap_kill else "なし") + "</span></span><br><span class='small text-warning'>B(info): <span class='value' data-st='trap_info'>" + (", ".join(map(str, room.players[pid].trap_info)) if room.players[pid].trap_info else "なし") + f"</span></span><br><span class='small text-warning'>info最大: <span class='value' data-st='info_max'>{get_info_max(room, pid)}</span></span>") if room.rules.get('trap', True) else "<span class='small text-warning'>このルームでは無効</span>" }
         </div>
       </div>
     </div>
@@ -1391,9 +2108,9 @@ def play(room_id):
       <div class="card-header">相手</div>
       <div class="card-body">
         <div class="mb-1"><span class="badge bg-secondary">名前</span> <span class="value">{oppname}</span></div>
-        <div class="mb-1"><span class="badge bg-secondary">あなたに対する予想回数</span> <span class="value">{room['tries'][opp]}</span></div>
-        <div class="mb-1"><span class="badge bg-secondary">ログ閲覧権（info）</span> {"有効" if room['can_view'][opp] else "なし"}</div>
-        <div class="small text-warning">レンジ: <span class="value">{room['eff_num_min']}〜{room['eff_num_max']}</span></div>
+        <div class="mb-1"><span class="badge bg-secondary">あなたに対する予想回数</span> <span class="value">{room.players[opp].tries}</span></div>
+        <div class="mb-1"><span class="badge bg-secondary">ログ閲覧権（info）</span> {"有効" if room.players[opp].can_view else "なし"}</div>
+        <div class="small text-warning">レンジ: <span class="value">{room.eff_num_min}〜{room.eff_num_max}</span></div>
       </div>
     </div>
   </div>
@@ -1405,8 +2122,13 @@ def play(room_id):
   const mypid = {pid};
   const ROOM_ID = "{room_id}";
   try{{ localStorage.setItem("pid:"+ROOM_ID, String(mypid)); }}catch(_){{}}
-  let lastSerial = {room['turn_serial']};
+  let lastSerial = {room.turn_serial};
+  let logNext = {len(room.actions)}, logEpoch = {room.players[pid].log_epoch};
+  const LOG_WINDOW = {LOG_WINDOW};
   const POLL_URL  = "{url_for('poll', room_id=room_id)}";
+  const LOG_URL   = "{url_for('log_delta', room_id=room_id)}?as={pid}";
+  const API_URL   = "{url_for('api_action', room_id=room_id)}";
+  const EVENTS_URL = "{url_for('events', room_id=room_id)}";
   const END_URL   = "{url_for('end_round', room_id=room_id)}?as={pid}";
   const LOBBY_URL = "{url_for('room_lobby', room_id=room_id)}?as={pid}";
 </script>
@@ -1415,33 +2137,147 @@ def play(room_id):
     script_poll = r"""
 <script>
 (function(){
-  async function check(){
+  // 状態を反映。ページ遷移した場合は true
+  function apply(j){
+    if (j.winner !== null) { window.location.href = END_URL;  return true; }
+    if (j.phase  !== "play"){ window.location.href = LOBBY_URL; return true; }
+    if (j.serial !== lastSerial && (j.turn === mypid)) { location.reload(); return true; }
+    lastSerial = j.serial;
+    if (j.log !== logNext) logTask = queue(fetchLog);
+    return false;
+  }
+  // ログ取得とアクション送信は1本の列で順に流す（logNext を常に最新にしてから次を送る）
+  let chain = Promise.resolve(), logTask = null;
+  function queue(fn){ chain = chain.then(fn, fn); return chain; }
+  // ログ差分：見えるようになった行だけ受け取って一覧の末尾に足す
+  function applyLog(d){
+    const ol = document.querySelector(".log-box ol");
+    if (ol && (d.reset || d.items.length)){
+      if (d.reset) ol.innerHTML = d.items.join("");
+      else ol.insertAdjacentHTML("beforeend", d.items.join(""));
+      while (ol.children.length > LOG_WINDOW) ol.firstElementChild.remove();
+      const box = ol.parentElement; box.scrollTop = box.scrollHeight;
+      if (d.items.length && window.runLogFx) window.runLogFx(ol.lastElementChild);
+    }
+    logNext = d.next; logEpoch = d.epoch;
+  }
+  async function fetchLog(){
     try{
-      const r = await fetch(POLL_URL, {cache:"no-store"});
-      const j = await r.json();
-      if (j.winner !== null) { window.location.href = END_URL;  return; }
-      if (j.phase  !== "play"){ window.location.href = LOBBY_URL; return; }
-      if (j.serial !== lastSerial && (j.turn === mypid)) { location.reload(); return; }
-      lastSerial = j.serial;
-    }catch(e){}
+      const r = await fetch(LOG_URL + "&since=" + logNext + "&epoch=" + logEpoch, {cache:"no-store"});
+      if (r.ok) applyLog(await r.json());
+    }catch(_){}
+  }
+
+  // アクション送信：/api で1往復。手番・ゲーム状態が変わる時だけページを読み直す
+  const RELOAD_KEYS = ["turn","winner","phase","round_no","press_pending","free_guess_pending",
+                       "decl1_used","guess_flag_used","devotion_used","role_extra","can_view","opp_can_view"];
+  function showState(diff){
+    for (const [k, v] of Object.entries(diff)){
+      document.querySelectorAll('[data-st="' + k + '"]').forEach(el => {
+        el.textContent = Array.isArray(v) ? (v.length ? v.join(", ") : "なし") : String(v);
+      });
+    }
   }
-  setInterval(check, 1200);
+  async function sendAction(form){
+    const body = {as: mypid, log_since: logNext, log_epoch: logEpoch};
+    for (const [k, v] of new FormData(form).entries()){
+      if (k in body) body[k] = [].concat(body[k], v); else body[k] = v;
+    }
+    const r = await fetch(API_URL, {method:"POST", headers:{"Content-Type":"application/json"}, body: JSON.stringify(body)});
+    if (!r.ok){ location.reload(); return; }
+    const res = await r.json();
+    if (res.log) applyLog(res.log);
+    lastSerial = res.serial;
+    if (RELOAD_KEYS.some(k => k in res.diff)){
+      if (res.diff.winner !== undefined && res.diff.winner !== null) window.location.href = END_URL;
+      else location.reload();
+      return;
+    }
+    showState(res.diff);
+    form.reset();
+  }
+  // 確認画面を挟むアクション（ヒントのブラフ確認・献身の候補選択）は従来どおりフォーム送信
+  const PAGE_ACTIONS = ["h", "devotion_offer"];
+  document.querySelectorAll('form[method="post"]').forEach(form => {
+    const a = form.querySelector('[name="action"]');
+    if (!a || !window.fetch || PAGE_ACTIONS.includes(a.value)) return;
+    form.addEventListener("submit", (ev) => {
+      ev.preventDefault();
+      const btn = form.querySelector("button"); if (btn) btn.disabled = true;
+      queue(() => sendAction(form)).finally(() => { if (btn) btn.disabled = false; });
+    });
+  });
+  // ロングポーリング：turn_serial が lastSerial から動くまでサーバ側で待機
+  let polling = false;
+  async function startPolling(){
+    if (polling) return;
+    polling = true;
+    while (true){
+      try{
+        const r = await fetch(POLL_URL + "?since=" + lastSerial + "&log=" + logNext, {cache:"no-store"});
+        if (!r.ok) throw new Error(String(r.status));
+        const j = await r.json();
+        if (apply(j)) return;
+        if (logTask) await logTask;
+        // サーバの待機枠が埋まっている時は短いポーリング（retry ミリ秒おき）
+        if (j.retry) await new Promise(res => setTimeout(res, j.retry));
+      }catch(e){
+        await new Promise(res => setTimeout(res, 1200));
+      }
+    }
+  }
+
+  // SSE が使えればそちらで待つ。使えない／切断されたらロングポーリングへフォールバック
+  if (!window.EventSource){ startPolling(); return; }
+  const es = new EventSource(EVENTS_URL);
+  es.onmessage = (ev) => {
+    try{ if (apply(JSON.parse(ev.data))) es.close(); }catch(_){}
+  };
+  es.addEventListener("gone", () => { es.close(); });
+  es.onerror = () => { if (es.readyState === EventSource.CLOSED) startPolling(); };
 })();
 </script>
 """
     return bootstrap_page(f"対戦 - {myname}", body + script_vars + script_poll)
 
+# ラウンド結果ページのログ差し込み位置（ページを前後に割って間にログを流す）
+ROUND_LOG_MARK = "<!--round-log-->"
+ROUND_LOG_CHUNK = 256
+
+def stream_round_log(room, log, head, tail):
+    """head → ログ（spill ファイル＋メモリを順読み）を ROUND_LOG_CHUNK 件ずつ → tail。
+    log は end_round がルームロック内で freeze() した複製（None なら複製できなかった）"""
+    yield head
+    buf = []
+    try:
+        if log is None:
+            raise LogDiscarded(0)
+        for idx, ev in log.iter_range():
+            buf.append(f"<li>{render_event(room, idx, ev)}</li>")
+            if len(buf) >= ROUND_LOG_CHUNK:
+                yield "".join(buf)
+                buf = []
+    except LogDiscarded:
+        buf.append("<li class='text-warning'>（次のラウンドが始まったため、これ以前の行動履歴は表示できません）</li>")
+    yield "".join(buf) + tail
+
 @app.get('/end/<room_id>')
 def end_round(room_id):
     room = room_or_404(room_id)
-    if room['winner'] is None:
-        return redirect(url_for('play', room_id=room_id))
-    winner = room['winner']
-    winner_name = room['pname'][winner]
-    tries = room['tries'][winner]
-    p1, p2 = room['pname'][1], room['pname'][2]
-    target = room['target_points']
-    match_over = (room['score'][1] >= target) or (room['score'][2] >= target)
+    # ログはロック内で複製しておく（ストリーム中に「次のラウンドへ」で discard() されても読み切れる）
+    with room_lock(room):
+        if room.winner is None:
+            return redirect(url_for('play', room_id=room_id))
+        try:
+            log = room.actions.freeze()
+        except LogDiscarded:
+            log = None
+    winner = room.winner
+    winner_name = room.players[winner].pname
+    tries = room.players[winner].tries
+    p1, p2 = room.players[1].pname, room.players[2].pname
+    target = room.target_points
+    match_over = (room.players[1].score >= target) or (room.players[2].score >= target)
     # 表示者（ブラウザ側）の勝敗を判定するため、?as= からプレイヤーIDを取得
     as_pid = request.args.get('as')
     if as_pid in ('1','2'):
@@ -1449,20 +2285,19 @@ def end_round(room_id):
     viewer_pid = int(as_pid) if as_pid in ('1','2') else session.get('player_id')
     view_state = 'win' if viewer_pid == winner else ('lose' if viewer_pid in (1,2) else '')
 
-    log_html_full = "".join(f"<li>{e}</li>" for e in room['actions'])
     next_url = url_for('next_round', room_id=room_id) + (f"?as={viewer_pid}" if viewer_pid in (1,2) else "")
     play_url = url_for('play', room_id=room_id) + (f"?as={viewer_pid}" if viewer_pid in (1,2) else "")
     finish_url = url_for('finish_match', room_id=room_id)
     body = f"""
 <div class="card mb-3">
-  <div class="card-header">ラウンド {room['round_no']} の結果</div>
+  <div class="card-header">ラウンド {room.round_no} の結果</div>
   <div class="card-body">
     <p class="h5">勝者: {winner_name} <span class="badge bg-success">{tries} 回で正解</span></p>
-    <p class="mb-1">{p1} の数: {room['secret'][1]}</p>
-    <p class="mb-1">{p2} の数: {room['secret'][2]}</p>
-    <p class="mb-1">誰にも知らない数: {room['hidden']}</p>
+    <p class="mb-1">{p1} の数: {room.players[1].secret}</p>
+    <p class="mb-1">{p2} の数: {room.players[2].secret}</p>
+    <p class="mb-1">誰にも知らない数: {room.hidden}</p>
     <hr/>
-    <div class="h6">現在スコア: {p1} {room['score'][1]} - {room['score'][2]} {p2}（先取 {target}）</div>
+    <div class="h6">現在スコア: {p1} {room.players[1].score} - {room.players[2].score} {p2}（先取 {target}）</div>
     <div class="mt-3">
       {"<a class='btn btn-primary' href='" + finish_url + "'>マッチ終了</a>" if match_over else "<a class='btn btn-primary' href='" + next_url + "'>次のラウンドへ</a>"}
       <a class="btn btn-outline-light ms-2" href="{play_url}">対戦画面へ戻る</a>
@@ -1473,7 +2308,7 @@ def end_round(room_id):
 <div class="card">
   <div class="card-header">このラウンドの行動履歴（フル）</div>
   <div class="card-body">
-    <div class="log-box"><ol class="mb-0">{log_html_full}</ol></div>
+    <div class="log-box"><ol class="mb-0">{ROUND_LOG_MARK}</ol></div>
   </div>
 </div>
 """
@@ -1491,7 +2326,7 @@ def end_round(room_id):
 // === ラウンド結果演出 ===
 // 1) 紙吹雪 + 勝利SE（失敗しても無視）
 (function(){
-  try{ new Audio("/static/sfx/win.mp3").play().catch(_=>{}); }catch(_){}
+  try{ if (typeof playSfx === 'function') playSfx("win", 1); }catch(_){}
   const c = document.createElement('canvas');
   Object.assign(c.style, {position:'fixed', inset:0, zIndex:1500, pointerEvents:'none'});
   document.body.appendChild(c);
@@ -1521,7 +2356,7 @@ def end_round(room_id):
 (function(){
   function fallbackShow(list){
     try{
-      var urls = Array.isArray(list)? list : [list];
+      var urls = Array.isArray(list)? list : ((list && list.urls) || [list]);
       var wrap = document.createElement('div');
       wrap.className = 'fx-img-overlay';
       var img = new Image();
@@ -1545,7 +2380,8 @@ def end_round(room_id):
   function pickList(state){
     try{
       var l = (state === 'lose') ? FX_ROUND_LOSE : FX_ROUND_WIN;
-      if (!Array.isArray(l) || l.length===0) throw new Error('empty');
+      var urls = Array.isArray(l) ? l : (l && l.urls);
+      if (!Array.isArray(urls) || urls.length===0) throw new Error('empty');
       return l;
     }catch(_){
       // サーバ側プレースホルダにフォールバック
@@ -1576,971 +2412,43 @@ def end_round(room_id):
 })();
 </script>
 """
-    return bootstrap_page("ラウンド結果", body + script_vars + script_fx)
+    head, tail = bootstrap_page("ラウンド結果", body + script_vars + script_fx).split(ROUND_LOG_MARK, 1)
+    resp = Response(stream_round_log(room, log, head, tail), mimetype='text/html')
+    if log is not None:
+        resp.call_on_close(log.discard)  # 複製の spill ファイルはストリームを閉じた時に消す
+    return resp
 
 @app.get('/next/<room_id>')
+@with_room_lock
 def next_round(room_id):
     room = room_or_404(room_id)
-    if room['winner'] is None:
+    if room.winner is None:
         return redirect(url_for('play', room_id=room_id))
-    loser = 2 if room['winner'] == 1 else 1
-    room['starter'] = loser
-    room['round_no'] += 1
-    room['secret'][1] = None
-    room['secret'][2] = None
-    room['phase'] = 'lobby'
-    room['winner'] = None  # 前ラウンドの勝者状態をクリア（誤って結果画面へ飛ばないように）
+    loser = 2 if room.winner == 1 else 1
+    room.starter = loser
+    room.round_no += 1
+    room.players[1].secret = None
+    room.players[2].secret = None
+    room.phase = 'lobby'
+    room.winner = None  # 前ラウンドの勝者状態をクリア（誤って結果画面へ飛ばないように）
+    bump_serial(room)
     return redirect(url_for('room_lobby', room_id=room_id))
 
 @app.get('/finish/<room_id>')
+@with_room_lock
 def finish_match(room_id):
     room = room_or_404(room_id)
-    p1, p2 = room['pname'][1], room['pname'][2]
-    msg = f"🏆 マッチ終了！ {p1} {room['score'][1]} - {room['score'][2]} {p2}"
-    del rooms[room_id]
+    p1, p2 = room.players[1].pname, room.players[2].pname
+    msg = f"🏆 マッチ終了！ {p1} {room.players[1].score} - {room.players[2].score} {p2}"
+    with rooms_lock:
+        del rooms[room_id]
+    room_ids.release(room_id)
+    room.actions.discard()
+    notify_room(room, force=True)
+    room_conds.pop(room_id, None)
+    room_locks.pop(room_id, None)
     return bootstrap_page("マッチ終了", f"<div class='alert alert-info'>{msg}</div><a class='btn btn-primary' href='{url_for('index')}'>ホームへ</a>")
 
-#
-# ====== アクション処理 ======
-
-# --- Devotion Offer ---
-def handle_devotion_offer(room, pid):
-    # 二重職：献身の候補を2つ提示（説明つき）
-    if not (room['rules'].get('devotion', True) and room['rules'].get('roles', True)):
-        return push_and_back(room, pid, "（このルームでは献身は無効です）")
-    if room['devotion_used'][pid]:
-        return push_and_back(room, pid, "（このラウンドは既に献身を使っています）")
-
-    # 既に持っているロールは候補から除外
-    owned = set([room['role_main'][pid], room['role_extra'][pid]])
-    pool = [k for k in ROLES.keys() if k not in owned]
-    if len(pool) < 2:
-        pool = list(ROLES.keys())
-
-    picks = random.sample(pool, 2)
-    room['devotion_offers'][pid] = set(picks)
-
-    body = f"""
-<div class="card"><div class="card-header">二重職：献身</div><div class="card-body">
-  <p class="mb-2">候補から<strong>1つ</strong>選んで取得します。</p>
-  <p class="small text-warning mb-3">代償：今ターン終了／予想とヒントにCT1付与／info上限-2（このラウンド）</p>
-  <form method="post">
-    <input type="hidden" name="action" value="devotion_pick">
-    <div class="form-check mb-2">
-      <input class="form-check-input" type="radio" name="pick" id="dev_pick1" value="{picks[0]}" required>
-      <label class="form-check-label" for="dev_pick1"><span class="badge bg-secondary">{role_label(picks[0])}</span> — {role_desc(picks[0])}</label>
-    </div>
-    <div class="form-check mb-3">
-      <input class="form-check-input" type="radio" name="pick" id="dev_pick2" value="{picks[1]}">
-      <label class="form-check-label" for="dev_pick2"><span class="badge bg-secondary">{role_label(picks[1])}</span> — {role_desc(picks[1])}</label>
-    </div>
-    <button class="btn btn-primary">このロールを得る</button>
-    <a class="btn btn-outline-light ms-2" href="{url_for('play', room_id=get_current_room_id())}">戻る</a>
-  </form>
-</div></div>
-"""
-    return bootstrap_page("献身：ロール選択", body)
-
-# --- Devotion Pick ---
-def handle_devotion_pick(room, pid, pick):
-    # 候補から選択 → 取得し、代償を適用して即ターン終了
-    if not (room['rules'].get('devotion', True) and room['rules'].get('roles', True)):
-        return push_and_back(room, pid, "（このルームでは献身は無効です）")
-
-    offers = room['devotion_offers'].get(pid)
-    if not offers or pick not in offers:
-        return push_and_back(room, pid, "⚠ 献身の選択肢が有効ではありません。")
-
-    room['role_extra'][pid] = pick
-    room['devotion_used'][pid] = True
-    room['devotion_offers'][pid] = None
-
-    push_log(room, f"{room['pname'][pid]} が 献身として『{role_label(pick)}』を獲得 — {role_desc(pick)}")
-
-    # 代償：予想＆ヒントのCTを最低1に引き上げ、info上限-2（get_info_maxで反映）
-    room['guess_penalty_active'][pid] = True
-    room['hint_penalty_active'][pid] = True
-    room.setdefault('hint_penalty_len', {1:1, 2:1})
-    room['hint_penalty_len'][pid] = max(room['hint_penalty_len'][pid], 1)
-    room['devotion_info_penalty'][pid] = 2
-    push_log(room, "（献身の代償：このターン終了／g&amp;hにCT1／info上限-2）")
-
-    # 即時CTを付与（学者のヒントCTは無効化仕様のため付与しない）
-    if not has_role(room, pid, 'Scholar'):
-        apply_ct(room, pid, 'hint_ct', 1)
-    apply_ct(room, pid, 'guess_ct', 1)
-
-    # 今ターン終了（相手へ）
-    switch_turn(room, pid)
-    return redirect_play_with_pid(get_current_room_id(), pid)
-
-def _hint_once(room, pid, chose_by_user=False, silent=False, chosen_type=None):
-    opp = 2 if pid == 1 else 1
-    opp_secret = room['secret'][opp]
-    hidden = room['hidden']
-
-    # --- 先にプレビューがあればそれを使う（確認画面と実値の一致を保証） ---
-    pv = room.get('hint_preview', {}).get(pid)
-    if pv:
-        htype = pv.get('type')         # '和' / '差' / '積'
-        shown = pv.get('shown')        # 既にノイズ適用済みの表示値
-        # 在庫（available_hints）をここで消費
-        stock = room['available_hints'][pid]
-        if htype in stock:
-            stock.remove(htype)
-        # 使い終わったのでクリア
-        room['hint_preview'][pid] = None
-        # プレビュー経由でも「種類指定だったか」を反映（学者・後攻指定）
-        chose_by_user = pv.get('chose_by_user', chose_by_user)
-    else:
-        # ここからは従来どおりの決定・計算フロー
-        if chosen_type in ('和','差','積'):
-            htype = chosen_type
-            stock = room['available_hints'][pid]
-            if htype in stock:
-                stock.remove(htype)
-        else:
-            stock = room['available_hints'][pid]
-            if stock:
-                htype = random.choice(stock)
-                stock.remove(htype)
-            else:
-                htype = random.choice(['和','差','積'])
-
-        if htype == '和':
-            val = opp_secret + hidden
-        elif htype == '差':
-            val = abs(opp_secret - hidden)
-        else:
-            val = opp_secret * hidden
-
-        shown = _apply_trickster_noise(room, pid, val)
-
-    # --- ログ：指定があった時だけ種別を表示。ランダムは値のみ ---
-    if not silent:
-        myname = room['pname'][pid]
-        if chose_by_user:
-            push_log(room, f"{myname} が h（ヒント取得）{htype}＝{shown}")
-        else:
-            push_log(room, f"{myname} が h（ヒント取得）＝{shown}")
-    return
-
-def handle_guess(room, pid, guess):
-    opp = 2 if pid == 1 else 1
-    myname = room['pname'][pid]
-    opponent_secret = room['secret'][opp]
-
-    if room['guess_ct'][pid] > 0:
-        push_log(room, "（予想はCT中）")
-        switch_turn(room, pid)
-        return redirect_play_with_pid(get_current_room_id(), pid)
-
-    room['tries'][pid] += 1
-
-    if room['rules'].get('guessflag', True) and room['guess_flag_armed'][opp]:
-        room['guess_flag_armed'][opp] = False
-        push_log(room, f"（{room['pname'][opp]} のゲスフラグが発動！{room['pname'][pid]} は即死）" + fx_markup('flag_boom','ゲスフラ炸裂！'))
-        room['score'][opp] += 1
-        room['winner'] = opp
-        room['turn_serial'] += 1
-        return redirect_end_with_pid(get_current_room_id(), pid)
-
-    if guess == opponent_secret:
-        push_log(room, f"{myname} が g（予想）→ {guess}（正解！相手は即死）" + fx_markup('guess_hit','一撃必殺！'))
-        room['score'][pid] += 1
-        room['winner'] = pid
-        room['turn_serial'] += 1
-        return redirect_end_with_pid(get_current_room_id(), pid)
-
-    kill_vals = set(room['trap_kill'][opp]) if room['rules'].get('trap', True) else set()
-    info = set(room['trap_info'][opp]) if room['rules'].get('trap', True) else set()
-    inst_t, near_t = _kill_thresholds(room, opp)
-
-    if any(abs(guess - k) <= inst_t for k in kill_vals):
-        push_log(room, f"{myname} が g（予想）→ {guess}（killトラップ±{inst_t}命中＝即敗北）" + fx_markup('kill_dead','木っ端微塵！'))
-        room['score'][opp] += 1
-        room['winner'] = opp
-        room['turn_serial'] += 1
-        return redirect_end_with_pid(get_current_room_id(), pid)
-
-    if guess in info:
-        room['pending_view'][opp] = True
-        room['view_cut_index'][opp] = len(room['actions'])
-        push_log(room, f"{myname} が g（予想）→ {guess}（情報トラップ発動）" + fx_markup('info','覗き見タイム！'))
-
-    if any(abs(guess - k) <= near_t for k in kill_vals):
-        set_skip(room, pid)
-        push_log(room, f"{myname} が g（予想）→ {guess}（kill近接±{near_t}命中：次ターンスキップ）" + fx_markup('kill_near','ヒヤッ！'))
-        if room['guess_penalty_active'][pid]:
-            apply_ct(room, pid, 'guess_ct', 1)
-        switch_turn(room, pid)
-        return redirect_play_with_pid(get_current_room_id(), pid)
-
-    push_log(room, f"{myname} が g（予想）→ {guess}（ハズレ）")
-    if room['rules'].get('press', True) and (not room['press_used'][pid]) and (not room['press_pending'][pid]):
-        push_log(room, "（サドン・プレスのチャンス！）" + fx_markup('press_ready','もう一回いく？'))
-        room['press_pending'][pid] = True
-        return redirect_play_with_pid(get_current_room_id(), pid)
-
-    if room['guess_penalty_active'][pid]:
-        apply_ct(room, pid, 'guess_ct', 1)
-    switch_turn(room, pid)
-    return redirect_play_with_pid(get_current_room_id(), pid)
-
-def handle_hint(room, pid, form):
-    myname = room['pname'][pid]
-    opp = 2 if pid == 1 else 1
-
-    if room['hint_ct'][pid] > 0:
-        push_log(room, "（ヒントはCT中）")
-        switch_turn(room, pid)
-        return redirect_play_with_pid(get_current_room_id(), pid)
-
-    want_choose = bool(form.get('confirm_choice'))
-    choose_type = form.get('hint_type')
-
-    if has_role(room, pid, 'Scholar'):
-        want_choose = True
-        if choose_type not in ('和','差','積'):
-            choose_type = random.choice(['和','差','積'])
-
-    if not room['rules'].get('bluff', True):
-        allow_choose_now = want_choose and (has_role(room, pid, 'Scholar') or room['hint_choice_available'][pid]) and choose_type in ('和','差','積')
-        if allow_choose_now and not has_role(room, pid, 'Scholar'):
-            room['hint_choice_available'][pid] = False
-        _hint_once(room, pid, chose_by_user=allow_choose_now, silent=False, chosen_type=choose_type if allow_choose_now else None)
-        # ヒント取得後は常にCT1（学者は例外）。ペナルティ中なら長い方を採用
-        if not has_role(room, pid, 'Scholar'):
-            ct_len = 1
-            if room['hint_penalty_active'][pid]:
-                ct_len = max(ct_len, room.get('hint_penalty_len', {}).get(pid, 1))
-            apply_ct(room, pid, 'hint_ct', ct_len)
-        switch_turn(room, pid)
-        return redirect_play_with_pid(get_current_room_id(), pid)
-
-    decision = form.get('bluff_decision')
-    has_bluff_flag = bool(room['bluff'][opp])
-
-    if not decision:
-        keep = ""
-        if want_choose:
-            keep += "<input type='hidden' name='confirm_choice' value='1'>"
-        if want_choose and choose_type:
-            keep += f"<input type='hidden' name='hint_type' value='{choose_type}'>"
-        if has_bluff_flag:
-            fake = room['bluff'][opp]
-            body = f"""
-<div class="card"><div class="card-header">ヒント（確認）</div><div class="card-body">
-  <p class="h5 mb-3">提示されたヒントの値： <span class="badge bg-warning text-dark">{fake['value']}</span></p>
-  <p class="mb-3">このヒントはブラフだと思いますか？</p>
-  <form method="post" class="d-inline me-2">
-    <input type="hidden" name="action" value="h"><input type="hidden" name="bluff_decision" value="believe">{keep}
-    <button class="btn btn-primary">信じる</button>
-  </form>
-  <form method="post" class="d-inline">
-    <input type="hidden" name="action" value="h"><input type="hidden" name="bluff_decision" value="accuse">{keep}
-    <button class="btn btn-outline-light">ブラフだ！と指摘する</button>
-  </form>
-  <div class="mt-3"><a class="btn btn-outline-light" href="{url_for('play', room_id=get_current_room_id())}">戻る</a></div>
-</div></div>
-"""
-        else:
-            # ここでプレビュー値を計算して保存（決定時に同じ値が出るよう固定）
-            choose_allowed = has_role(room, pid, 'Scholar') or room['hint_choice_available'][pid]
-            allow_choose_now = False
-            if has_role(room, pid, 'Scholar'):
-                # 学者は常に種類指定可能（未指定なら在庫からランダムに後で決定）
-                allow_choose_now = True
-            else:
-                allow_choose_now = bool(want_choose and choose_allowed and choose_type in ('和','差','積'))
-
-            # 実際の種類を決定（指定があればそれ、なければ在庫→無ければランダム）
-            stock = list(room['available_hints'][pid])
-            if allow_choose_now and choose_type in ('和','差','積'):
-                htype = choose_type
-            else:
-                htype = random.choice(stock) if stock else random.choice(['和','差','積'])
-
-            # 値を計算してノイズ適用
-            opp = 2 if pid == 1 else 1
-            opp_secret = room['secret'][opp]
-            hidden = room['hidden']
-            if htype == '和':
-                val = opp_secret + hidden
-            elif htype == '差':
-                val = abs(opp_secret - hidden)
-            else:
-                val = opp_secret * hidden
-            preview_shown = _apply_trickster_noise(room, pid, val)
-
-            # プレビュー保存（_hint_once 側で在庫消費＆ログ出力時に使用）
-            room.setdefault('hint_preview', {1: None, 2: None})
-            room['hint_preview'][pid] = {
-                'type': htype,
-                'shown': preview_shown,
-                'chose_by_user': allow_choose_now
-            }
-
-            body = f"""
-<div class="card"><div class="card-header">ヒント（確認）</div><div class="card-body">
-  <p class="h5 mb-3">提示されたヒントの値： <span class="badge bg-warning text-dark">{preview_shown}</span></p>
-  <p class="mb-3">このヒントはブラフだと思いますか？</p>
-  <form method="post" class="d-inline me-2">
-    <input type="hidden" name="action" value="h"><input type="hidden" name="bluff_decision" value="believe">{keep}
-    <button class="btn btn-primary">信じる（通常のヒントを受け取る）</button>
-  </form>
-  <form method="post" class="d-inline">
-    <input type="hidden" name="action" value="h"><input type="hidden" name="bluff_decision" value="accuse">{keep}
-    <button class="btn btn-outline-light">ブラフだ！と指摘する</button>
-  </form>
-  <div class="mt-3"><a class="btn btn-outline-light" href="{url_for('play', room_id=get_current_room_id())}">戻る</a></div>
-</div></div>
-"""
-        return bootstrap_page("ヒント確認", body)
-
-    if has_bluff_flag:
-        if decision == 'believe':
-            # プレイヤーはブラフを「信じる」→ このターンのヒントは
-            # ブラフの種類・値として扱い、在庫（available_hints）も消費する
-            fake = room['bluff'][opp] or {}
-            ftype = fake.get('type')
-            fval  = fake.get('value')
-            # 在庫から該当種類を消費（存在すれば）
-            stock = room['available_hints'][pid]
-            if ftype in stock:
-                stock.remove(ftype)
-
-            # ログ（ブラフ値として提示されたことを明示）
-            if ftype in ('和','差','積'):
-                push_log(room, f"{myname} は 提示ヒント（{fval}）を受け入れた → h（ヒント取得）{ftype}＝{fval}")
-            else:
-                # 種類が不明/異常でも値は表示（安全側）
-                push_log(room, f"{myname} は 提示ヒント（{fval}）を受け入れた → h（ヒント取得）＝{fval}")
-
-            # ブラフは消費
-            room['bluff'][opp] = None
-
-            # ヒント受領扱い：常にCT1（学者は例外）。ペナルティ中なら長い方を採用
-            if not has_role(room, pid, 'Scholar'):
-                ct_len = 1
-                if room['hint_penalty_active'][pid]:
-                    ct_len = max(ct_len, room.get('hint_penalty_len', {}).get(pid, 1))
-                apply_ct(room, pid, 'hint_ct', ct_len)
-            switch_turn(room, pid)
-            return redirect_play_with_pid(get_current_room_id(), pid)
-        else:
-            push_log(room, f"{myname} は ブラフだ！と指摘 → 見破った！本物ヒント×2" + fx_markup('bluff_ok','見抜いた！'))
-            _hint_once(room, pid, chose_by_user=False, silent=False, chosen_type=None)
-            _hint_once(room, pid, chose_by_user=False, silent=False, chosen_type=None)
-            room['bluff'][opp] = None
-            # 本物ヒント×2後：常にCT1（学者は例外）。ペナルティ中なら長い方を採用
-            if not has_role(room, pid, 'Scholar'):
-                ct_len = 1
-                if room['hint_penalty_active'][pid]:
-                    ct_len = max(ct_len, room.get('hint_penalty_len', {}).get(pid, 1))
-                apply_ct(room, pid, 'hint_ct', ct_len)
-            switch_turn(room, pid)
-            return redirect_play_with_pid(get_current_room_id(), pid)
-    else:
-        if decision == 'accuse':
-            room['hint_penalty_active'][pid] = True
-            room.setdefault('hint_penalty_len', {1:1, 2:1})
-            if has_role(room, opp, 'Trickster'):
-                room['hint_penalty_len'][pid] = 2
-                push_log(room, f"{myname} は ブラフだ！と指摘したが外れ（以後ヒント取得後はCT2）" + fx_markup('bluff_ng','ぐぬぬ…'))
-            else:
-                room['hint_penalty_len'][pid] = 1
-                push_log(room, f"{myname} は ブラフだ！と指摘したが外れ（以後ヒント取得後はCT1）" + fx_markup('bluff_ng','ぐぬぬ…'))
-            # 直後の処理：ヒント行動としてCTを付与し、ターンを進める（学者はCT無効）
-            if not has_role(room, pid, 'Scholar'):
-                ct_len = max(1, room.get('hint_penalty_len', {}).get(pid, 1))
-                apply_ct(room, pid, 'hint_ct', ct_len)
-            switch_turn(room, pid)
-            return redirect_play_with_pid(get_current_room_id(), pid)
-            room['hint_preview'][pid] = None
-            # ブラフ指摘失敗でも、次の自分のヒントは最低CT1（学者以外）
-            if not has_role(room, pid, 'Scholar'):
-                ct_len = max(1, room.get('hint_penalty_len', {}).get(pid, 1))
-                apply_ct(room, pid, 'hint_ct', ct_len)
-            switch_turn(room, pid)
-            return redirect_play_with_pid(get_current_room_id(), pid)
-        else:
-            allow_choose_now = (has_role(room, pid, 'Scholar') or (want_choose and room['hint_choice_available'][pid])) and choose_type in ('和','差','積')
-            if allow_choose_now and not has_role(room, pid, 'Scholar'):
-                room['hint_choice_available'][pid] = False
-            _hint_once(room, pid, chose_by_user=allow_choose_now, silent=False, chosen_type=choose_type if allow_choose_now else None)
-            # ヒント取得後は常にCT1（学者は例外）。ペナルティ中なら長い方を採用
-            if not has_role(room, pid, 'Scholar'):
-                ct_len = 1
-                if room['hint_penalty_active'][pid]:
-                    ct_len = max(ct_len, room.get('hint_penalty_len', {}).get(pid, 1))
-                apply_ct(room, pid, 'hint_ct', ct_len)
-            switch_turn(room, pid)
-            return redirect_play_with_pid(get_current_room_id(), pid)
-
-def handle_change(room, pid, new_secret):
-    myname = room['pname'][pid]
-    if room['cooldown'][pid] > 0:
-        push_log(room, "（自分の数の変更はCT中）")
-        switch_turn(room, pid)
-        return redirect_play_with_pid(get_current_room_id(), pid)
-    my_traps = set(room['trap_kill'][pid]) | set(room['trap_info'][pid])
-    if new_secret in my_traps:
-        push_log(room, "⚠ その数字は現在のトラップに含まれています。別の数字を選んでください。")
-        switch_turn(room, pid)
-        return redirect_play_with_pid(get_current_room_id(), pid)
-    if not (room['eff_num_min'] <= new_secret <= room['eff_num_max']):
-        push_log(room, "⚠ 範囲外の数字です。")
-        switch_turn(room, pid)
-        return redirect_play_with_pid(get_current_room_id(), pid)
-    limit = 3 if has_role(room, pid, 'Tuner') else 2
-    ct = 5 if has_role(room, pid, 'Tuner') else 7
-    if room['change_used'][pid] >= limit:
-        push_log(room, f"（このラウンドでの自分の数の変更は{limit}回まで）")
-        switch_turn(room, pid)
-        return redirect_play_with_pid(get_current_room_id(), pid)
-
-    room['secret'][pid] = new_secret
-    room['cooldown'][pid] = ct
-    room['change_used'][pid] += 1
-
-    room['decl1_value'][pid] = None
-    room['decl1_resolved'][pid] = True
-    room['decl1_used'][pid] = False
-    room['info_free_per_turn'][pid] = 1
-    room['info_max'][pid] = INFO_MAX_DEFAULT
-    room['info_free_used_this_turn'][pid] = min(room['info_free_used_this_turn'][pid], room['info_free_per_turn'][pid])
-
-    opp = 2 if pid == 1 else 1
-    room['available_hints'][opp] = ['和','差','積']
-
-    push_log(room, f"{myname} が c（自分の数を変更）→ {new_secret}" + fx_markup('change','入れ替え！'))
-    push_log(room, f"（宣言効果リセット：無料info/ターン=1、上限={INFO_MAX_DEFAULT}。再宣言可）")
-    switch_turn(room, pid)
-    return redirect_play_with_pid(get_current_room_id(), pid)
-
-def handle_trap_kill(room, pid, form):
-    if not room['rules'].get('trap', True):
-        return push_and_back(room, pid, "（このルームではトラップは無効です）")
-    myname = room['pname'][pid]
-    eff_min, eff_max = room['eff_num_min'], room['eff_num_max']
-    my_secret = room['secret'][pid]
-    v = form.get('trap_kill_value')
-    try:
-        x = int(v)
-    except Exception:
-        push_log(room, "⚠ 無効なkillトラップ値です。")
-        switch_turn(room, pid)
-        return redirect_play_with_pid(get_current_room_id(), pid)
-    if not (eff_min <= x <= eff_max) or x == my_secret or (room['allow_negative'] and abs(x) == abs(my_secret)):
-        push_log(room, "⚠ 無効なkillトラップ値です。")
-        switch_turn(room, pid)
-        return redirect_play_with_pid(get_current_room_id(), pid)
-    room['trap_kill'][pid].clear()
-    room['trap_kill'][pid].append(x)
-    push_log(room, f"{myname} が killトラップを {x} に設定")
-    switch_turn(room, pid)
-    return redirect_play_with_pid(get_current_room_id(), pid)
-
-def handle_trap_info(room, pid, form):
-    if not room['rules'].get('trap', True):
-        return push_and_back(room, pid, "（このルームではトラップは無効です）")
-    myname = room['pname'][pid]
-    eff_min, eff_max = room['eff_num_min'], room['eff_num_max']
-    my_secret = room['secret'][pid]
-
-    max_allowed = get_info_max(room, pid)
-    free_cap = room['info_free_per_turn'][pid]
-    free_used = room['info_free_used_this_turn'][pid]
-
-    bulk = form.get('info_bulk') in ('1', 'on', 'true', 'True')
-
-    if bulk:
-        candidates = ('trap_info_value', 'trap_info_value_1', 'trap_info_value_2', 'trap_info_val')
-        added_list = []
-        for key in candidates:
-            v = form.get(key)
-            if not v:
-                continue
-            try:
-                x = int(v)
-            except Exception:
-                continue
-            if not (eff_min <= x <= eff_max):
-                continue
-            if x == my_secret or (room['allow_negative'] and abs(x) == abs(my_secret)):
-                continue
-            if x in room['trap_info'][pid] or x in added_list:
-                continue
-            if len(room['trap_info'][pid]) >= max_allowed:
-                break
-            added_list.append(x)
-
-        if added_list:
-            room['trap_info'][pid].extend(added_list)
-            push_log(room, f"{myname} が infoトラップをまとめて設定 → {', '.join(map(str, added_list))}（ターン消費）")
-            switch_turn(room, pid)
-        else:
-            push_log(room, "⚠ infoトラップの追加はありません。")
-        return redirect_play_with_pid(get_current_room_id(), pid)
-
-    if free_used >= free_cap:
-        push_log(room, f"（このターンの無料infoは上限 {free_cap} 個に達しています）")
-        return redirect_play_with_pid(get_current_room_id(), pid)
-
-    candidates = ('trap_info_value', 'trap_info_value_1', 'trap_info_value_2', 'trap_info_val')
-    added = None
-    for key in candidates:
-        v = form.get(key)
-        if not v:
-            continue
-        try:
-            x = int(v)
-        except Exception:
-            continue
-        if not (eff_min <= x <= eff_max):
-            continue
-        if x == my_secret or (room['allow_negative'] and abs(x) == abs(my_secret)):
-            continue
-        if x in room['trap_info'][pid]:
-            continue
-        if len(room['trap_info'][pid]) >= max_allowed:
-            push_log(room, f"（infoは最大{max_allowed}個までです）")
-            return redirect_play_with_pid(get_current_room_id(), pid)
-        added = x
-        break
-
-    if added is not None:
-        room['trap_info'][pid].append(added)
-        room['info_free_used_this_turn'][pid] += 1
-        left = max(0, free_cap - room['info_free_used_this_turn'][pid])
-        push_log(room, f"{myname} が infoトラップを {added} に設定（ターン消費なし／このターンはあと {left} 個）")
-    else:
-        push_log(room, "⚠ infoトラップの追加はありません。")
-    return redirect_play_with_pid(get_current_room_id(), pid)
-
-def handle_trap(room, pid, form):
-    if not room['rules'].get('trap', True):
-        return push_and_back(room, pid, "（このルームではトラップは無効です）")
-
-    myname = room['pname'][pid]
-    eff_min, eff_max = room['eff_num_min'], room['eff_num_max']
-    my_secret = room['secret'][pid]
-
-    turn_consumed = False
-
-    bulk = form.get('info_bulk') in ('1', 'on', 'true', 'True')
-    info_keys = ('trap_info_value', 'trap_info_value_1', 'trap_info_value_2', 'trap_info_val')
-    info_inputs = []
-    for k in info_keys:
-        v = form.get(k)
-        if v is None or v == '':
-            continue
-        try:
-            x = int(v)
-        except Exception:
-            continue
-        info_inputs.append(x)
-
-    info_inputs_unique = []
-    for x in info_inputs:
-        if x not in info_inputs_unique:
-            info_inputs_unique.append(x)
-
-    max_allowed = get_info_max(room, pid)
-    free_cap   = room['info_free_per_turn'][pid]
-    free_used  = room['info_free_used_this_turn'][pid]
-
-    if bulk and info_inputs_unique:
-        added_bulk = []
-        for x in info_inputs_unique:
-            if not (eff_min <= x <= eff_max):
-                continue
-            if x == my_secret or (room['allow_negative'] and abs(x) == abs(my_secret)):
-                continue
-            if x in room['trap_info'][pid] or x in added_bulk:
-                continue
-            if len(room['trap_info'][pid]) >= max_allowed:
-                break
-            added_bulk.append(x)
-        if added_bulk:
-            room['trap_info'][pid].extend(added_bulk)
-            push_log(room, f"{myname} が infoトラップをまとめて設定 → {', '.join(map(str, added_bulk))}（ターン消費）")
-            turn_consumed = True
-        else:
-            push_log(room, "⚠ infoトラップの追加はありません。")
-
-    if (not bulk) and info_inputs_unique:
-        remain = max(0, free_cap - free_used)
-        added_free = []
-        for x in info_inputs_unique:
-            if remain <= 0:
-                break
-            if not (eff_min <= x <= eff_max):
-                continue
-            if x == my_secret or (room['allow_negative'] and abs(x) == abs(my_secret)):
-                continue
-            if x in room['trap_info'][pid] or x in added_free:
-                continue
-            if len(room['trap_info'][pid]) >= max_allowed:
-                break
-            room['trap_info'][pid].append(x)
-            added_free.append(x)
-            remain -= 1
-        if added_free:
-            room['info_free_used_this_turn'][pid] += len(added_free)
-            left = max(0, free_cap - room['info_free_used_this_turn'][pid])
-            push_log(room, f"{myname} が infoトラップを {', '.join(map(str, added_free))} に設定（ターン消費なし／このターンはあと {left} 個）")
-        else:
-            if free_cap - free_used <= 0:
-                push_log(room, f"（このターンの無料infoは上限 {free_cap} 個に達しています）")
-            else:
-                push_log(room, "⚠ infoトラップの追加はありません。")
-
-    kill_v = form.get('trap_kill_value')
-    if kill_v is not None and kill_v != '':
-        try:
-            kx = int(kill_v)
-        except Exception:
-            kx = None
-        if kx is None or not (eff_min <= kx <= eff_max) or kx == my_secret or (room['allow_negative'] and abs(kx) == abs(my_secret)):
-            push_log(room, "⚠ 無効なkillトラップ値です。")
-        else:
-            room['trap_kill'][pid].clear()
-            room['trap_kill'][pid].append(kx)
-            push_log(room, f"{myname} が killトラップを {kx} に設定")
-            turn_consumed = True
-
-    if turn_consumed:
-        switch_turn(room, pid)
-    return redirect_play_with_pid(get_current_room_id(), pid)
-
-def handle_bluff(room, pid, form):
-    if not room['rules'].get('bluff', True):
-        return push_and_back(room, pid, "（このルームではブラフヒントは無効です）")
-    myname = room['pname'][pid]
-    btype = form.get('bluff_type') or '和'
-    try:
-        bval = int(form.get('bluff_value'))
-    except:
-        push_log(room, "⚠ ブラフ値が不正です。")
-        switch_turn(room, pid)
-        return redirect_play_with_pid(get_current_room_id(), pid)
-    room['bluff'][pid] = {'type': btype, 'value': bval}
-    push_log(room, f"{myname} が ブラフヒント を仕掛けた")
-    switch_turn(room, pid)
-    return redirect_play_with_pid(get_current_room_id(), pid)
-
-def handle_guessflag(room, pid):
-    if not room['rules'].get('guessflag', True):
-        return push_and_back(room, pid, "（このルームではゲスフラグは無効です）")
-    myname = room['pname'][pid]
-    if room['guess_flag_used'][pid]:
-        push_log(room, "⚠ このラウンドでは既にゲスフラグを使っています。")
-        switch_turn(room, pid)
-        return redirect_play_with_pid(get_current_room_id(), pid)
-    room['guess_flag_armed'][pid] = True
-    room['guess_flag_used'][pid] = True
-    push_log(room, f"{myname} が ゲスフラグ を立てた" + fx_markup('ping'))
-    switch_turn(room, pid)
-    return redirect_play_with_pid(get_current_room_id(), pid)
-
-def handle_decl1(room, pid, form):
-    if not room['rules'].get('decl1', True):
-        return push_and_back(room, pid, "（このルームでは一の位の宣言は無効です）")
-    myname = room['pname'][pid]
-    if room['decl1_used'][pid]:
-        return push_and_back(room, pid, "（このラウンドは既に宣言しています）")
-    d = get_int(form, 'decl1_digit', default=None, min_v=0, max_v=9)
-    if d is None:
-        return push_and_back(room, pid, "⚠ 一の位は0〜9で入力してください。")
-    room['decl1_value'][pid] = d
-    room['decl1_used'][pid] = True
-    room['decl1_resolved'][pid] = False
-    room['info_free_per_turn'][pid] = 2
-    room['info_max'][pid] = 10
-    push_log(room, f"{myname} が 一の位を {d} と宣言（このラウンド中、無料infoは1ターン2個・最大10個）" + fx_markup('decl','宣言ッ！'))
-    opp = 2 if pid == 1 else 1
-    push_log(room, f"{room['pname'][opp]} への通知: {myname} が秘密の数字の一の位が {d} であると宣言した")
-    return redirect_play_with_pid(get_current_room_id(), pid)
-
-def handle_decl1_challenge(room, pid):
-    if not room['rules'].get('decl1', True):
-        return push_and_back(room, pid, "（このルームでは一の位の宣言は無効です）")
-
-    myname = room['pname'][pid]
-    opp = 2 if pid == 1 else 1
-
-    # 相手が宣言していない／既に決着済みならチャレンジ不可
-    if room['decl1_value'][opp] is None or room['decl1_resolved'][opp]:
-        return push_and_back(room, pid, "（相手の宣言は現在チャレンジできません）")
-
-    # 真値（一の位）と宣言値を比較
-    true_ones = abs(room['secret'][opp]) % 10
-    declared = room['decl1_value'][opp]
-
-    if declared != true_ones:
-        # 成功：正しい一の位を公開し、直後に無料予想権を付与（ターンは維持）
-        push_log(room, f"{myname} が『嘘だ！』→ 成功。正しい一の位は {true_ones}" + fx_markup('bluff_ok','見破った！'))
-        room['decl1_resolved'][opp] = True
-        room['free_guess_pending'][pid] = True
-        return redirect_play_with_pid(get_current_room_id(), pid)
-    else:
-        # 失敗：次ターンスキップ（番人なら1回だけ自動無効化）、ターン交代
-        push_log(room, f"{myname} が『嘘だ！』→ 失敗（宣言は真だった）" + fx_markup('bluff_ng','ぐぬぬ…'))
-        room['decl1_resolved'][opp] = True
-        set_skip(room, pid)
-        switch_turn(room, pid)
-        return redirect_play_with_pid(get_current_room_id(), pid)
-
-def handle_press(room, pid, press_val):
-    """サドン・プレス：ハズレ直後に同ターンでもう1回だけ予想。当たれば勝利、外せば次ターンスキップ。"""
-    if not room['rules'].get('press', True):
-        return push_and_back(room, pid, "（このルームではサドン・プレスは無効です）")
-    if not room['press_pending'][pid]:
-        return push_and_back(room, pid, "（サドン・プレスは現在使用できません）")
-
-    myname = room['pname'][pid]
-    opp = 2 if pid == 1 else 1
-    opponent_secret = room['secret'][opp]
-
-    # 今回のプレス消費
-    room['press_pending'][pid] = False
-    room['press_used'][pid] = True
-
-    # プレスでも通常の予想としてカウント
-    room['tries'][pid] += 1
-
-    # 成功：即勝利
-    if press_val == opponent_secret:
-        push_log(room, f"{myname} が サドン・プレス → {press_val}（正解！相手は即死）" + fx_markup('guess_hit','一撃必殺！'))
-        room['score'][pid] += 1
-        room['winner'] = pid
-        room['turn_serial'] += 1
-        return redirect_end_with_pid(get_current_room_id(), pid)
-
-    # トラップ処理（ゲスフラグは同ターンなので発動対象外）
-    kill_vals = set(room['trap_kill'][opp]) if room['rules'].get('trap', True) else set()
-    info_vals = set(room['trap_info'][opp]) if room['rules'].get('trap', True) else set()
-    inst_t, near_t = _kill_thresholds(room, opp)
-
-    # 即死
-    if any(abs(press_val - k) <= inst_t for k in kill_vals):
-        push_log(room, f"{myname} が サドン・プレス → {press_val}（killトラップ±{inst_t}命中＝即敗北）" + fx_markup('kill_dead','木っ端微塵！'))
-        room['score'][opp] += 1
-        room['winner'] = opp
-        room['turn_serial'] += 1
-        return redirect_end_with_pid(get_current_room_id(), pid)
-
-    # info
-    if press_val in info_vals:
-        room['pending_view'][opp] = True
-        room['view_cut_index'][opp] = len(room['actions'])
-        push_log(room, f"{myname} が サドン・プレス → {press_val}（情報トラップ発動）" + fx_markup('info','覗き見タイム！'))
-
-    # 失敗：必ず次ターンスキップ
-    push_log(room, f"{myname} が サドン・プレス → {press_val}（ハズレ：次ターンスキップ）" + fx_markup('press_miss','ガーン…'))
-    set_skip(room, pid)
-    switch_turn(room, pid)
-    return redirect_play_with_pid(get_current_room_id(), pid)
-
-def handle_press_skip(room, pid):
-    """サドン・プレス権を放棄して通常のターン交代へ。"""
-    if not room['rules'].get('press', True):
-        return push_and_back(room, pid, "（このルームではサドン・プレスは無効です）")
-    if not room['press_pending'][pid]:
-        return push_and_back(room, pid, "（サドン・プレス待機はありません）")
-
-    myname = room['pname'][pid]
-    room['press_pending'][pid] = False
-    room['press_used'][pid] = True
-    push_log(room, f"{myname} は サドン・プレスを見送った")
-    switch_turn(room, pid)
-    return redirect_play_with_pid(get_current_room_id(), pid)
-
-def handle_free_guess(room, pid, val):
-    """嘘だ！成功後の無料予想。
-    - ターン消費なし（自分のターンのまま）
-    - ゲスフラグ無効
-    - kill/info/近接は有効
-    - CT/サドン・プレスは発生させない
-    """
-    opp = 2 if pid == 1 else 1
-    myname = room['pname'][pid]
-    opponent_secret = room['secret'][opp]
-
-    # 1回限りの無料予想フラグを消費
-    room['free_guess_pending'][pid] = False
-
-    # 正解：その場で勝利
-    if val == opponent_secret:
-        push_log(room, f"{myname} が 無料予想 → {val}（正解！相手は即死）" + fx_markup('guess_hit','一撃必殺！'))
-        room['score'][pid] += 1
-        room['winner'] = pid
-        room['turn_serial'] += 1
-        return redirect_end_with_pid(get_current_room_id(), pid)
-
-    # ゲスフラグは発動しない（チェック自体を行わない）
-
-    # トラップ（kill/info/近接）は有効
-    kill_vals = set(room['trap_kill'][opp]) if room['rules'].get('trap', True) else set()
-    info_vals = set(room['trap_info'][opp]) if room['rules'].get('trap', True) else set()
-    inst_t, near_t = _kill_thresholds(room, opp)
-
-    # 即死
-    if any(abs(val - k) <= inst_t for k in kill_vals):
-        push_log(room, f"{myname} が 無料予想 → {val}（killトラップ±{inst_t}命中＝即敗北）" + fx_markup('kill_dead','木っ端微塵！'))
-        room['score'][opp] += 1
-        room['winner'] = opp
-        room['turn_serial'] += 1
-        return redirect_end_with_pid(get_current_room_id(), pid)
-
-    # 情報
-    if val in info_vals:
-        room['pending_view'][opp] = True
-        room['view_cut_index'][opp] = len(room['actions'])
-        push_log(room, f"{myname} が 無料予想 → {val}（情報トラップ発動）" + fx_markup('info','覗き見タイム！'))
-
-    # 近接（次ターンスキップ付与）。ターンは切り替えない。
-    if any(abs(val - k) <= near_t for k in kill_vals):
-        set_skip(room, pid)
-        push_log(room, f"{myname} が 無料予想 → {val}（kill近接±{near_t}命中：次ターンスキップ）" + fx_markup('kill_near','ヒヤッ！'))
-        return redirect_play_with_pid(get_current_room_id(), pid)
-
-    # 通常ハズレ：ターンは維持（CTやプレスも発生させない）
-    push_log(room, f"{myname} が 無料予想 → {val}（ハズレ）")
-    return redirect_play_with_pid(get_current_room_id(), pid)
-
-def handle_yn(room, pid, form):
-    """Yes/No 質問（ターン消費なし）。分析屋はラウンド3回まで、CT2。同一ターン連打不可。"""
-    if not room['rules'].get('yn', True):
-        return push_and_back(room, pid, "（このルームではYes/No質問は無効です）")
-
-    myname = room['pname'][pid]
-    opp = 2 if pid == 1 else 1
-    secret = room['secret'][opp]
-
-    # 使用回数・CT制御
-    cap = 3 if has_role(room, pid, 'Analyst') else 1
-    if room['yn_used_count'][pid] >= cap:
-        return push_and_back(room, pid, f"（このラウンドのYes/Noは上限 {cap} 回です）")
-    if has_role(room, pid, 'Analyst'):
-        # 連打防止：同一ターンでの連投禁止
-        if room['yn_last_tick'][pid] == room['tick']:
-            return push_and_back(room, pid, "（同一ターンでの連続質問はできません）")
-        if room['yn_ct'][pid] > 0:
-            return push_and_back(room, pid, "（Yes/NoはCT中です）")
-
-    qtype = form.get('yn_type', 'ge')
-    x = get_int(form, 'yn_x', None, room['eff_num_min'], room['eff_num_max'])
-    a = get_int(form, 'yn_a', None, room['eff_num_min'], room['eff_num_max'])
-    b = get_int(form, 'yn_b', None, room['eff_num_min'], room['eff_num_max'])
-
-    # 質問評価
-    ans = None
-    desc = ""
-    if qtype == 'ge' and x is not None:
-        ans = (secret >= x); desc = f"≥ {x}"
-    elif qtype == 'le' and x is not None:
-        ans = (secret <= x); desc = f"≤ {x}"
-    elif qtype == 'eq' and x is not None:
-        ans = (secret == x); desc = f"= {x}"
-    elif qtype == 'between' and (a is not None and b is not None):
-        lo, hi = (a, b) if a <= b else (b, a)
-        ans = (lo <= secret <= hi); desc = f"[{lo}, {hi}] 内"
-    else:
-        return push_and_back(room, pid, "⚠ 質問の入力が不正です。")
-
-    res = "Yes" if ans else "No"
-    push_log(room, f"{myname} が Yes/No 質問 → 「{desc}？」：{res}")
-
-    # 消費
-    room['yn_used_count'][pid] += 1
-    room['yn_last_tick'][pid] = room['tick']
-    if has_role(room, pid, 'Analyst'):
-        room['yn_ct'][pid] = 2
-
-    # ターンは維持（消費なし）
-    return redirect_play_with_pid(get_current_room_id(), pid)
-
-def _devotion_candidates(room, pid):
-    """献身の候補ロールを2つ返す（自分の main/extra と重複しないように）。"""
-    owned = {room['role_main'][pid], room['role_extra'][pid]}
-    pool = [k for k in ROLES.keys() if k not in owned]
-    if len(pool) >= 2:
-        c1 = random.choice(pool); pool.remove(c1)
-        c2 = random.choice(pool)
-        return [c1, c2]
-    # 足りない場合は重複を許すが、極力1個は別種を返す
-    if len(pool) == 1:
-        return [pool[0], pool[0]]
-    # すべて埋まっている（理論上起きにくい）：とりあえず任意2種
-    keys = list(ROLES.keys())
-    return random.sample(keys, 2)
-
-def handle_devotion_offer(room, pid):
-    """献身：候補を2つ提示（説明付き）。決定は handle_devotion_pick へ。"""
-    if not (room['rules'].get('devotion', True) and room['rules'].get('roles', True)):
-        return push_and_back(room, pid, "（このルームでは献身は無効です）")
-    if room['devotion_used'][pid]:
-        return push_and_back(room, pid, "（このラウンドでは既に献身を使っています）")
-
-    # 候補生成＆保存
-    cand = _devotion_candidates(room, pid)
-    room['devotion_offers'][pid] = cand
-
-    myname = room['pname'][pid]
-    # UI：2択と説明を表示
-    options_html = ""
-    for code in cand:
-        options_html += f"""
-        <div class="p-2 rounded border border-secondary mb-2">
-          <div class="h6 m-0"><span class="badge bg-secondary">{ROLES[code]}</span> <span class="small text-muted">（{code}）</span></div>
-          <div class="small text-muted">— {role_desc(code)}</div>
-          <form method="post" class="mt-2">
-            <input type="hidden" name="action" value="devotion_pick">
-            <input type="hidden" name="pick" value="{code}">
-            <button class="btn btn-outline-light w-100">このロールを選ぶ</button>
-          </form>
-        </div>
-        """
-
-    body = f"""
-<div class="card"><div class="card-header">二重職：献身（{myname}）</div><div class="card-body">
-  <p class="mb-2">追加で1ロールを獲得します（このラウンド限定）。代償として <code>今ターン終了</code>、さらに <code>g/h にCT1</code>、加えて <code>info上限-2</code>（このラウンド中）。</p>
-  <div class="row"><div class="col-12 col-md-8">{options_html}</div></div>
-  <div class="mt-3"><a class="btn btn-outline-light" href="{url_for('play', room_id=get_current_room_id())}">戻る</a></div>
-</div></div>
-"""
-    return bootstrap_page("献身の選択", body)
-
-def handle_devotion_pick(room, pid, pick):
-    # 献身：候補2から1つ取得し、代償を適用（今ターン終了／g&hにCT1／info上限-2）
-    if not (room['rules'].get('devotion', True) and room['rules'].get('roles', True)):
-        return push_and_back(room, pid, "（このルームでは献身は無効です）")
-
-    offers = room['devotion_offers'].get(pid)
-    if not offers or pick not in offers:
-        return push_and_back(room, pid, "⚠ 献身の選択肢が有効ではありません。")
-
-    # 取得
-    room['role_extra'][pid] = pick
-    room['devotion_offers'][pid] = None
-    room['devotion_used'][pid] = True
-    push_log(room, f"{room['pname'][pid]} が 献身として『{role_label(pick)}』を獲得 — {role_desc(pick)}")
-
-    # 代償：g/h の CT を最低1に引き上げ、info 上限 -2（get_info_max で反映）
-    room['guess_penalty_active'][pid] = True
-    room['hint_penalty_active'][pid] = True
-    room.setdefault('hint_penalty_len', {1:1, 2:1})
-    room['hint_penalty_len'][pid] = max(room['hint_penalty_len'][pid], 1)
-    room['devotion_info_penalty'][pid] = 2
-    push_log(room, "（献身の代償：このターン終了／g&hにCT1／info上限-2）")
-
-    # 今ターン終了
-    switch_turn(room, pid)
-    return redirect_play_with_pid(get_current_room_id(), pid)
-
 # （オプション）直接実行時の起動
 if __name__ == "__main__":
     # 環境変数でポート／デバッグ制御（無指定なら 5000 / True）
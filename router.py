@@ -0,0 +1,144 @@
+# router.py
+# ルーム番号で振り分けるフロントルーター（シャーディングモード）。
+# 共有ストア（ROOM_STORE=sqlite:///...）の代わりに、SHARD_COUNT 個の number:app を別プロセスで
+# 立て、各プロセスは 整数化したルーム番号 % SHARD_COUNT == SHARD_INDEX の番号だけを払い出す。
+# ルームの状態は各プロセスのメモリに置いたまま、ルーム数に比例してコアを使える。
+#   /room/<id>・/play/<id>・/poll/<id>・/api/rooms/<id>/… など番号を含む URL → 担当シャード
+#   /room?room_id=<id>                                                    → 担当シャード
+#   それ以外（/・/create_room・/static/…）                                → 順番に回す
+# 使い方（Procfile の web をこれに替える）:
+#   web: python router.py
+# 環境変数: PORT, SHARD_COUNT(既定 2), SHARD_BASE_PORT(既定 9100),
+#           SHARD_THREADS(既定 64), ROUTER_THREADS(既定 128),
+#           ROOM_ID_LENGTH / ROOM_ID_ALPHABET（number.py と同じ値がシャードにも渡る）
+import os, sys, re, time, signal, itertools, threading, subprocess, http.client
+from urllib.parse import parse_qs
+
+from number import room_shard, normalize_room_id
+
+SHARD_COUNT = max(1, int(os.environ.get("SHARD_COUNT", "2")))
+SHARD_BASE_PORT = int(os.environ.get("SHARD_BASE_PORT", "9100"))
+SHARD_HOST = "127.0.0.1"
+BACKEND_TIMEOUT = 120
+# 送り終えた後に失敗しても張り直して送り直してよいメソッド（それ以外は二重に適用され得る）
+RETRY_METHODS = frozenset(('GET', 'HEAD'))
+
+ROOM_PATH = re.compile(r"^/(?:room|play|poll|log|events|end|next|finish|join|set_secret|api/rooms)/([^/]+)")
+# 転送しないヘッダ（hop-by-hop）
+HOP_HEADERS = frozenset(('connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+                         'te', 'trailers', 'transfer-encoding', 'upgrade'))
+
+_rr = itertools.count()
+_local = threading.local()
+
+def pick_shard(path, query):
+    m = ROOM_PATH.match(path)
+    rid = normalize_room_id(m.group(1) if m else (parse_qs(query).get('room_id') or [''])[0])
+    shard = room_shard(rid, SHARD_COUNT) if rid else None
+    return next(_rr) % SHARD_COUNT if shard is None else shard
+
+def backend(shard, fresh=False):
+    """スレッドごとに各シャードへの keep-alive 接続を1本持つ"""
+    conns = _local.__dict__.setdefault('conns', {})
+    conn = conns.get(shard)
+    if conn is None or fresh:
+        if conn is not None:
+            conn.close()
+        conn = conns[shard] = http.client.HTTPConnection(SHARD_HOST, SHARD_BASE_PORT + shard,
+                                                         timeout=BACKEND_TIMEOUT)
+    return conn
+
+def forward_headers(environ):
+    headers = {}
+    for k, v in environ.items():
+        if k.startswith('HTTP_'):
+            name = k[5:].replace('_', '-').title()
+            if name.lower() not in HOP_HEADERS:
+                headers[name] = v
+    for k in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+        if environ.get(k):
+            headers[k.replace('_', '-').title()] = environ[k]
+    peer = environ.get('REMOTE_ADDR')
+    if peer:
+        prior = headers.get('X-Forwarded-For')
+        headers['X-Forwarded-For'] = f"{prior}, {peer}" if prior else peer
+    return headers
+
+def relay(conn, resp):
+    """本文を届いた分ずつ流す（SSE・ラウンド結果の逐次出力もそのまま通る）"""
+    done = False
+    try:
+        while True:
+            chunk = resp.read1(65536)
+            if not chunk:
+                done = True
+                return
+            yield chunk
+    finally:
+        resp.close()
+        if not done:
+            # 途中で切れた接続は使い回さない
+            conn.close()
+
+def app(environ, start_response):
+    path = environ.get('PATH_INFO') or '/'
+    query = environ.get('QUERY_STRING', '')
+    shard = pick_shard(path, query)
+    length = int(environ.get('CONTENT_LENGTH') or 0)
+    body = environ['wsgi.input'].read(length) if length else None
+    url = path + ('?' + query if query else '')
+    headers = forward_headers(environ)
+    method = environ['REQUEST_METHOD']
+    resp = None
+    for attempt in (0, 1):
+        conn = backend(shard, fresh=attempt > 0)
+        sent = False
+        try:
+            conn.request(method, url, body=body, headers=headers)
+            sent = True
+            resp = conn.getresponse()
+            break
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            # keep-alive が切れていたら1回だけ張り直す。送り終えた後の失敗（応答待ちのタイムアウト等）は
+            # シャード側で処理済みかもしれないので、GET/HEAD 以外は送り直さない
+            if sent and method not in RETRY_METHODS:
+                break
+    if resp is None:
+        start_response('502 Bad Gateway', [('Content-Type', 'text/plain; charset=utf-8')])
+        return [f"shard {shard} unavailable".encode()]
+    start_response(f"{resp.status} {resp.reason}",
+                   [(k, v) for k, v in resp.getheaders() if k.lower() not in HOP_HEADERS])
+    return relay(conn, resp)
+
+def gunicorn_cmd(bind, module, threads):
+    return [sys.executable, '-m', 'gunicorn', '-w', '1', '-k', 'gthread', '--threads', str(threads),
+            '-b', bind, module]
+
+def main():
+    here = os.path.dirname(os.path.abspath(__file__))
+    port = os.environ.get("PORT", "8000")
+    procs = []
+    for i in range(SHARD_COUNT):
+        env = dict(os.environ, SHARD_INDEX=str(i), SHARD_COUNT=str(SHARD_COUNT))
+        procs.append(subprocess.Popen(
+            gunicorn_cmd(f"{SHARD_HOST}:{SHARD_BASE_PORT + i}", 'number:app', os.environ.get("SHARD_THREADS", "64")),
+            cwd=here, env=env))
+    procs.append(subprocess.Popen(
+        gunicorn_cmd(f"0.0.0.0:{port}", 'router:app', os.environ.get("ROUTER_THREADS", "128")), cwd=here))
+
+    def stop(*_):
+        for p in procs:
+            if p.poll() is None:
+                p.terminate()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    # どれか1つでも落ちたら全体を止める（再起動はプラットフォーム側に任せる）
+    while all(p.poll() is None for p in procs):
+        time.sleep(1)
+    stop()
+    for p in procs:
+        p.wait()
+
+if __name__ == '__main__':
+    main()
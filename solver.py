@@ -0,0 +1,305 @@
+# solver.py
+# 相手の秘密の数の候補をビット集合で持つソルバ（ボット・ヒント補助・集計用）。
+# 候補は (相手の数 s, 隠し数 h) の組で、ビット番号 = (s - eff_num_min) * 隠し数の幅 + (h - eff_hidden_min)。
+# 1本の Python int をビット集合として使い、手掛かりごとに「その手掛かりと矛盾しない組」のマスクと AND する。
+#   ・ヒント（和・差・積／種類不明）：表示値ごとのマスクを逆引き表（hint_tables.bin を mmap）から
+#     読むだけ。詐欺師の ±1 は noise（ずれの候補）ぶんを OR 済みの表を使う
+#   ・Yes/No（ge/le/eq/between）：s が連続する範囲は連続したビットなので、その場でシフトして作る
+#   ・嘘だ！成功で分かった一の位（|s| % 10）・外した予想（その s の行を消す）
+#   ・相手の数の変更：隠し数はそのまま、s だけを全範囲に戻す（隠し数の候補は残す）
+# allow_negative の範囲（-50..50 × -30..30）でも1手あたり数 µs〜数十 µs で更新できる。
+import os, mmap, struct
+from array import array
+
+import engine as E
+
+# 詐欺師ノイズの扱い：表示値 − 真値 としてありうるもの
+NOISE_NONE = (0,)             # ロール無効：ノイズなし
+NOISE_MAYBE = (-1, 0, 1)      # 相手が詐欺師かどうか分からない
+NOISE_TRICKSTER = (-1, 1)     # 相手が詐欺師と分かっている（ノイズは必ず ±1）
+
+# ====== ヒント逆引き表（hint_tables.bin） ======
+# (範囲, 種類, ノイズ) ごとに「表示値 → その値になる組のマスク」を tools/build_hint_tables.py で
+# 事前に書き出し、import 時に mmap する。各セクションは 表示値 - vmin で引く int32 の添字表
+# （-1 = 該当なし）と、nbytes 固定長のマスク（little endian）の並び。ノイズ込みの表は OR 済み。
+# ファイルが無い／範囲が今の eff_ranges と違うセクションは、その範囲だけ従来どおりプロセス内で作る。
+HINT_TABLES_PATH = os.environ.get("HINT_TABLES") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "hint_tables.bin")
+HT_MAGIC = b"NUMHINT1"
+HT_HEADER = struct.Struct("<8sI")                    # magic, セクション数
+HT_SECTION = struct.Struct("<BBBxiiiiiiIQQ")         # neg, 種類, ノイズ, nmin, nmax, hmin, hmax, vmin, 値の数, nbytes, 添字表, マスク列
+NOISES = (NOISE_NONE, NOISE_MAYBE, NOISE_TRICKSTER)
+
+def exact_hint_masks(allow_negative):
+    """種類ごとの {表示値: マスク}（ノイズなし）。ビット番号は PairTable と同じ"""
+    nmin, nmax, hmin, hmax = E.eff_ranges(allow_negative)
+    width = hmax - hmin + 1
+    nbytes = ((nmax - nmin + 1) * width + 7) // 8
+    hint = [{}, {}, {}]
+    for s in range(nmin, nmax + 1):
+        base = (s - nmin) * width
+        for h in range(hmin, hmax + 1):
+            i = base + h - hmin
+            for t, htype in enumerate(E.HINT_TYPES):
+                v = E.hint_value(htype, s, h)
+                buf = hint[t].get(v)
+                if buf is None:
+                    buf = hint[t][v] = bytearray(nbytes)
+                buf[i >> 3] |= 1 << (i & 7)
+    return [{v: int.from_bytes(b, 'little') for v, b in d.items()} for d in hint]
+
+def build_hint_tables(path=HINT_TABLES_PATH):
+    """両方の範囲 × 3種類 × 3ノイズの逆引き表を書き出し、ファイルの大きさを返す"""
+    sections, payload = [], []
+    pos = HT_HEADER.size + HT_SECTION.size * 2 * len(E.HINT_TYPES) * len(NOISES)
+    for neg in (False, True):
+        nmin, nmax, hmin, hmax = E.eff_ranges(neg)
+        nbytes = ((nmax - nmin + 1) * (hmax - hmin + 1) + 7) // 8
+        for t, exact in enumerate(exact_hint_masks(neg)):
+            for k, noise in enumerate(NOISES):
+                values = {v + d for v in exact for d in noise}
+                vmin, vmax = min(values), max(values)
+                index = array('i', [-1]) * (vmax - vmin + 1)
+                masks = []
+                for v in range(vmin, vmax + 1):
+                    m = 0
+                    for d in noise:
+                        m |= exact.get(v - d, 0)
+                    if m:
+                        index[v - vmin] = len(masks)
+                        masks.append(m.to_bytes(nbytes, 'little'))
+                index_off = (pos + 3) & ~3   # 添字表は4バイト境界に置く
+                payload.append(bytes(index_off - pos))
+                blob_off = index_off + len(index) * index.itemsize
+                pos = blob_off + len(masks) * nbytes
+                sections.append(HT_SECTION.pack(neg, t, k, nmin, nmax, hmin, hmax, vmin, len(index),
+                                                nbytes, index_off, blob_off))
+                payload += [index.tobytes(), b"".join(masks)]
+    tmp = path + ".tmp"
+    with open(tmp, 'wb') as f:
+        f.write(HT_HEADER.pack(HT_MAGIC, len(sections)))
+        f.write(b"".join(sections))
+        for chunk in payload:
+            f.write(chunk)
+    os.replace(tmp, path)
+    return pos
+
+class HintTables:
+    """mmap した逆引き表。section(neg, 種類, ノイズ) で引く"""
+    __slots__ = ('mm', 'view', 'sections')
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = HT_HEADER.unpack_from(self.mm, 0)
+        if magic != HT_MAGIC:
+            raise ValueError(f"{path}: not a hint table")
+        self.view = memoryview(self.mm)
+        self.sections = {}
+        for i in range(count):
+            neg, t, k, *ranges, vmin, nvals, nbytes, index_off, blob_off = \
+                HT_SECTION.unpack_from(self.mm, HT_HEADER.size + i * HT_SECTION.size)
+            if tuple(ranges) != E.eff_ranges(bool(neg)):
+                continue   # 範囲の定数が変わった後の古い表は使わない
+            index = self.view[index_off:index_off + 4 * nvals].cast('i')
+            self.sections[bool(neg), t, k] = (vmin, nvals, nbytes, index, blob_off)
+
+    def mask(self, neg, t, k, v):
+        return self.read(self.sections[neg, t, k], v)
+
+    def read(self, section, v):
+        vmin, nvals, nbytes, index, blob_off = section
+        i = v - vmin
+        if not 0 <= i < nvals:
+            return 0
+        slot = index[i]
+        if slot < 0:
+            return 0
+        off = blob_off + slot * nbytes
+        return int.from_bytes(self.mm[off:off + nbytes], 'little')
+
+def load_hint_tables(path=HINT_TABLES_PATH):
+    try:
+        return HintTables(path)
+    except (OSError, ValueError, struct.error):
+        return None
+
+HINT_TABLES = load_hint_tables()
+HINT_CACHE_MAX = 4096   # mmap から読んで int にしたマスクをプロセス内に残す数（超えたら捨てて読み直す）
+
+class PairTable:
+    """1つの範囲（allow_negative ごと）で使い回す定数マスク"""
+    __slots__ = ('neg', 'nmin', 'nmax', 'hmin', 'hmax', 'width', 'rows', 'full', 'row', 'hint', 'ones', 'spread',
+                 'mapped', 'cache')
+
+    def __init__(self, allow_negative):
+        self.neg = bool(allow_negative)
+        self.nmin, self.nmax, self.hmin, self.hmax = E.eff_ranges(allow_negative)
+        self.width = self.hmax - self.hmin + 1
+        self.rows = self.nmax - self.nmin + 1
+        self.full = (1 << (self.rows * self.width)) - 1
+        self.row = (1 << self.width) - 1
+        # 1行ぶん（隠し数の集合）を全行へ複製するための掛け数
+        self.spread = sum(1 << (r * self.width) for r in range(self.rows))
+        self.ones = [0] * 10
+        for s in range(self.nmin, self.nmax + 1):
+            self.ones[abs(s) % 10] |= self.secrets_mask(s, s)
+        # mapped[ノイズ][種類] = 逆引き表のセクション。表が使えない時だけプロセス内で作る
+        keys = [[(self.neg, t, k) for t in range(len(E.HINT_TYPES))] for k in range(len(NOISES))]
+        if HINT_TABLES and all(key in HINT_TABLES.sections for row in keys for key in row):
+            self.mapped = [[HINT_TABLES.sections[key] for key in row] for row in keys]
+            self.hint = None
+        else:
+            self.mapped = None
+            self.hint = exact_hint_masks(self.neg)
+        self.cache = {}
+
+    def hint_mask(self, t, value, noise):
+        """種類 t（HINT_TYPES の添字）で value と表示される組（noise のずれを含む）"""
+        if self.mapped and noise in NOISES:
+            key = (noise, t, value)
+            m = self.cache.get(key)
+            if m is None:
+                if len(self.cache) >= HINT_CACHE_MAX:
+                    self.cache.clear()
+                m = self.cache[key] = HINT_TABLES.read(self.mapped[NOISES.index(noise)][t], value)
+            return m
+        if self.hint is None:
+            self.hint = exact_hint_masks(self.neg)
+        table = self.hint[t]
+        m = 0
+        for d in noise:
+            m |= table.get(value - d, 0)
+        return m
+
+    def secrets_mask(self, lo, hi):
+        """lo <= s <= hi の組（範囲外は切り詰め、空なら 0）"""
+        lo, hi = max(lo, self.nmin), min(hi, self.nmax)
+        if lo > hi:
+            return 0
+        return ((1 << ((hi - lo + 1) * self.width)) - 1) << ((lo - self.nmin) * self.width)
+
+_TABLES = {}
+
+def pair_table(allow_negative):
+    key = bool(allow_negative)
+    if key not in _TABLES:
+        _TABLES[key] = PairTable(key)
+    return _TABLES[key]
+
+class Solver:
+    __slots__ = ('tab', 'bits', 'noise')
+
+    def __init__(self, allow_negative=False, noise=NOISE_MAYBE):
+        self.tab = pair_table(allow_negative)
+        self.bits = self.tab.full
+        self.noise = noise
+
+    @classmethod
+    def for_room(cls, room):
+        return cls(room.allow_negative, NOISE_MAYBE if room.rules.get('roles', True) else NOISE_NONE)
+
+    def copy(self):
+        other = Solver.__new__(Solver)
+        other.tab, other.bits, other.noise = self.tab, self.bits, self.noise
+        return other
+
+    # --- 手掛かり ---
+    # clue はタプル：('hint', 種類 or None, 表示値) / ('yn', YN_TYPES の添字, 答え, x) /
+    # ('yn', 3, 答え, lo, hi) / ('ones', 一の位) / ('not', 外した予想)
+    def mask(self, clue):
+        """clue と矛盾しない組のマスク"""
+        tab, kind = self.tab, clue[0]
+        if kind == 'hint':
+            types = (E.HINT_TYPES.index(clue[1]),) if clue[1] else (0, 1, 2)
+            m = 0
+            for t in types:
+                m |= tab.hint_mask(t, clue[2], self.noise)
+            return m
+        if kind == 'yn':
+            q, ans = E.YN_TYPES[clue[1]], bool(clue[2])
+            if q == 'ge':
+                m = tab.secrets_mask(clue[3], tab.nmax)
+            elif q == 'le':
+                m = tab.secrets_mask(tab.nmin, clue[3])
+            elif q == 'eq':
+                m = tab.secrets_mask(clue[3], clue[3])
+            else:
+                m = tab.secrets_mask(clue[3], clue[4])
+            return m if ans else tab.full & ~m
+        if kind == 'ones':
+            return tab.ones[clue[1]]
+        if kind == 'not':
+            return tab.full & ~tab.secrets_mask(clue[1], clue[1])
+        raise ValueError(f"unknown clue {clue!r}")
+
+    def add(self, clue):
+        """手掛かりを1つ足して、残りの組の数を返す"""
+        self.bits &= self.mask(clue)
+        return self.count()
+
+    def would_keep(self, clue):
+        """足したら残る組の数（自分は変えない）"""
+        return (self.bits & self.mask(clue)).bit_count()
+
+    def secret_changed(self):
+        """相手が数を変えた：隠し数の候補だけを残して s を全範囲に戻す"""
+        tab, bits, cols = self.tab, self.bits, 0
+        while bits:
+            cols |= bits & tab.row
+            bits >>= tab.width
+        self.bits = cols * tab.spread
+
+    # --- 読み出し ---
+    def count(self):
+        return self.bits.bit_count()
+
+    def secrets(self):
+        """残っている相手の数（昇順）"""
+        tab, bits, out = self.tab, self.bits, []
+        s = tab.nmin
+        while bits:
+            if bits & tab.row:
+                out.append(s)
+            bits >>= tab.width
+            s += 1
+        return out
+
+    def hiddens(self):
+        """残っている隠し数（昇順）"""
+        tab, bits, cols = self.tab, self.bits, 0
+        while bits:
+            cols |= bits & tab.row
+            bits >>= tab.width
+        return [tab.hmin + i for i in range(tab.width) if cols >> i & 1]
+
+    def pairs(self):
+        tab, bits, out = self.tab, self.bits, []
+        while bits:
+            low = bits & -bits
+            i = low.bit_length() - 1
+            out.append((tab.nmin + i // tab.width, tab.hmin + i % tab.width))
+            bits ^= low
+        return out
+
+# ====== 行動ログから手掛かりへ ======
+_HINT_EVENTS = {E.EV['hint']: False, E.EV['hint_accept']: False,
+                E.EV['hint_typed']: True, E.EV['hint_accept_typed']: True}
+_MISS_EVENTS = frozenset(E.EV[n] for n in (
+    'guess_miss', 'guess_near', 'guess_info', 'press_miss', 'press_info', 'free_miss', 'free_near', 'free_info'))
+
+def clue_from_event(pid, ev):
+    """pid が行動者の行動ログ1件から手掛かりを取り出す（関係なければ None）。
+    受け入れたブラフ（hint_accept*）は偽かもしれないので、矛盾した時の扱いは呼び出し側で決める"""
+    code, actor, _tick, a = ev
+    if actor != pid:
+        return None
+    typed = _HINT_EVENTS.get(code)
+    if typed is not None:
+        return ('hint', E.HINT_TYPES[a[0]], a[1]) if typed else ('hint', None, a[0])
+    if code == E.EV['yn']:
+        return ('yn',) + tuple(a)
+    if code == E.EV['decl_call_ok']:
+        return ('ones', a[0])
+    if code in _MISS_EVENTS:
+        return ('not', a[0])
+    return None
@@ -0,0 +1,147 @@
+# tools/bench_engine_np.py
+# engine_np（NumPy 一括評価）と engine のスカラー判定の突き合わせ・速度比較：
+#   ヒント値（和・差・積＋詐欺師ノイズ）／Yes/No の答え／トラップ判定フラグ＋予想の結果
+# 突き合わせは全件を要素ごとに比較し、予想の結果はさらに一部を本物の Room と resolve_guess で確かめる。
+# 正負どちらの範囲（allow_negative）も混ぜる。NumPy が無ければ何もせず終わる。
+# 局は最初から列ごとの array('q')（COLS）で作るので、NumPy 側は np.frombuffer で列をそのまま
+# 借りるだけ（1局ずつの dict から集め直す変換は払わない）。見出しの時間はその変換込み。
+# 使い方: python tools/bench_engine_np.py [件数]
+import os, sys, time, random
+from array import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import engine as E
+
+INFO_COLS = 13      # get_info_max の上限
+ROOM_CHECKS = 3000  # resolve_guess で確かめる件数
+
+NO_KILL = 1 << 40   # kill 未設置（engine_np.NO_TRAP と同じ値）
+COLS = ('neg', 'secret', 'hidden', 'guess', 'htype', 'noise', 'qtype', 'x', 'lo', 'hi',
+        'kill', 'trapper', 'info_len')
+
+def make_cases(n, rng):
+    """列名 → n 局ぶんの array('q')。info は全局ぶんを続けた info（長さは info_len 列）"""
+    cols = {k: array('q') for k in COLS}
+    cols['info'] = array('q')
+    for _ in range(n):
+        neg = rng.random() < 0.5
+        nmin, nmax, hmin, hmax = E.eff_ranges(neg)
+        num = lambda: rng.randint(nmin, nmax)
+        qtype = rng.randrange(len(E.YN_TYPES))
+        a, b = num(), num()
+        info = rng.sample(range(nmin, nmax + 1), rng.randint(0, INFO_COLS))
+        row = (neg, num(), rng.randint(hmin, hmax), num(), rng.randrange(3), rng.choice((-1, 0, 1)),
+               qtype, num(), min(a, b), max(a, b), num() if rng.random() < 0.8 else NO_KILL,
+               rng.random() < 0.3, len(info))
+        for k, v in zip(COLS, row):
+            cols[k].append(v)
+        cols['info'].extend(info)
+    return cols
+
+def case(cols, i):
+    """i 局目を dict で（resolve_guess での確かめ用）"""
+    c = {k: cols[k][i] for k in COLS}
+    start = sum(cols['info_len'][:i])
+    c['info'] = list(cols['info'][start:start + c['info_len']])
+    c['kill'] = None if c['kill'] == NO_KILL else c['kill']
+    c['neg'], c['trapper'] = bool(c['neg']), bool(c['trapper'])
+    return c
+
+def thresholds(trapper):
+    return E.KILL_THRESHOLDS_TRAPPER if trapper else E.KILL_THRESHOLDS
+
+def scalar(cols):
+    hints, answers, flags, outcomes = [], [], [], []
+    info_all, start = cols['info'], 0
+    for secret, hidden, guess, htype, noise, qtype, x, lo, hi, kill, trapper, info_len in zip(
+            *(cols[k] for k in COLS[1:])):
+        hints.append(E.hint_value(E.HINT_TYPES[htype], secret, hidden) + noise)
+        answers.append(E.yn_answer(E.YN_TYPES[qtype], secret, x, lo, hi))
+        inst_t, near_t = thresholds(trapper)
+        info = set(info_all[start:start + info_len])
+        start += info_len
+        f = E.trap_flags(guess, [] if kill == NO_KILL else [kill], info, inst_t, near_t)
+        flags.append(f)
+        outcomes.append('hit' if guess == secret else
+                        'kill' if f & E.OUT_KILL else 'near' if f & E.OUT_NEAR else 'miss')
+    return hints, answers, flags, outcomes
+
+def to_arrays(np, NP, cols):
+    out = {k: np.frombuffer(cols[k], dtype=np.int64) for k in COLS}
+    out['trapper'] = out['trapper'].astype(bool)
+    if NO_KILL != NP.NO_TRAP:
+        out['kill'] = np.where(out['kill'] == NO_KILL, NP.NO_TRAP, out['kill'])
+    # info は長さ別に (N, INFO_COLS) へ詰める（未設置の枠は NO_TRAP）
+    lens = out.pop('info_len')
+    info = np.full((len(lens), INFO_COLS), NP.NO_TRAP, dtype=np.int64)
+    info[np.arange(INFO_COLS) < lens[:, None]] = np.frombuffer(cols['info'], dtype=np.int64)
+    out['info'] = info
+    return out
+
+def vectorized(NP, a):
+    hints = NP.hint_values(a['htype'], a['secret'], a['hidden'], a['noise'])
+    answers = NP.yn_answers(a['qtype'], a['secret'], a['x'], a['lo'], a['hi'])
+    inst_t, near_t = NP.kill_thresholds(a['trapper'])
+    flags = NP.trap_flags(a['guess'], a['kill'], a['info'], inst_t, near_t)
+    outcomes = NP.guess_outcomes(a['guess'], a['secret'], flags)
+    return hints, answers, flags, outcomes
+
+def room_outcome(c):
+    """本物の Room で守る側(2)のトラップを置き、1 が予想した時の resolve_guess の結果"""
+    room = E.init_room(c['neg'], 3)
+    room.players[1].secret = c['guess'] if c['guess'] != c['secret'] else c['secret'] + 1
+    room.players[2].secret = c['secret']
+    room.players[2].role_main = 'Trapper' if c['trapper'] else 'Scholar'
+    if c['kill'] is not None:
+        E.set_kill_trap(room, 2, c['kill'])
+    E.add_info_traps(room, 2, c['info'])
+    out = E.resolve_guess(room, 1, c['guess'], 'guess')
+    info_hit = room.players[2].pending_view
+    room.actions.discard()
+    return out, info_hit
+
+def main():
+    try:
+        import numpy as np
+        import engine_np as NP
+    except ImportError:
+        print("NumPy が無いため比較をスキップします（engine_np は任意依存）")
+        return 0
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    cases = make_cases(n, random.Random(1))
+
+    t0 = time.perf_counter()
+    ref = scalar(cases)
+    t_scalar = time.perf_counter() - t0
+    best = None
+    for _ in range(3):
+        t0 = time.perf_counter()
+        arrays = to_arrays(np, NP, cases)
+        t1 = time.perf_counter()
+        got = vectorized(NP, arrays)
+        t2 = time.perf_counter()
+        if best is None or t2 - t0 < best[0]:
+            best = (t2 - t0, t1 - t0, t2 - t1)
+    t_total, t_convert, t_kernel = best
+
+    names = ('hint', 'yn', 'trap_flags', 'outcome')
+    ref_arrays = (np.array(ref[0]), np.array(ref[1]), np.array(ref[2]),
+                  np.array([NP.GUESS_OUTCOMES.index(o) for o in ref[3]]))
+    for name, r, g in zip(names, ref_arrays, got):
+        bad = int(np.count_nonzero(r != g))
+        assert bad == 0, f"{name}: {bad} mismatches"
+    for i in range(min(n, ROOM_CHECKS)):
+        c = case(cases, i)
+        out, info_hit = room_outcome(c)
+        assert NP.GUESS_OUTCOMES[got[3][i]] == out, (i, c, out)
+        if out not in ('hit', 'kill'):
+            assert bool(got[2][i] & E.OUT_INFO) == info_hit, (i, c)
+    print(f"match: {n} cases x {len(names)} kernels identical ({ROOM_CHECKS} also checked via resolve_guess)")
+    print(f"scalar: {t_scalar * 1e3:9.1f} ms  ({t_scalar / n * 1e9:7.0f} ns/case)")
+    print(f" numpy: {t_total * 1e3:9.1f} ms  ({t_total / n * 1e9:7.0f} ns/case)  x{t_scalar / t_total:.0f}  "
+          f"(列→配列 {t_convert * 1e3:.1f} ms + カーネル {t_kernel * 1e3:.1f} ms)")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,63 @@
+# tools/bench_render.py
+# ページ外枠の描画コスト比較：
+#   before = 毎回 render_template_string でテンプレートを解析＋画像の拡張子を4キー分 stat（最大24回）
+#   after  = import 時にコンパイル済みの PAGE_SHELL ＋アセットマニフェストを使う bootstrap_page
+# 使い方: python tools/bench_render.py [回数]
+import os, sys, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import render_template_string
+import number as N
+
+BODY = "<div class='card'><div class='card-body'>bench</div></div>"
+
+def legacy_fx_img_urls(key):
+    # 旧実装：リクエスト毎に拡張子6種を os.path.exists で確認
+    m = N.asset_manifest()
+    urls = []
+    for ext in N.FX_IMG_EXTS:
+        rel = f"img/{key}.{ext}"
+        if os.path.exists(os.path.join(N.app.static_folder, rel)):
+            e = next(e for e in m['img'][key] if e['file'] == rel)
+            urls.append(e['url'])
+    return urls or [N.url_for('fx_placeholder', key=key, v=N._placeholder_svg(key)[1])]
+
+def legacy_fx_img_spec(key):
+    # 縮小版も同様にリクエスト毎に img/fx を走査（after と同じ dict 形にそろえる）
+    m = N.asset_manifest()
+    try:
+        names = sorted(os.listdir(os.path.join(N.app.static_folder, 'img', 'fx')))
+    except OSError:
+        names = []
+    by_type = {}
+    for e in m['variants'][key]:
+        if os.path.basename(e['file']) in names:
+            by_type.setdefault(e['type'], []).append(f"{e['url']} {e['width']}w")
+    sources = [{'type': t, 'srcset': ', '.join(by_type[t])}
+               for t in N.FX_VARIANT_TYPES.values() if t in by_type]
+    return {'sources': sources, 'urls': legacy_fx_img_urls(key)}
+
+def render_before():
+    FX_BS = legacy_fx_img_spec('bluff_success')
+    FX_BF = legacy_fx_img_spec('bluff_fail')
+    FX_RW = legacy_fx_img_spec('round_win')
+    FX_RL = legacy_fx_img_spec('round_lose')
+    SFX = N.fx_shell_assets()['sfx']
+    return render_template_string(N.PAGE_SHELL_SRC, title='bench', body=BODY,
+                                  NUM_MIN=N.NUM_MIN, NUM_MAX=N.NUM_MAX, HIDDEN_MIN=N.HIDDEN_MIN, HIDDEN_MAX=N.HIDDEN_MAX,
+                                  FX_BS=FX_BS, FX_BF=FX_BF, FX_RW=FX_RW, FX_RL=FX_RL, SFX=SFX)
+
+def render_after():
+    return N.bootstrap_page('bench', BODY)
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    with N.app.test_request_context('/'):
+        assert render_before() == render_after()
+        for name, fn in (('before', render_before), ('after', render_after)):
+            best = min(timeit.repeat(fn, number=n, repeat=3)) / n
+            print(f"{name:>6}: {best * 1e6:9.1f} us/render")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# tools/bench_room_memory.py
+# ルーム状態のメモリ比較（既定 10000 ルーム、両者とも対戦開始後の状態）：
+#   before = 旧 init_room の dict（{1: x, 2: y} の入れ子 dict を約50個）＋ラウンド頭に作り直し
+#   after  = Room / PlayerState（__slots__）＋ reset_round でその場で初期化
+# 行動ログ（EventLog）は両者で同じなので数えない。ラウンド頭の初期化時間もあわせて出す。
+# 使い方: python tools/bench_room_memory.py [ルーム数]
+import os, sys, gc, timeit, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import engine as E
+
+PER_PLAYER = {
+    'score': 0, 'pname': None, 'secret': None, 'tries': 0, 'cooldown': 0, 'change_used': 0,
+    'pending_view': False, 'can_view': False, 'view_cut_index': None, 'skip_next_turn': False,
+    'info_set_this_turn': False, 'info_max': E.INFO_MAX_DEFAULT, 'info_free_per_turn': 1,
+    'info_free_used_this_turn': 0, 'log_scan': 0, 'log_epoch': 0,
+    'bluff': None, 'hint_preview': None, 'hint_penalty_active': False, 'hint_ct': 0,
+    'guess_flag_armed': False, 'guess_flag_ct': 0, 'guess_penalty_active': False, 'guess_ct': 0,
+    'guess_flag_warn': False, 'guess_flag_used': False,
+    'decl1_value': None, 'decl1_used': False, 'decl1_resolved': True, 'decl1_hint_token_ready': False,
+    'decl1_hint_token_active': False, 'free_guess_pending': False, 'press_used': False, 'press_pending': False,
+    'role_main': None, 'role_extra': None, 'guardian_shield_used': False, 'disarm_cd': 0,
+    'yn_used_count': 0, 'yn_ct': 0, 'yn_last_tick': -999,
+    'devotion_used': False, 'devotion_offers': None, 'devotion_info_penalty': 0,
+}
+PER_PLAYER_LISTS = ('trap_kill', 'trap_info', 'log_view', 'log_html')
+
+def legacy_reset(room):
+    # 旧 start_new_round：プレイヤー別の値を毎ラウンド新しい dict で作り直す
+    for k, v in PER_PLAYER.items():
+        if k not in ('score', 'pname', 'secret', 'log_epoch'):
+            room[k] = {1: v, 2: v}
+    for k in PER_PLAYER_LISTS:
+        room[k] = {1: [], 2: []}
+    room['available_hints'] = {1: ['和', '差', '積'], 2: ['和', '差', '積']}
+    room['hint_choice_available'] = {1: False, 2: True}
+    room['log_epoch'] = {1: room['log_epoch'][1] + 1, 2: room['log_epoch'][2] + 1}
+    room['turn'] = 1
+    room['tick'] = 0
+
+def legacy_room(rid):
+    eff_nmin, eff_nmax, eff_hmin, eff_hmax = E.eff_ranges(False)
+    room = {
+        'id': rid, 'allow_negative': False,
+        'eff_num_min': eff_nmin, 'eff_num_max': eff_nmax, 'eff_hidden_min': eff_hmin, 'eff_hidden_max': eff_hmax,
+        'target_points': 3, 'round_no': 1, 'turn': 1, 'hidden': None, 'winner': None, 'phase': 'play',
+        'last_active': 0.0, 'starter': 1, 'rules': E.RULE_DEFAULTS.copy(), 'turn_serial': 0, 'tick': 0,
+        'score': {1: 0, 2: 0}, 'pname': {1: 'A', 2: 'B'}, 'secret': {1: 10, 2: 20},
+        'log_epoch': {1: 0, 2: 0},
+    }
+    legacy_reset(room)
+    return room
+
+def slots_room(rid):
+    room = E.Room(rid, False, 3, E.RULE_DEFAULTS.copy())
+    room.actions = None
+    room.players[1].pname, room.players[2].pname = 'A', 'B'
+    room.players[1].secret, room.players[2].secret = 10, 20
+    return room
+
+def slots_reset(room):
+    for p in (1, 2):
+        ps = room.players[p]
+        ps.reset_round(p != room.starter)
+        ps.log_epoch += 1
+    room.turn = room.starter
+    room.tick = 0
+
+def measure(make, n):
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    rooms = [make(f"{i:05d}") for i in range(n)]
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    return rooms, used
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    for name, make, reset in (('before', legacy_room, legacy_reset), ('after', slots_room, slots_reset)):
+        rooms, used = measure(make, n)
+        room = rooms[0]
+        best = min(timeit.repeat(lambda: reset(room), number=2000, repeat=3)) / 2000
+        print(f"{name:>6}: {used / 2**20:7.1f} MiB / {n} rooms ({used / n:7.0f} B/room), "
+              f"round reset {best * 1e6:6.2f} us")
+        del rooms
+
+if __name__ == '__main__':
+    main()
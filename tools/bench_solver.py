@@ -0,0 +1,120 @@
+# tools/bench_solver.py
+# solver.Solver（ビット集合）と、(s, h) の組を全部並べて1つずつ確かめる素朴な絞り込みの比較。
+# 本物の engine.hint_value / yn_answer で作った手掛かり（詐欺師ノイズ・Yes/No・一の位・外した予想・
+# 相手の数の変更を混ぜる）を順に足し、毎回 残りの組が一致するかを確かめて1手あたりの時間を出す。
+# 使い方: python tools/bench_solver.py [局数]
+import os, sys, time, random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import engine as E
+import solver as S
+
+CLUES_PER_GAME = 12
+
+def make_game(rng, allow_negative):
+    """1局ぶんの手掛かり列（'change' は相手の数の変更）"""
+    nmin, nmax, hmin, hmax = E.eff_ranges(allow_negative)
+    secret, hidden = rng.randint(nmin, nmax), rng.randint(hmin, hmax)
+    trickster = rng.random() < 0.3
+    clues = []
+    for _ in range(CLUES_PER_GAME):
+        r = rng.random()
+        if r < 0.45:
+            htype = rng.choice(E.HINT_TYPES)
+            shown = E.hint_value(htype, secret, hidden) + (rng.choice((-1, 1)) if trickster else 0)
+            clues.append(('hint', htype if rng.random() < 0.5 else None, shown))
+        elif r < 0.7:
+            q = rng.randrange(len(E.YN_TYPES))
+            if E.YN_TYPES[q] == 'between':
+                lo, hi = sorted((rng.randint(nmin, nmax), rng.randint(nmin, nmax)))
+                clues.append(('yn', q, int(E.yn_answer('between', secret, lo=lo, hi=hi)), lo, hi))
+            else:
+                x = rng.randint(nmin, nmax)
+                clues.append(('yn', q, int(E.yn_answer(E.YN_TYPES[q], secret, x)), x))
+        elif r < 0.8:
+            clues.append(('ones', abs(secret) % 10))
+        elif r < 0.95:
+            g = rng.randint(nmin, nmax)
+            if g != secret:
+                clues.append(('not', g))
+        else:
+            secret = rng.randint(nmin, nmax)
+            clues.append(('change',))
+    return clues
+
+def naive_keep(pairs, clue):
+    kind = clue[0]
+    if kind == 'hint':
+        types = (clue[1],) if clue[1] else E.HINT_TYPES
+        return [(s, h) for s, h in pairs
+                if any(abs(E.hint_value(t, s, h) - clue[2]) <= 1 for t in types)]
+    if kind == 'yn':
+        q = E.YN_TYPES[clue[1]]
+        if q == 'between':
+            return [(s, h) for s, h in pairs if E.yn_answer(q, s, lo=clue[3], hi=clue[4]) == bool(clue[2])]
+        return [(s, h) for s, h in pairs if E.yn_answer(q, s, clue[3]) == bool(clue[2])]
+    if kind == 'ones':
+        return [(s, h) for s, h in pairs if abs(s) % 10 == clue[1]]
+    return [(s, h) for s, h in pairs if s != clue[1]]
+
+def run_naive(allow_negative, games):
+    nmin, nmax, hmin, hmax = E.eff_ranges(allow_negative)
+    full = [(s, h) for s in range(nmin, nmax + 1) for h in range(hmin, hmax + 1)]
+    out = []
+    for clues in games:
+        pairs = full
+        for clue in clues:
+            if clue[0] == 'change':
+                hs = {h for _s, h in pairs}
+                pairs = [(s, h) for s, h in full if h in hs]
+            else:
+                pairs = naive_keep(pairs, clue)
+            out.append(pairs)
+    return out
+
+def run_bitset(allow_negative, games):
+    out = []
+    for clues in games:
+        sv = S.Solver(allow_negative, S.NOISE_MAYBE)
+        for clue in clues:
+            if clue[0] == 'change':
+                sv.secret_changed()
+            else:
+                sv.add(clue)
+            out.append(sv.bits)
+    return out
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    rng = random.Random(1)
+    for neg in (False, True):
+        t0 = time.perf_counter()
+        S.pair_table(neg)
+        t_table = time.perf_counter() - t0
+        games = [make_game(rng, neg) for _ in range(n)]
+        steps = n * CLUES_PER_GAME
+        t0 = time.perf_counter()
+        ref = run_naive(neg, games)
+        t_naive = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        got = run_bitset(neg, games)
+        t_bits = time.perf_counter() - t0
+        # 突き合わせ：ビット集合を組に戻して比べる
+        probe = S.Solver(neg)
+        for i, (pairs, bits) in enumerate(zip(ref, got)):
+            probe.bits = bits
+            assert probe.pairs() == pairs, (neg, i)
+        t0 = time.perf_counter()
+        for bits in got:
+            probe.bits = bits
+            probe.secrets()
+        t_read = time.perf_counter() - t0
+        tab = S.pair_table(neg)
+        print(f"allow_negative={neg!s:5} ({tab.rows}x{tab.width} pairs, table {t_table * 1e3:.0f} ms once): "
+              f"{steps} clues identical; naive {t_naive / steps * 1e6:7.1f} us/clue, "
+              f"bitset {t_bits / steps * 1e6:5.1f} us/clue (x{t_naive / t_bits:.0f}), "
+              f"secrets() {t_read / steps * 1e6:5.1f} us")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# tools/build_fx_images.py
+# FX 画像（static/img/<key>.png 等）から、スマホ向けの縮小版を static/img/fx/ に書き出す。
+#   static/img/fx/<key>-<幅>.avif / .webp   （Pillow が対応していれば）
+#   static/img/fx/<key>-<幅>.png            （AVIF/WebP どちらも使えない環境のみ・最適化PNG）
+# 元画像より新しい出力があればスキップする。number.py のアセットマニフェストが
+# これらを拾って srcset 候補にし、元画像はフォールバックとして残る。
+# 使い方: python tools/build_fx_images.py [--force]
+import os, sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SRC_DIR = os.path.join(ROOT, 'static', 'img')
+OUT_DIR = os.path.join(SRC_DIR, 'fx')
+KEYS = ('bluff_success', 'bluff_fail', 'round_win', 'round_lose')
+SRC_EXTS = ('png', 'jpg', 'jpeg', 'PNG', 'JPG', 'JPEG')
+WIDTHS = (480, 768, 1024)
+QUALITY = {'avif': 55, 'webp': 78}
+
+def find_source(key):
+    for ext in SRC_EXTS:
+        p = os.path.join(SRC_DIR, f"{key}.{ext}")
+        if os.path.exists(p):
+            return p
+    return None
+
+def output_formats(features):
+    fmts = [f for f in ('avif', 'webp') if features.check(f)]
+    return fmts or ['png']
+
+def save(im, path, fmt):
+    if fmt == 'png':
+        im.save(path, 'PNG', optimize=True)
+    elif fmt == 'webp':
+        im.save(path, 'WEBP', quality=QUALITY['webp'], method=6)
+    else:
+        im.save(path, 'AVIF', quality=QUALITY['avif'])
+
+def main():
+    try:
+        from PIL import Image, features
+    except ImportError:
+        print("Pillow が無いため FX 画像の変換をスキップします（元画像のみ配信）")
+        return 0
+    force = '--force' in sys.argv[1:]
+    fmts = output_formats(features)
+    os.makedirs(OUT_DIR, exist_ok=True)
+    for key in KEYS:
+        src = find_source(key)
+        if not src:
+            print(f"{key}: 元画像なし")
+            continue
+        src_mtime = os.path.getmtime(src)
+        with Image.open(src) as im:
+            im = im.convert('RGBA' if 'A' in im.getbands() else 'RGB')
+            w0, h0 = im.size
+            for w in WIDTHS:
+                if w > w0:
+                    continue
+                resized = None
+                for fmt in fmts:
+                    out = os.path.join(OUT_DIR, f"{key}-{w}.{fmt}")
+                    if not force and os.path.exists(out) and os.path.getmtime(out) >= src_mtime:
+                        continue
+                    if resized is None:
+                        resized = im if w == w0 else im.resize((w, round(h0 * w / w0)), Image.LANCZOS)
+                    save(resized, out, fmt)
+                    print(f"{os.path.relpath(out, ROOT)}: {os.path.getsize(out):,} B")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,52 @@
+# tools/build_hint_tables.py
+# solver.py が mmap するヒント逆引き表（hint_tables.bin）を書き出す。
+#   eff_ranges(False) / eff_ranges(True) × 和・差・積 × ノイズ（なし／±1かも／必ず±1）
+# 書いた後に読み直し、全セクションの全表示値をプロセス内で作ったマスクと突き合わせる。
+# NUM_* / HIDDEN_* を変えたら作り直す（古い表は範囲が合わないセクションごと無視される）。
+# 使い方: python tools/build_hint_tables.py [出力先]（既定は solver.HINT_TABLES_PATH）
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import engine as E
+import solver as S
+
+def verify(tables):
+    """全表示値を突き合わせ、合わなければ ValueError（python -O でも省かれないよう assert は使わない）"""
+    checked = 0
+    for neg in (False, True):
+        exact = S.exact_hint_masks(neg)
+        for t in range(len(E.HINT_TYPES)):
+            values = list(exact[t])
+            lo, hi = min(values) - 2, max(values) + 2
+            for k, noise in enumerate(S.NOISES):
+                for v in range(lo, hi + 1):
+                    want = 0
+                    for d in noise:
+                        want |= exact[t].get(v - d, 0)
+                    if tables.mask(neg, t, k, v) != want:
+                        raise ValueError(f"mask mismatch: allow_negative={neg} {E.HINT_TYPES[t]} "
+                                         f"noise={noise} value={v}")
+                    checked += 1
+    return checked
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else S.HINT_TABLES_PATH
+    t0 = time.perf_counter()
+    size = S.build_hint_tables(path)
+    built = time.perf_counter() - t0
+    tables = S.load_hint_tables(path)
+    if tables is None or len(tables.sections) != 2 * len(E.HINT_TYPES) * len(S.NOISES):
+        print(f"{path}: 読み直しに失敗しました")
+        return 1
+    try:
+        checked = verify(tables)
+    except ValueError as e:
+        print(f"{path}: {e}")
+        return 1
+    print(f"{os.path.relpath(path)}: {size:,} B, {len(tables.sections)} sections, "
+          f"built in {built:.2f} s, {checked:,} lookups verified")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
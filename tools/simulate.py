@@ -0,0 +1,353 @@
+# tools/simulate.py
+# ヘッドレス対戦シミュレータ：engine.py の本物のルール（init_room → start_new_round → apply）で
+# マッチを最後まで打ち、ルール調整（RULE_DEFAULTS・ROLES・INFO_MAX_DEFAULT・kill 閾値）の材料を出す。
+#   ・手の選び方は POLICIES（random / greedy-hint / trap-heavy）。2つを指定し、1局ごとに席を入れ替える
+#   ・multiprocessing.Pool で局をまとめて各プロセスへ配り、集計（Counter）だけを返させて足し合わせる
+#   ・出力：games/s・rounds/s、方針別の勝率、ラウンド長（ticks＝ターン交代数）、決着の内訳、
+#           ロール別・ルール別（on/off）の勝率
+# 各局は seed + 局番号 で random を初期化するので、同じ引数なら -j に関係なく同じ集計になる。
+# 使い方: python tools/simulate.py [-n 局数] [-j プロセス数] [--policies a,b] [--rules all|random|-bluff,-press]
+#                                  [--target 点] [--negative] [--info-max N] [--kill 1,5] [--kill-trapper 2,6]
+#                                  [--seed N] [--json]
+import os, sys, json, time, random, argparse, collections, multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import engine as E
+import solver as S
+
+MAX_MOVES = 2000         # 1ラウンドの apply 回数の上限（超えたら未決着としてそのマッチを打ち切る）
+GUESS_AT = 3             # greedy-hint：候補がこの数以下になったら予想に切り替える
+
+# ====== 観測から相手の数を絞る ======
+# 自分が行動者のログ（ヒント・受け入れたブラフ・Yes/No・嘘だ！成功・ハズレた予想）を
+# solver.Solver に足していく。相手の数の変更や受け入れたブラフで矛盾したら、新しい観測から
+# 遡って矛盾しないところまでだけを使い直す。
+def observations(room, pid, mem):
+    obs = mem.setdefault('obs', [])
+    for _i, ev in room.actions.iter_range(mem.get('seen', 0)):
+        code, actor = ev[0], ev[1]
+        if actor != pid:
+            continue
+        clue = S.clue_from_event(pid, ev)
+        if clue is not None:
+            obs.append(clue)
+        if code == E.EV['decl_notice']:
+            mem['decl'] = ev[3][0]
+        elif code in (E.EV['decl_call_ok'], E.EV['decl_call_ng']):
+            mem['decl'] = None
+    mem['seen'] = len(room.actions)
+    return obs
+
+def candidates(room, pid, mem):
+    """相手の数として残っている値（昇順）"""
+    obs = observations(room, pid, mem)
+    used = mem.get('used', 0)
+    if used == len(obs) and 'cands' in mem:
+        return mem['cands']
+    sv = mem.get('solver') or S.Solver.for_room(room)
+    for clue in obs[used:]:
+        if not sv.add(clue):
+            break
+    if not sv.count():
+        # 矛盾：新しい観測から遡って、矛盾しないところまでで作り直す
+        sv = S.Solver.for_room(room)
+        for clue in reversed(obs):
+            if not sv.would_keep(clue):
+                break
+            sv.add(clue)
+    mem['used'] = len(obs)
+    mem['solver'] = sv
+    mem['cands'] = sv.secrets()
+    return mem['cands']
+
+# ====== 方針 ======
+# policy(room, pid, mem) -> action（フォーム／JSON API と同じキーの dict）。mem はラウンドごとの
+# 作業領域。相手の秘密の数・トラップ・ロールは見ない（自分の状態と自分に見えるログだけを使う）。
+def rand_num(room):
+    return random.randint(room.eff_num_min, room.eff_num_max)
+
+def answer_prompt(room, believe):
+    prompt = room.prompt
+    if prompt['kind'] == 'devotion_pick':
+        return {'action': 'devotion_pick', 'pick': random.choice(prompt['choices'])}
+    return dict(prompt['keep'], action='h', bluff_decision='believe' if believe else 'accuse')
+
+def policy_random(room, pid, mem):
+    """使える行動から一様に選ぶ"""
+    ps = room.players[pid]
+    if room.prompt:
+        return answer_prompt(room, random.random() < 0.5)
+    if ps.press_pending:
+        return random.choice(({'action': 'press', 'press_guess': rand_num(room)}, {'action': 'press_skip'}))
+    if ps.free_guess_pending:
+        return {'action': 'free_guess', 'free_guess': rand_num(room)}
+    rules = room.rules
+    menu = [{'action': 'g', 'guess': rand_num(room)},
+            {'action': 'h', 'hint_type': random.choice(E.HINT_TYPES), 'confirm_choice': '1'},
+            {'action': 'c', 'new_secret': rand_num(room)}]
+    if rules.get('trap', True):
+        menu += [{'action': 't_kill', 'trap_kill_value': rand_num(room)},
+                 {'action': 't_info', 'trap_info_value': rand_num(room)}]
+    if rules.get('bluff', True):
+        menu.append({'action': 'bh', 'bluff_type': random.choice(E.HINT_TYPES), 'bluff_value': rand_num(room)})
+    if rules.get('guessflag', True):
+        menu.append({'action': 'gf'})
+    if rules.get('decl1', True):
+        menu += [{'action': 'decl1', 'decl1_digit': random.randint(0, 9)}, {'action': 'decl1_challenge'}]
+    if rules.get('yn', True):
+        menu.append({'action': 'yn', 'yn_type': random.choice(('ge', 'le')), 'yn_x': rand_num(room)})
+    if rules.get('devotion', True) and rules.get('roles', True):
+        menu.append({'action': 'devotion_offer'})
+    return random.choice(menu)
+
+def yn_ready(room, pid):
+    ps = room.players[pid]
+    if not room.rules.get('yn', True):
+        return False
+    if E.has_role(room, pid, 'Analyst'):
+        return ps.yn_used_count < 3 and ps.yn_last_tick != room.tick and E.ct_left(room, pid, 'yn_ct_until') == 0
+    return ps.yn_used_count < 1
+
+def pick_guess(cands, mem):
+    tried = mem.setdefault('tried', set())
+    pool = [s for s in cands if s not in tried] or cands
+    g = random.choice(pool)
+    tried.add(g)
+    return g
+
+def policy_greedy_hint(room, pid, mem):
+    """ヒントと Yes/No で候補を絞り、GUESS_AT 個以下になったら予想する"""
+    ps = room.players[pid]
+    cands = candidates(room, pid, mem)
+    if room.prompt:
+        if room.prompt['kind'] == 'devotion_pick':
+            return answer_prompt(room, True)
+        # 提示値が今の候補と矛盾しなければ信じる
+        return answer_prompt(room, mem['solver'].would_keep(('hint', None, room.prompt['value'])) > 0)
+    if ps.press_pending:
+        if len(cands) <= GUESS_AT:
+            return {'action': 'press', 'press_guess': pick_guess(cands, mem)}
+        return {'action': 'press_skip'}
+    if ps.free_guess_pending:
+        return {'action': 'free_guess', 'free_guess': pick_guess(cands, mem)}
+    decl = mem.get('decl')
+    if decl is not None and room.rules.get('decl1', True) and all(abs(s) % 10 != decl for s in cands):
+        return {'action': 'decl1_challenge'}
+    if len(cands) > 2 and yn_ready(room, pid):
+        return {'action': 'yn', 'yn_type': 'ge', 'yn_x': cands[len(cands) // 2]}
+    if len(cands) <= GUESS_AT or E.ct_left(room, pid, 'hint_ct_until') > 0:
+        return {'action': 'g', 'guess': pick_guess(cands, mem)}
+    act = {'action': 'h'}
+    if ps.hint_choice_available:
+        act.update(confirm_choice='1', hint_type=random.choice(ps.available_hints or E.HINT_TYPES))
+    return act
+
+def policy_trap_heavy(room, pid, mem):
+    """自分の数の ±2 に kill、周りに無料 info、ゲスフラグ・ブラフも使い、あとは greedy-hint"""
+    ps = room.players[pid]
+    if room.prompt or ps.press_pending or ps.free_guess_pending or not room.rules.get('trap', True):
+        return policy_greedy_hint(room, pid, mem)
+    lo, hi, me = room.eff_num_min, room.eff_num_max, ps.secret
+    if not ps.trap_kill:
+        spots = [x for x in (me + 2, me - 2) if lo <= x <= hi] or [rand_num(room)]
+        return {'action': 't_kill', 'trap_kill_value': random.choice(spots)}
+    if ps.info_free_used_this_turn < ps.info_free_per_turn and len(ps.trap_info) < E.get_info_max(room, pid):
+        near = [x for x in range(me - 6, me + 7)
+                if lo <= x <= hi and x != me and x not in ps.trap_info and x not in ps.trap_kill]
+        if near:
+            return {'action': 't_info', 'trap_info_value': random.choice(near)}
+    if room.rules.get('guessflag', True) and not ps.guess_flag_used and random.random() < 0.3:
+        return {'action': 'gf'}
+    if room.rules.get('bluff', True) and ps.bluff is None and random.random() < 0.2:
+        fake = rand_num(room) + random.randint(room.eff_hidden_min, room.eff_hidden_max)
+        return {'action': 'bh', 'bluff_type': '和', 'bluff_value': fake}
+    return policy_greedy_hint(room, pid, mem)
+
+POLICIES = {
+    'random': policy_random,
+    'greedy-hint': policy_greedy_hint,
+    'trap-heavy': policy_trap_heavy,
+}
+
+# ====== 対戦 ======
+def rules_for(spec):
+    """'all'＝全部 on、'random'＝局ごとに各ルール 1/2 で on、'-bluff,-press'＝指定だけ off"""
+    if spec == 'random':
+        return {k: random.random() < 0.5 for k in E.RULE_DEFAULTS}
+    rules = dict(E.RULE_DEFAULTS)
+    if spec != 'all':
+        for name in spec.split(','):
+            name = name.strip()
+            rules[name.lstrip('-+')] = not name.startswith('-')
+    return rules
+
+def play_round(room, seats):
+    mems = (None, {}, {})
+    moves = 0
+    while room.winner is None and moves < MAX_MOVES:
+        if E.resolve_pending_skip(room):
+            continue
+        pid = room.turn
+        E.apply(room, pid, POLICIES[seats[pid]](room, pid, mems[pid]))
+        moves += 1
+    return moves
+
+def play_match(seed, names, opts, stats):
+    random.seed(seed)
+    stats['games'] += 1
+    rules = rules_for(opts.rules)
+    room = E.init_room(opts.negative, opts.target, rules)
+    # 席の偏りを消すため、奇数番の局は方針を入れ替える
+    seats = (None,) + (tuple(names) if seed % 2 == 0 else tuple(reversed(names)))
+    while True:
+        for p in (1, 2):
+            room.players[p].secret = rand_num(room)
+        E.start_new_round(room)
+        moves = play_round(room, seats)
+        stats['rounds'] += 1
+        stats['moves'] += moves
+        if room.winner is None:
+            stats['unfinished'] += 1
+            break
+        win, lose = room.winner, 3 - room.winner
+        ticks = room.tick
+        stats['ticks'] += ticks
+        stats[('len', ticks)] += 1
+        stats[('round_win', seats[win])] += 1
+        stats[('round_seat', seats[win])] += 1
+        stats[('round_seat', seats[lose])] += 1
+        stats['starter_win'] += room.starter == win
+        stats[('end', E.EVENTS[room.actions.get(len(room.actions) - 1)[0]][0])] += 1
+        for p in (1, 2):
+            ps = room.players[p]
+            for role in {ps.role_main, ps.role_extra} - {None}:
+                stats[('role', role)] += 1
+                stats[('role_win', role)] += p == win
+        for k, on in rules.items():
+            stats[('rule', k, on)] += 1
+            stats[('rule_starter', k, on)] += room.starter == win
+            stats[('rule_ticks', k, on)] += ticks
+            stats[('rule_a', k, on)] += seats[win] == names[0]
+        if max(room.players[1].score, room.players[2].score) >= room.target_points:
+            stats[('match_win', seats[win])] += 1
+            stats[('match_seat', seats[win])] += 1
+            stats[('match_seat', seats[lose])] += 1
+            break
+        room.starter = lose
+        room.round_no += 1
+    room.actions.discard()
+
+def init_worker(opts):
+    E.INFO_MAX_DEFAULT = opts.info_max
+    E.KILL_THRESHOLDS = opts.kill
+    E.KILL_THRESHOLDS_TRAPPER = opts.kill_trapper
+
+def run_chunk(job):
+    start, count, names, opts = job
+    init_worker(opts)
+    stats = collections.Counter()
+    for seed in range(start, start + count):
+        play_match(seed, names, opts, stats)
+    return stats
+
+# ====== 集計の表示 ======
+def pct(a, b):
+    return f"{100.0 * a / b:5.1f}%" if b else "    -"
+
+def percentile(stats, q):
+    hist = sorted((k[1], v) for k, v in stats.items() if isinstance(k, tuple) and k[0] == 'len')
+    total = sum(v for _k, v in hist)
+    acc = 0
+    for ticks, v in hist:
+        acc += v
+        if acc >= q * total:
+            return ticks
+    return 0
+
+def report(stats, names, elapsed, jobs):
+    rounds = stats['rounds']
+    done = rounds - stats['unfinished']
+    print(f"games {stats['games']} / rounds {rounds} (cut at {MAX_MOVES} moves: {stats['unfinished']}) in {elapsed:.2f} s, jobs={jobs}: "
+          f"{stats['games'] / elapsed:,.1f} games/s, {rounds / elapsed:,.1f} rounds/s, {stats['moves'] / elapsed:,.0f} moves/s")
+    print(f"round length (ticks): mean {stats['ticks'] / max(1, done):.1f}, p50 {percentile(stats, 0.5)}, "
+          f"p90 {percentile(stats, 0.9)}; moves/round {stats['moves'] / max(1, rounds):.1f}; "
+          f"starter wins {pct(stats['starter_win'], done)}")
+    print("\npolicy          match win  round win")
+    for name in dict.fromkeys(names):
+        print(f"  {name:<14} {pct(stats[('match_win', name)], stats[('match_seat', name)])}"
+              f"     {pct(stats[('round_win', name)], stats[('round_seat', name)])}")
+    print("\nround ended by")
+    ends = sorted(((v, k[1]) for k, v in stats.items() if isinstance(k, tuple) and k[0] == 'end'), reverse=True)
+    for v, name in ends:
+        print(f"  {name:<16} {pct(v, done)}")
+    print("\nrole            rounds   win")
+    for role in E.ROLES:
+        n = stats[('role', role)]
+        if n:
+            print(f"  {role:<12} {n:8d}  {pct(stats[('role_win', role)], n)}")
+    # 方針が2種類の時だけ、ルール別に1つ目の方針のラウンド勝率も出す
+    a_col = names[0] != names[1]
+    head = f"{names[0][:10]:>10}" if a_col else ""
+    print(f"\nrule        on: rounds starter  ticks  {head}   | off: rounds starter  ticks  {head}")
+    for k in E.RULE_DEFAULTS:
+        cols = []
+        for on in (True, False):
+            n = stats[('rule', k, on)]
+            a = f" {pct(stats[('rule_a', k, on)], n):>10}" if a_col else ""
+            cols.append(f"{n:8d} {pct(stats[('rule_starter', k, on)], n)} {stats[('rule_ticks', k, on)] / n if n else 0:6.1f}{a}")
+        print(f"  {k:<10}{cols[0]}   |    {cols[1]}")
+
+def main():
+    ap = argparse.ArgumentParser(description="engine.py のルールでマッチをまとめて打つ")
+    ap.add_argument('-n', '--games', type=int, default=2000)
+    ap.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1)
+    ap.add_argument('--policies', default='greedy-hint,trap-heavy')
+    ap.add_argument('--rules', default='all')
+    ap.add_argument('--target', type=int, default=3)
+    ap.add_argument('--negative', action='store_true')
+    ap.add_argument('--info-max', type=int, default=E.INFO_MAX_DEFAULT)
+    ap.add_argument('--kill', default=','.join(map(str, E.KILL_THRESHOLDS)))
+    ap.add_argument('--kill-trapper', default=','.join(map(str, E.KILL_THRESHOLDS_TRAPPER)))
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--json', action='store_true', help="集計を JSON で出す")
+    opts = ap.parse_args()
+    opts.kill = tuple(int(x) for x in opts.kill.split(','))
+    opts.kill_trapper = tuple(int(x) for x in opts.kill_trapper.split(','))
+    names = [x.strip() for x in opts.policies.split(',')]
+    if len(names) == 1:
+        names *= 2
+    for name in names:
+        if name not in POLICIES:
+            ap.error(f"unknown policy {name!r} (choose from {', '.join(POLICIES)})")
+
+    # 1プロセスあたり数チャンク：終わるのが早いプロセスが次を取れる程度に細かく、IPC は集計だけ
+    jobs = max(1, opts.jobs)
+    size = max(1, opts.games // (jobs * 8))
+    chunks = [(opts.seed + i, min(size, opts.games - i), names, opts) for i in range(0, opts.games, size)]
+    stats = collections.Counter()
+    t0 = time.perf_counter()
+    if jobs == 1:
+        for job in chunks:
+            stats.update(run_chunk(job))
+    else:
+        with multiprocessing.Pool(jobs) as pool:
+            for part in pool.imap_unordered(run_chunk, chunks):
+                stats.update(part)
+    elapsed = time.perf_counter() - t0
+
+    if opts.json:
+        out = collections.defaultdict(dict)
+        for k, v in stats.items():
+            if isinstance(k, tuple):
+                out[k[0]]['/'.join(map(str, k[1:]))] = v
+            else:
+                out['total'][k] = v
+        out['total']['elapsed'] = elapsed
+        json.dump(out, sys.stdout, ensure_ascii=False, indent=1)
+        print()
+    else:
+        report(stats, names, elapsed, jobs)
+
+if __name__ == '__main__':
+    main()